@@ -0,0 +1,2 @@
+"""Benchmarks for the bird API. Run from the top-level directory with
+`python -m benchmarks.<name>'."""
@@ -0,0 +1,52 @@
+"""Keeping a copy of the bird list in sync, by listing or by changes
+
+A mirror catches up with a handful of writes either by downloading the
+whole list again, or by asking GET /birds/changes for what happened
+since its last token. Listing costs grow with the number of birds, while
+following changes costs only as much as there were changes."""
+
+import json
+import sys
+import time
+
+from birds import app
+from benchmarks.load import Engine, InProcessClient, bird
+
+ENGINES = ["memory"]
+SIZES = [1000, 10000, 100000]
+# Writes between two polls of the mirror, half of them deletes
+CHURN = 100
+ROUNDS = 5
+
+
+def timed(client, path, query_string = ""):
+    """Returns average time and size of a response."""
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        _, data = client.request("GET", path, query_string)
+    return (time.perf_counter() - start) / ROUNDS, len(data)
+
+def main(sizes = SIZES):
+    print("%-8s %7s %12s %12s %12s %12s" % (
+        "engine", "birds", "list", "list size", "changes", "changes size"))
+    for name in ENGINES:
+        for count in sizes:
+            with Engine(name) as engine:
+                ids = engine.store_many([bird(i) for i in range(count)])
+                client = InProcessClient(app.setup(birds_storage = engine,
+                                                   with_metrics = False))
+                _, data = client.request("GET", "/birds/changes")
+                token = json.loads(data.decode("utf-8"))["next"]
+                engine.store_many([bird(i) for i in range(CHURN // 2)])
+                for bird_id in ids[:CHURN // 2]:
+                    engine.remove(bird_id)
+                listing, listing_size = timed(client, "/birds")
+                changes, changes_size = timed(client, "/birds/changes",
+                                              "since=" + token)
+            print("%-8s %7d %9.2f ms %9.1f kB %9.2f ms %9.1f kB" % (
+                name, count, listing * 1e3, listing_size / 1e3,
+                changes * 1e3, changes_size / 1e3))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or SIZES)
@@ -0,0 +1,93 @@
+"""Write latency and throughput with and without coalescing
+
+Threads store birds as fast as they can, each one at a time, straight
+through the storage engine or through a CoalescingStorage with various
+windows. Engines wait for the disk on every write, which is the cost that
+storing writes together shares out. Coalescing trades latency of lone
+writes for throughput of concurrent ones, so look at both."""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from birds import logstorage
+from birds import storage
+from benchmarks.load import bird, percentile
+
+ENGINES = ["sqlite", "log"]
+CLIENTS = [1, 16]
+# Milliseconds, None is no coalescing at all
+WINDOWS = [None, 0.5, 2.0, 5.0]
+WRITES = 4000
+
+
+def open_engine(name, directory):
+    if name == "sqlite":
+        return storage.SqliteStorage(os.path.join(directory, "birds.db"),
+                                     sync = True)
+    return logstorage.LogStorage(directory, sync = True,
+                                 compaction_interval = None)
+
+def write(engine, count, latencies):
+    for number in range(count):
+        start = time.perf_counter()
+        engine.store(bird(number))
+        latencies.append(time.perf_counter() - start)
+
+def measure(name, clients, window, batch_size, writes):
+    directory = tempfile.mkdtemp()
+    try:
+        engine = open_engine(name, directory)
+        front = engine
+        if window is not None:
+            front = storage.CoalescingStorage(engine, batch_size,
+                                              window / 1000.0)
+        latencies = [[] for _ in range(clients)]
+        threads = [threading.Thread(target = write,
+                                    args = (front, writes // clients,
+                                            latencies[index]))
+                   for index in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        engine.close()
+    finally:
+        shutil.rmtree(directory)
+    merged = sorted(latency for client in latencies for latency in client)
+    return (len(merged) / elapsed, percentile(merged, 50) * 1e3,
+            percentile(merged, 99) * 1e3)
+
+
+parser = argparse.ArgumentParser(prog = "python -m benchmarks.coalescing",
+                                 description = __doc__.split("\n")[0])
+parser.add_argument("--writes", type = int, default = WRITES,
+                    help = "writes per run (default: %(default)s)")
+parser.add_argument("--batch-size", type = int,
+                    default = storage.DEFAULT_COALESCE_BATCH_SIZE,
+                    help = "most writes stored together "
+                    "(default: %(default)s)")
+
+def main(argv = None):
+    args = parser.parse_args(argv)
+    print("%-7s %7s %9s %12s %10s %10s" % (
+        "engine", "clients", "window", "writes/s", "p50 ms", "p99 ms"))
+    for name in ENGINES:
+        for clients in CLIENTS:
+            for window in WINDOWS:
+                throughput, p50, p99 = measure(name, clients, window,
+                                               args.batch_size, args.writes)
+                print("%-7s %7d %9s %12.0f %10.3f %10.3f" % (
+                    name, clients,
+                    "none" if window is None else "%.1f ms" % window,
+                    throughput, p50, p99))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
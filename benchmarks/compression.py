@@ -0,0 +1,55 @@
+"""Listing pages of birds with and without compression, cached or not
+
+A page of ids is serialized, and compressed if the client accepts it,
+once per version of the list. The first request after a change pays for
+both, repeated requests only for copying the kept body. Lists without a
+limit are streamed instead, and pay for both every time."""
+
+import sys
+import time
+
+from birds import app
+from birds.resources import MAX_PAGE_SIZE
+from benchmarks.load import Engine, InProcessClient, bird
+
+SIZES = [100, 1000, MAX_PAGE_SIZE]
+CODINGS = [None, "gzip", "deflate"]
+ROUNDS = 20
+
+
+def measure(engine, client, coding, limit):
+    """Returns average time of a first and of a repeated request for a
+    page of `limit' birds, and the size of the response."""
+    headers = {} if coding is None else {"Accept-Encoding" : coding}
+    query_string = "limit=%d" % limit
+    first = repeated = 0.0
+    for _ in range(ROUNDS):
+        # A new visible bird changes the list
+        engine.store(bird(0))
+        start = time.perf_counter()
+        _, data = client.request("GET", "/birds", query_string,
+                                 headers = headers)
+        middle = time.perf_counter()
+        client.request("GET", "/birds", query_string, headers = headers)
+        first += middle - start
+        repeated += time.perf_counter() - middle
+    return first / ROUNDS, repeated / ROUNDS, len(data)
+
+def main(sizes = SIZES):
+    print("%7s %-8s %10s %12s %12s" % (
+        "page", "coding", "size", "first", "repeated"))
+    for count in sizes:
+        with Engine("memory") as engine:
+            engine.store_many([bird(i) for i in range(count)])
+            client = InProcessClient(app.setup(birds_storage = engine,
+                                               with_metrics = False))
+            for coding in CODINGS:
+                first, repeated, size = measure(engine, client, coding,
+                                                count)
+                print("%7d %-8s %7.1f kB %9.2f ms %9.2f ms" % (
+                    count, coding or "identity", size / 1e3, first * 1e3,
+                    repeated * 1e3))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or SIZES)
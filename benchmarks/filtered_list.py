@@ -0,0 +1,88 @@
+"""Cost of listing birds filtered by family and continent
+
+Fills each engine with birds of many families, spread over the continents,
+then times the first page of selective filtered listings, against telling
+matching birds apart by retrieving every visible one, which is what
+listing cost without the indexes. Rarer families make more selective
+queries, so the index should stay fast however many birds there are."""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from birds import logstorage
+from birds import storage
+
+SIZES = [10000, 100000]
+ENGINES = ["memory", "sqlite", "log"]
+FAMILIES = 200
+CONTINENTS = ["Africa", "Antarctica", "Asia", "Australia", "Europe",
+              "North America", "South America"]
+PAGE_SIZE = 100
+QUERIES = 200
+SCANS = 3
+
+
+def bird(rng):
+    return {"name" : "Bird",
+            "family" : "Family %d" % rng.randrange(FAMILIES),
+            "continents" : rng.sample(CONTINENTS, rng.randint(1, 3)),
+            "visible" : rng.random() < 0.9}
+
+def open_engine(name, directory):
+    if name == "memory":
+        return storage.MemoryStorage()
+    elif name == "sqlite":
+        return storage.SqliteStorage(os.path.join(directory, "birds.db"))
+    return logstorage.LogStorage(directory, compaction_interval = None)
+
+def filters(rng):
+    """Random family, continent or both."""
+    family = "Family %d" % rng.randrange(FAMILIES)
+    continent = rng.choice(CONTINENTS)
+    return rng.choice([(family, None), (None, continent), (family, continent)])
+
+def scan(engine, family, continent):
+    """Lists matching birds without the filter indexes."""
+    found = []
+    for item_id in engine.list():
+        if storage.matches(engine.retrieve(item_id), family, continent):
+            found.append(item_id)
+            if len(found) == PAGE_SIZE:
+                break
+    return found
+
+def timed(function, queries):
+    start = time.perf_counter()
+    for family, continent in queries:
+        function(family, continent)
+    return (time.perf_counter() - start) / len(queries)
+
+def main(sizes = SIZES):
+    print("%-8s %9s %14s %14s" % ("engine", "birds", "indexed", "scan"))
+    for name in ENGINES:
+        for count in sizes:
+            rng = random.Random(0)
+            directory = tempfile.mkdtemp()
+            try:
+                engine = open_engine(name, directory)
+                engine.store_many([bird(rng) for _ in range(count)])
+                queries = [filters(rng) for _ in range(QUERIES)]
+                indexed = timed(lambda family, continent: list(engine.list(
+                    limit = PAGE_SIZE, family = family,
+                    continent = continent)), queries)
+                scanned = timed(lambda family, continent: scan(
+                    engine, family, continent), queries[:SCANS])
+                if hasattr(engine, "close"):
+                    engine.close()
+            finally:
+                shutil.rmtree(directory)
+            print("%-8s %9d %11.1f us %11.1f us" % (
+                name, count, indexed * 1e6, scanned * 1e6))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or SIZES)
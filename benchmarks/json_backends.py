@@ -0,0 +1,69 @@
+"""GET by id throughput with every installed JSON backend
+
+Fetches the same birds over and over straight from the WSGI application,
+from memory storage with the serialized records reused or serialized
+again for every request, and from SQLite storage, which returns plain
+dictionaries that are serialized by the JSON backend every time."""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from birds import app
+from birds import jsoncodec
+from birds import storage
+from benchmarks.load import InProcessClient, bird
+
+BIRDS = 100
+REQUESTS = 20000
+
+
+class Uncached(storage.MemoryStorage):
+    """Memory storage forgetting what records serialized to."""
+
+    def retrieve(self, item_id):
+        record = super(Uncached, self).retrieve(item_id)
+        if record is not None:
+            record.encoded = None
+        return record
+
+
+def throughput(engine, requests):
+    ids = ["/birds/%s" % item_id
+           for item_id in engine.store_many([bird(i) for i in range(BIRDS)])]
+    client = InProcessClient(app.setup(birds_storage = engine,
+                                       with_metrics = False))
+    start = time.perf_counter()
+    for number in range(requests):
+        status, _ = client.request("GET", ids[number % BIRDS])
+        assert status == 200
+    return requests / (time.perf_counter() - start)
+
+def sqlite_throughput(requests):
+    directory = tempfile.mkdtemp()
+    engine = storage.SqliteStorage(os.path.join(directory, "birds.db"))
+    try:
+        return throughput(engine, requests)
+    finally:
+        engine.close()
+        shutil.rmtree(directory)
+
+def main(requests = REQUESTS):
+    print("%8s %14s %14s %14s" % ("backend", "memory", "uncached",
+                                  "sqlite"))
+    previous = jsoncodec.backend
+    try:
+        for name in jsoncodec.available():
+            jsoncodec.use(name)
+            print("%8s %11.0f /s %11.0f /s %11.0f /s" % (
+                name, throughput(storage.MemoryStorage(), requests),
+                throughput(Uncached(), requests),
+                sqlite_throughput(requests)))
+    finally:
+        jsoncodec.use(previous)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,342 @@
+"""Request latency and throughput of the whole application
+
+Sends a random mix of requests to the application made by app.setup(),
+with the storage engines given on the command line. Requests go straight
+to the WSGI application in this process, or with `--transport socket'
+through the HTTP server over a real socket. Prints throughput and latency
+percentiles of every kind of request.
+
+`--output' saves results as JSON. Given a `--baseline' saved that way, the
+run is compared against it and exits with status 1 if any percentile got
+slower, or throughput lower, by more than the tolerance. Latency of short
+runs is noisy, so keep both runs long enough and on the same machine."""
+
+from pymongo import MongoClient
+import argparse
+import falcon.testing
+import http.client
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from birds import app
+from birds import logstorage
+from birds import server
+from birds import storage
+
+ENGINES = ["memory", "sqlite", "log", "mongo"]
+DEFAULT_ENGINES = ["memory", "sqlite", "log"]
+TRANSPORTS = ["inprocess", "socket"]
+PERCENTILES = [50, 95, 99]
+DEFAULT_REQUESTS = 20000
+DEFAULT_BIRDS = 1000
+DEFAULT_CLIENTS = 1
+DEFAULT_TOLERANCE = 0.2
+PAGE_SIZE = 100
+MONGO_COLLECTION = "load_benchmark"
+
+# Endpoint names and their share of the requests
+MIX = [("GET /birds/{id}", 60),
+       ("GET /birds?limit", 15),
+       ("POST /birds", 15),
+       ("DELETE /birds/{id}", 10)]
+
+
+def bird(number):
+    return {"name" : "Bird %d" % number,
+            "family" : "Birdies",
+            "continents" : ["Europe", "Asia"],
+            "visible" : number % 2 == 0}
+
+
+class InProcessClient(object):
+    """Calls the WSGI application directly."""
+
+    def __init__(self, application):
+        self.application = application
+
+    def request(self, method, path, query_string = "", body = "",
+                headers = None):
+        environ = falcon.testing.create_environ(
+            path, query_string, method = method, body = body,
+            headers = headers)
+        start_response = falcon.testing.StartResponseMock()
+        result = self.application(environ, start_response)
+        data = b"".join(result)
+        return int(start_response.status[:3]), data
+
+    def close(self):
+        pass
+
+
+class SocketClient(object):
+    """Makes requests over a kept alive connection."""
+
+    def __init__(self, port):
+        self.connection = http.client.HTTPConnection("127.0.0.1", port)
+
+    def request(self, method, path, query_string = "", body = None):
+        if query_string:
+            path += "?" + query_string
+        self.connection.request(method, path, body = body or None)
+        response = self.connection.getresponse()
+        return response.status, response.read()
+
+    def close(self):
+        self.connection.close()
+
+
+class Workload(object):
+    """Random requests, with the ids of birds known to exist."""
+
+    def __init__(self, ids, seed):
+        self.ids = list(ids)
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+        self.names = [name for name, _ in MIX]
+        self.weights = [weight for _, weight in MIX]
+        self.posted = 0
+
+    def next(self):
+        """Returns endpoint name, method, path, query string and body."""
+        with self.lock:
+            name = self.rng.choices(self.names, self.weights)[0]
+            if name == "GET /birds/{id}" and self.ids:
+                return (name, "GET",
+                        "/birds/%s" % self.rng.choice(self.ids), "", "")
+            elif name == "GET /birds?limit":
+                return name, "GET", "/birds", "limit=%d" % PAGE_SIZE, ""
+            elif name == "DELETE /birds/{id}" and self.ids:
+                index = self.rng.randrange(len(self.ids))
+                self.ids[index], self.ids[-1] = self.ids[-1], self.ids[index]
+                return (name, "DELETE", "/birds/%s" % self.ids.pop(),
+                        "", "")
+            self.posted += 1
+            return ("POST /birds", "POST", "/birds", "",
+                    json.dumps(bird(self.posted)))
+
+    def created(self, body):
+        item_id = json.loads(body.decode("utf-8"))["id"]
+        with self.lock:
+            self.ids.append(item_id)
+
+
+EXPECTED_STATUS = {"GET" : 200, "POST" : 201, "DELETE" : 200}
+
+def run_client(client, workload, count, latencies, errors):
+    try:
+        for _ in range(count):
+            name, method, path, query_string, body = workload.next()
+            start = time.perf_counter()
+            status, data = client.request(method, path, query_string, body)
+            latencies.setdefault(name, []).append(time.perf_counter() - start)
+            if status != EXPECTED_STATUS[method]:
+                errors[name] = errors.get(name, 0) + 1
+            elif method == "POST":
+                workload.created(data)
+    finally:
+        client.close()
+
+
+def percentile(ordered, percent):
+    """Nearest-rank percentile of an ordered list."""
+    rank = max(0, int(round(percent / 100.0 * len(ordered))) - 1)
+    return ordered[rank]
+
+def summarize(latencies, errors, elapsed):
+    endpoints = {}
+    for name, values in latencies.items():
+        values.sort()
+        summary = {"count" : len(values),
+                   "errors" : errors.get(name, 0),
+                   "throughput" : len(values) / elapsed}
+        for percent in PERCENTILES:
+            summary["p%d" % percent] = percentile(values, percent) * 1e3
+        endpoints[name] = summary
+    total = sum(len(values) for values in latencies.values())
+    return {"throughput" : total / elapsed, "endpoints" : endpoints}
+
+
+class Engine(object):
+    """Creates a storage engine and cleans up after it."""
+
+    def __init__(self, name):
+        self.name = name
+        self.directory = None
+        self.client = None
+
+    def __enter__(self):
+        if self.name == "memory":
+            self.storage = storage.ShardedMemoryStorage()
+        elif self.name == "sqlite":
+            self.directory = tempfile.mkdtemp()
+            self.storage = storage.SqliteStorage(
+                os.path.join(self.directory, "birds.db"))
+        elif self.name == "log":
+            self.directory = tempfile.mkdtemp()
+            self.storage = logstorage.LogStorage(self.directory)
+        else:
+            self.client = MongoClient()
+            collection = self.client.test_db[MONGO_COLLECTION]
+            collection.drop()
+            self.storage = storage.MongoStorage(collection)
+            self.storage.ensure_indexes()
+            self.storage.ensure_change_log()
+        return self.storage
+
+    def __exit__(self, *exc_info):
+        if hasattr(self.storage, "close"):
+            self.storage.close()
+        if self.directory is not None:
+            shutil.rmtree(self.directory)
+        if self.client is not None:
+            self.client.test_db.drop_collection(MONGO_COLLECTION)
+            self.client.test_db.drop_collection(MONGO_COLLECTION + ".meta")
+            self.client.test_db.drop_collection(MONGO_COLLECTION + ".changes")
+            self.client.close()
+
+
+def measure(engine_name, transport, requests, birds, clients, seed,
+            with_metrics = True):
+    with Engine(engine_name) as engine:
+        ids = engine.store_many([bird(i) for i in range(birds)])
+        application = app.setup(birds_storage = engine,
+                                with_metrics = with_metrics)
+        workload = Workload(ids, seed)
+        worker_server = None
+        if transport == "socket":
+            worker_server = server.WorkerServer(
+                server.bind("127.0.0.1", 0, server.DEFAULT_BACKLOG),
+                application, clients, server.DEFAULT_KEEPALIVE_TIMEOUT)
+            threading.Thread(target = worker_server.serve_forever,
+                             daemon = True).start()
+            port = worker_server.socket.getsockname()[1]
+            connect = lambda: SocketClient(port)
+        else:
+            connect = lambda: InProcessClient(application)
+
+        latencies = [{} for _ in range(clients)]
+        errors = [{} for _ in range(clients)]
+        threads = []
+        for index in range(clients):
+            client = connect()
+            count = requests // clients + (index < requests % clients)
+            threads.append(threading.Thread(
+                target = run_client,
+                args = (client, workload, count, latencies[index],
+                        errors[index])))
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        if worker_server is not None:
+            worker_server.stop_accepting()
+            worker_server.pool.shutdown(wait = True)
+            worker_server.server_close()
+
+    merged = {}
+    merged_errors = {}
+    for client_latencies, client_errors in zip(latencies, errors):
+        for name, values in client_latencies.items():
+            merged.setdefault(name, []).extend(values)
+        for name, count in client_errors.items():
+            merged_errors[name] = merged_errors.get(name, 0) + count
+    return summarize(merged, merged_errors, elapsed)
+
+
+def regressions(results, baseline, tolerance):
+    """Generates descriptions of what got worse than in `baseline'."""
+    for engine, result in sorted(results["engines"].items()):
+        expected = baseline["engines"].get(engine)
+        if expected is None:
+            continue
+        for name, summary in sorted(result["endpoints"].items()):
+            before = expected["endpoints"].get(name)
+            if before is None:
+                continue
+            for percent in PERCENTILES:
+                key = "p%d" % percent
+                if summary[key] > before[key] * (1 + tolerance):
+                    yield "%s %s %s: %.3f ms, was %.3f ms" % (
+                        engine, name, key, summary[key], before[key])
+            if summary["throughput"] < before["throughput"] * (1 - tolerance):
+                yield "%s %s throughput: %.0f/s, was %.0f/s" % (
+                    engine, name, summary["throughput"], before["throughput"])
+
+def report(results):
+    print("%d requests over %s, %d clients" % (
+        results["requests"], results["transport"], results["clients"]))
+    for engine, result in sorted(results["engines"].items()):
+        print("\n%s: %.0f requests/s" % (engine, result["throughput"]))
+        print("  %-20s %8s %6s %10s %10s %10s" % (
+            "endpoint", "req/s", "errors", "p50 ms", "p95 ms", "p99 ms"))
+        for name, summary in sorted(result["endpoints"].items()):
+            print("  %-20s %8.0f %6d %10.3f %10.3f %10.3f" % (
+                name, summary["throughput"], summary["errors"],
+                summary["p50"], summary["p95"], summary["p99"]))
+
+
+parser = argparse.ArgumentParser(prog = "python -m benchmarks.load",
+                                 description = __doc__.split("\n")[0])
+parser.add_argument("--engine", dest = "engines", action = "append",
+                    choices = ENGINES,
+                    help = "storage engine to measure, may be repeated "
+                    "(default: %s)" % " ".join(DEFAULT_ENGINES))
+parser.add_argument("--transport", choices = TRANSPORTS,
+                    default = "inprocess",
+                    help = "how requests get to the application "
+                    "(default: %(default)s)")
+parser.add_argument("--requests", type = int, default = DEFAULT_REQUESTS,
+                    help = "requests per engine (default: %(default)s)")
+parser.add_argument("--birds", type = int, default = DEFAULT_BIRDS,
+                    help = "birds stored up front (default: %(default)s)")
+parser.add_argument("--clients", type = int, default = DEFAULT_CLIENTS,
+                    help = "concurrent clients (default: %(default)s)")
+parser.add_argument("--seed", type = int, default = 0,
+                    help = "seed of the request mix (default: %(default)s)")
+parser.add_argument("--without-metrics", action = "store_true",
+                    help = "leave out request and storage timing")
+parser.add_argument("--output", help = "file to save results to, as JSON")
+parser.add_argument("--baseline", help = "results to compare against")
+parser.add_argument("--tolerance", type = float, default = DEFAULT_TOLERANCE,
+                    help = "allowed share of slowdown before calling it "
+                    "a regression (default: %(default)s)")
+
+def main(argv = None):
+    args = parser.parse_args(argv)
+    results = {"transport" : args.transport,
+               "requests" : args.requests,
+               "birds" : args.birds,
+               "clients" : args.clients,
+               "engines" : {}}
+    for engine in args.engines or DEFAULT_ENGINES:
+        results["engines"][engine] = measure(
+            engine, args.transport, args.requests, args.birds, args.clients,
+            args.seed, not args.without_metrics)
+    report(results)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent = 2, sort_keys = True)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        found = list(regressions(results, baseline, args.tolerance))
+        if found:
+            print("\nRegressions against %s:" % args.baseline)
+            for regression in found:
+                print("  " + regression)
+            return 1
+        print("\nNo regressions against %s" % args.baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
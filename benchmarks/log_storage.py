@@ -0,0 +1,76 @@
+"""LogStorage write, read and recovery cost
+
+Stores birds one by one and in batches, with and without waiting for the
+disk, reads them back, and measures how long reopening the log takes,
+which is what recovering after a crash costs, before and after
+compaction."""
+
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from birds import logstorage
+
+SIZES = [10000, 100000]
+BATCH_SIZE = 1000
+SYNCED_WRITES = 200
+RETRIEVALS = 10000
+
+
+def bird(number):
+    return {"name" : "Bird %d" % number,
+            "family" : "Birdies",
+            "continents" : ["Europe", "Asia"],
+            "visible" : number % 2 == 0}
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+def open_storage(path, sync = False):
+    return logstorage.LogStorage(path, sync = sync,
+                                 compaction_interval = None)
+
+def main(sizes = SIZES):
+    print("%9s %12s %12s %12s %12s %12s %12s" % (
+        "birds", "store", "store_many", "synced", "retrieve",
+        "recovery", "compacted"))
+    for count in sizes:
+        path = tempfile.mkdtemp()
+        try:
+            engine = open_storage(path)
+            single, ids = timed(lambda: [engine.store(bird(i))
+                                         for i in range(count)])
+            batched, _ = timed(lambda: [
+                engine.store_many([bird(i) for i in range(j, j + BATCH_SIZE)])
+                for j in range(0, count, BATCH_SIZE)])
+            engine.close()
+
+            engine = open_storage(path, sync = True)
+            synced, _ = timed(lambda: [engine.store(bird(i))
+                                       for i in range(SYNCED_WRITES)])
+            sample = random.Random(0).sample(ids, min(RETRIEVALS, count))
+            reading, _ = timed(lambda: [engine.retrieve(item_id)
+                                        for item_id in sample])
+            for item_id in ids:
+                engine.remove(item_id)
+            engine.close()
+
+            recovery, engine = timed(lambda: open_storage(path))
+            engine.compact()
+            engine.close()
+            compacted, engine = timed(lambda: open_storage(path))
+            engine.close()
+        finally:
+            shutil.rmtree(path)
+
+        print("%9d %9.0f /s %9.0f /s %9.0f /s %9.2f us %9.0f ms %9.0f ms" % (
+            count, count / single, count / batched, SYNCED_WRITES / synced,
+            reading / len(sample) * 1e6, recovery * 1e3, compacted * 1e3))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or SIZES)
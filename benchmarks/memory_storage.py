@@ -0,0 +1,53 @@
+"""MemoryStorage list and retrieve cost with mostly hidden birds
+
+Compares the storage with what it did before it kept an index of visible
+birds and cheap copies: scanning every bird to list the visible ones, and
+retrieving with copy.deepcopy."""
+
+import copy
+import sys
+import timeit
+
+from birds import storage
+
+SIZES = [10000, 100000, 1000000]
+VISIBLE_RATIO = 0.01
+RETRIEVALS = 10000
+
+
+def scanning_list(engine):
+    return [key for key, item in engine.database.items()
+            if storage.VISIBLE_KEY in item and item[storage.VISIBLE_KEY]]
+
+def deepcopy_retrieve(engine, item_id):
+    return copy.deepcopy(engine.database.get(engine.parse_oid(item_id)))
+
+def fill(count):
+    engine = storage.MemoryStorage()
+    every = int(1 / VISIBLE_RATIO)
+    engine.store_many({"name" : "Bird %d" % i,
+                       "family" : "Birdies",
+                       "continents" : ["Europe", "Asia"],
+                       "visible" : i % every == 0}
+                      for i in range(count))
+    return engine
+
+def best(function, number):
+    return min(timeit.repeat(function, number = number, repeat = 3)) / number
+
+def main(sizes = SIZES):
+    print("%9s %14s %14s %14s %14s" % ("birds", "scan list", "index list",
+                                       "deepcopy get", "copy_item get"))
+    for count in sizes:
+        engine = fill(count)
+        item_id = next(iter(engine.database))
+        print("%9d %11.3f ms %11.3f ms %11.2f us %11.2f us" % (
+            count,
+            best(lambda: scanning_list(engine), 5) * 1e3,
+            best(lambda: list(engine.list()), 5) * 1e3,
+            best(lambda: deepcopy_retrieve(engine, item_id), RETRIEVALS) * 1e6,
+            best(lambda: engine.retrieve(item_id), RETRIEVALS) * 1e6))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or SIZES)
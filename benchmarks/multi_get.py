@@ -0,0 +1,57 @@
+"""Fetching a page of birds one request at a time, or all at once
+
+Lists a page of birds, then fetches every one of them with its own
+GET /birds/{id}, against a single POST /birds/_mget of the whole page and
+a GET /birds?expand=true listing the birds themselves. Requests go
+straight to the application, so this leaves out the network round trips
+that make separate requests cost even more."""
+
+import json
+import sys
+import time
+
+from birds import app
+from benchmarks.load import Engine, InProcessClient, bird
+
+ENGINES = ["memory", "sqlite", "log"]
+BIRDS = 10000
+PAGE_SIZES = [100, 1000]
+ROUNDS = 5
+
+
+def one_by_one(client, page_size):
+    _, data = client.request("GET", "/birds", "limit=%d" % page_size)
+    for bird_id in json.loads(data.decode("utf-8")):
+        client.request("GET", "/birds/" + bird_id)
+
+def multi_get(client, page_size):
+    _, data = client.request("GET", "/birds", "limit=%d" % page_size)
+    client.request("POST", "/birds/_mget", body = data)
+
+def expanded(client, page_size):
+    client.request("GET", "/birds", "expand=true&limit=%d" % page_size)
+
+def timed(function, *args):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        function(*args)
+    return (time.perf_counter() - start) / ROUNDS
+
+def main(page_sizes = PAGE_SIZES):
+    print("%-8s %6s %14s %14s %14s" % ("engine", "page", "one by one",
+                                       "_mget", "expand"))
+    for name in ENGINES:
+        with Engine(name) as engine:
+            engine.store_many([bird(i) for i in range(BIRDS)])
+            client = InProcessClient(app.setup(birds_storage = engine,
+                                               with_metrics = False))
+            for page_size in page_sizes:
+                print("%-8s %6d %11.2f ms %11.2f ms %11.2f ms" % (
+                    name, page_size,
+                    timed(one_by_one, client, page_size) * 1e3,
+                    timed(multi_get, client, page_size) * 1e3,
+                    timed(expanded, client, page_size) * 1e3))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or PAGE_SIZES)
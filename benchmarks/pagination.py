@@ -0,0 +1,36 @@
+"""GET /birds page latency at increasing depth into a large collection"""
+
+import sys
+import timeit
+
+from birds import resources
+from birds import storage
+
+COUNT = 1000000
+PAGE_SIZE = 100
+NUMBER = 1000
+
+
+def memory_storage(count):
+    engine = storage.MemoryStorage()
+    engine.store_many({"name" : "Bird", "visible" : True}
+                      for _ in range(count))
+    return engine
+
+def main(count = COUNT):
+    engine = memory_storage(count)
+    ids = list(engine.list())
+    print("%d visible birds, pages of %d" % (count, PAGE_SIZE))
+    for depth in (0, 0.25, 0.5, 0.75, 0.99):
+        position = int(depth * (count - PAGE_SIZE))
+        cursor = resources.encode_cursor(ids[position])
+        def page():
+            after = resources.decode_cursor(cursor)
+            return list(engine.list(after, PAGE_SIZE + 1))
+        seconds = min(timeit.repeat(page, number = NUMBER, repeat = 3))
+        print("page at %3d%% %8.2f us/page" % (
+            depth * 100, seconds / NUMBER * 1e6))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,51 @@
+"""Memory per bird held as a dictionary and as a records.BirdRecord"""
+
+from bson.objectid import ObjectId
+import gc
+import sys
+import tracemalloc
+
+from birds import records
+from birds import storage
+
+COUNT = 1000000
+CONTINENTS = [["Europe"], ["Asia", "Europe"], ["Africa"],
+              ["North America", "South America"]]
+FAMILIES = ["Anatidae", "Corvidae", "Paridae", "Strigidae"]
+
+
+def make_bird(i):
+    bird = {"name" : "Bird number %d" % i,
+            "family" : FAMILIES[i % len(FAMILIES)],
+            "continents" : list(CONTINENTS[i % len(CONTINENTS)]),
+            "visible" : i % 2 == 0,
+            "added" : "2016-%02d-%02d" % (i % 12 + 1, i % 28 + 1)}
+    storage.add_etag(bird)
+    bird[storage.ID_KEY] = ObjectId()
+    return bird
+
+def measure(count, convert):
+    """Bytes allocated per bird for a database of converted birds."""
+    gc.collect()
+    tracemalloc.start()
+    database = {}
+    for i in range(count):
+        bird = make_bird(i)
+        database[bird[storage.ID_KEY]] = convert(bird)
+    del bird
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return used / count
+
+def main(count = COUNT):
+    as_dict = measure(count, lambda bird: bird)
+    as_record = measure(count, records.BirdRecord)
+    print("%d birds" % count)
+    print("dictionary %8.1f bytes/bird" % as_dict)
+    print("record     %8.1f bytes/bird (%.0f%%)" % (
+        as_record, as_record / as_dict * 100))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,72 @@
+"""Server throughput against the number of worker processes
+
+Starts `python -m birds' with memory storage for every worker count and
+hammers it with keep-alive clients in separate processes. Throughput can
+only scale up to the number of cores shared by the server and clients."""
+
+import http.client
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+PORT = 8765
+CLIENTS = 8
+DURATION = 5.0
+WORKER_COUNTS = [1, 2, 4]
+BIRD = b'{"name": "Bird", "family": "Birdies", "continents": ["Europe"]}'
+
+
+def client(deadline):
+    """Posts a bird, then fetches it until deadline. Returns count."""
+    connection = http.client.HTTPConnection("127.0.0.1", PORT)
+    connection.request("POST", "/birds", body = BIRD)
+    response = connection.getresponse()
+    response.read()
+    location = response.getheader("Location")
+    count = 0
+    while time.time() < deadline:
+        connection.request("GET", location)
+        connection.getresponse().read()
+        count += 1
+    connection.close()
+    return count
+
+def wait_until_up(timeout = 10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", PORT)
+            connection.request("GET", "/birds")
+            connection.getresponse().read()
+            connection.close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("Server did not start")
+
+def measure(workers):
+    process = subprocess.Popen(
+        [sys.executable, "-m", "birds", "--storage", "memory",
+         "--port", str(PORT), "--workers", str(workers)],
+        stderr = subprocess.DEVNULL)
+    try:
+        wait_until_up()
+        deadline = time.time() + DURATION
+        with multiprocessing.Pool(CLIENTS) as pool:
+            counts = pool.map(client, [deadline] * CLIENTS)
+        return sum(counts) / DURATION
+    finally:
+        process.terminate()
+        process.wait()
+
+def main():
+    print("%d cores, %d keep-alive clients, GET /birds/{id}" % (
+        os.cpu_count(), CLIENTS))
+    for workers in WORKER_COUNTS:
+        print("%2d workers %10.0f requests/s" % (workers, measure(workers)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Throughput of ShardedMemoryStorage as threads are added
+
+Threads run a mix of reads, writes, removals and list pages against a
+ShardedMemoryStorage with a single stripe, which is one global lock, and
+with many. Only one thread runs Python code at a time, so do not expect
+throughput to grow with threads; what stripes spare is threads queueing
+for the lock, which shows as the single lock falling behind."""
+
+import random
+import sys
+import threading
+import time
+
+from birds import storage
+from benchmarks.load import bird
+
+THREADS = [1, 2, 4, 8, 16]
+STRIPES = [1, storage.DEFAULT_STRIPES]
+BIRDS = 10000
+OPERATIONS = 100000
+PAGE_SIZE = 100
+
+# Operations and their share of the mix
+MIX = [("retrieve", 70), ("store", 15), ("remove", 10), ("list", 5)]
+
+
+def run(engine, ids, count, seed):
+    rng = random.Random(seed)
+    names = [name for name, _ in MIX]
+    weights = [weight for _, weight in MIX]
+    mine = []
+    for name in rng.choices(names, weights, k = count):
+        if name == "retrieve":
+            engine.retrieve(rng.choice(ids))
+        elif name == "store":
+            mine.append(engine.store(bird(len(mine))))
+        elif name == "remove" and mine:
+            engine.remove(mine.pop())
+        else:
+            list(engine.list(limit = PAGE_SIZE))
+
+def measure(stripes, threads):
+    engine = storage.ShardedMemoryStorage(stripes)
+    ids = engine.store_many([bird(number) for number in range(BIRDS)])
+    workers = [threading.Thread(target = run,
+                                args = (engine, ids, OPERATIONS // threads,
+                                        seed))
+               for seed in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return OPERATIONS / (time.perf_counter() - start)
+
+def main(threads = THREADS):
+    print("%8s" % "threads" + "".join("%16s" % ("%d stripes" % stripes)
+                                      for stripes in STRIPES))
+    for count in threads:
+        print("%8d" % count + "".join(
+            "%12.0f /s " % measure(stripes, count) for stripes in STRIPES))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or THREADS)
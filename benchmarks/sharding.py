@@ -0,0 +1,145 @@
+"""Throughput of ShardedStorage against the number of shards
+
+Threads store birds in batches, retrieve them and list pages through a
+ShardedStorage of one to many shards of the chosen engine, one kind of
+operation at a time. Batches are split between shards and stored on all
+of them at once, and list pages are gathered from all of them at once.
+
+Shards only add throughput when they work in parallel: SQLite and
+MongoDB shards wait for the disk or the network with the GIL released,
+while memory shards all run Python code, one thread at a time, and only
+show what routing costs. MongoDB shards are collections of the local
+server, so they share its disk; shards on servers of their own are what
+spreads the writes."""
+
+from pymongo import MongoClient
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from birds import storage
+from benchmarks.load import bird
+
+ENGINES = ["memory", "sqlite", "mongo"]
+SHARDS = [1, 2, 4, 8]
+DEFAULT_THREADS = 8
+DEFAULT_BIRDS = 20000
+OPERATIONS = 2000
+BATCH_SIZE = 100
+PAGE_SIZE = 100
+MONGO_COLLECTION = "sharding_benchmark_%d"
+
+
+class Shards(object):
+    """Creates shards of an engine and cleans up after them."""
+
+    def __init__(self, name, count):
+        self.name = name
+        self.count = count
+        self.directory = None
+        self.client = None
+
+    def __enter__(self):
+        if self.name == "memory":
+            self.shards = [storage.ShardedMemoryStorage()
+                           for _ in range(self.count)]
+        elif self.name == "sqlite":
+            self.directory = tempfile.mkdtemp()
+            self.shards = [storage.SqliteStorage(os.path.join(
+                self.directory, "shard%d.db" % number))
+                           for number in range(self.count)]
+        else:
+            self.client = MongoClient()
+            self.shards = []
+            for number in range(self.count):
+                collection = self.client.test_db[MONGO_COLLECTION % number]
+                collection.drop()
+                engine = storage.MongoStorage(collection)
+                engine.ensure_indexes()
+                self.shards.append(engine)
+        self.storage = storage.ShardedStorage(self.shards)
+        return self.storage
+
+    def __exit__(self, *exc_info):
+        self.storage.close()
+        for shard in self.shards:
+            if hasattr(shard, "close"):
+                shard.close()
+        if self.directory is not None:
+            shutil.rmtree(self.directory)
+        if self.client is not None:
+            for number in range(self.count):
+                name = MONGO_COLLECTION % number
+                for suffix in ("", ".meta", ".changes"):
+                    self.client.test_db.drop_collection(name + suffix)
+            self.client.close()
+
+
+def store(engine, ids, rng, count):
+    for _ in range(count):
+        engine.store_many([bird(number) for number in range(BATCH_SIZE)])
+
+def retrieve(engine, ids, rng, count):
+    for _ in range(count):
+        engine.retrieve(rng.choice(ids))
+
+def list_page(engine, ids, rng, count):
+    for _ in range(count):
+        list(engine.list(rng.choice(ids), PAGE_SIZE))
+
+# Workload names, what runs them and the items each operation handles
+WORKLOADS = [("store", store, BATCH_SIZE),
+             ("retrieve", retrieve, 1),
+             ("list", list_page, PAGE_SIZE)]
+
+
+def measure(engine, ids, operation, threads):
+    """Returns items per second handled by `threads' running `operation'."""
+    count = OPERATIONS // threads
+    workers = [threading.Thread(target = operation,
+                                args = (engine, ids, random.Random(seed),
+                                        count))
+               for seed in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return count * threads / (time.perf_counter() - start)
+
+
+parser = argparse.ArgumentParser(prog = "python -m benchmarks.sharding",
+                                 description = __doc__.split("\n")[0])
+parser.add_argument("shards", type = int, nargs = "*", default = SHARDS,
+                    help = "numbers of shards to measure (default: %s)"
+                    % " ".join(map(str, SHARDS)))
+parser.add_argument("--engine", choices = ENGINES, default = "sqlite",
+                    help = "engine of the shards (default: %(default)s)")
+parser.add_argument("--threads", type = int, default = DEFAULT_THREADS,
+                    help = "threads running operations "
+                    "(default: %(default)s)")
+parser.add_argument("--birds", type = int, default = DEFAULT_BIRDS,
+                    help = "birds stored up front (default: %(default)s)")
+
+def main(argv = None):
+    args = parser.parse_args(argv)
+    print("%-8s %7s" % ("engine", "shards") + "".join(
+        "%18s" % name for name, _, _ in WORKLOADS))
+    for count in args.shards:
+        with Shards(args.engine, count) as engine:
+            ids = engine.store_many([bird(number)
+                                     for number in range(args.birds)])
+            results = []
+            for _, operation, items in WORKLOADS:
+                results.append(items * measure(engine, ids, operation,
+                                               args.threads))
+        print("%-8s %7d" % (args.engine, count) + "".join(
+            "%11.0f item/s" % result for result in results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Startup time of memory storage from a snapshot, against snapshot size
+
+Fills memory storage, snapshots it and restores it into a fresh one,
+which is what starting the server with a snapshot costs. Compared with
+warming the storage by storing every bird again, and with decoding all of
+the restored birds, which restoring leaves until they are retrieved."""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from birds import storage
+from benchmarks.load import bird
+
+SIZES = [10000, 100000, 1000000]
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+def main(sizes = SIZES):
+    print("%9s %9s %10s %10s %10s %10s %10s" % (
+        "birds", "size", "snapshot", "warm-up", "restore", "first get",
+        "decode all"))
+    for count in sizes:
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "birds.snapshot")
+        try:
+            items = [bird(number) for number in range(count)]
+            warming, _ = timed(lambda: storage.ShardedMemoryStorage()
+                               .store_many(items))
+            engine = storage.ShardedMemoryStorage()
+            ids = engine.store_many([bird(number)
+                                     for number in range(count)])
+            writing, _ = timed(lambda: engine.snapshot(path))
+            size = os.path.getsize(path)
+
+            restored = storage.ShardedMemoryStorage()
+            restoring, _ = timed(lambda: restored.restore(path))
+            first, _ = timed(lambda: restored.retrieve(ids[0]))
+            decoding, _ = timed(lambda: [restored.retrieve(item_id)
+                                         for item_id in ids])
+        finally:
+            shutil.rmtree(directory)
+        print("%9d %6.1f MB %7.0f ms %7.0f ms %7.0f ms %7.0f us %7.0f ms" % (
+            count, size / 1e6, writing * 1e3, warming * 1e3,
+            restoring * 1e3, first * 1e6, decoding * 1e3))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or SIZES)
@@ -0,0 +1,93 @@
+"""SqliteStorage write, read and list cost
+
+Stores birds one by one, each in its own transaction, and in batches
+sharing one, with and without waiting for the disk. Then reads birds back
+and lists pages of visible ones off the partial index, with most birds
+hidden, from one and from several threads."""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from birds import storage
+
+SIZES = [10000, 100000]
+BATCH_SIZE = 1000
+SINGLE_WRITES = 1000
+RETRIEVALS = 10000
+PAGE_SIZE = 100
+THREADS = 4
+
+
+def bird(number):
+    return {"name" : "Bird %d" % number,
+            "family" : "Birdies",
+            "continents" : ["Europe", "Asia"],
+            "visible" : number % 10 == 0}
+
+def timed(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+def retrieve_all(engine, ids):
+    for item_id in ids:
+        engine.retrieve(item_id)
+
+def list_pages(engine, count):
+    after = None
+    for _ in range(count):
+        page = list(engine.list(after, PAGE_SIZE))
+        if len(page) < PAGE_SIZE:
+            after = None
+        else:
+            after = page[-1]
+
+def threaded(function, total):
+    with ThreadPoolExecutor(THREADS) as pool:
+        for future in [pool.submit(function, total // THREADS)
+                       for _ in range(THREADS)]:
+            future.result()
+
+def main(sizes = SIZES):
+    print("%9s %5s %11s %11s %11s %11s %11s %11s" % (
+        "birds", "sync", "store", "store_many", "retrieve", "threaded",
+        "list page", "threaded"))
+    for count in sizes:
+        for sync in (False, True):
+            directory = tempfile.mkdtemp()
+            engine = storage.SqliteStorage(
+                os.path.join(directory, "birds.db"), sync = sync)
+            try:
+                single = timed(lambda: [engine.store(bird(i))
+                                        for i in range(SINGLE_WRITES)])
+                batched = timed(lambda: [
+                    engine.store_many([bird(i)
+                                       for i in range(j, j + BATCH_SIZE)])
+                    for j in range(0, count, BATCH_SIZE)])
+                ids = list(engine.list())
+                sample = [random.choice(ids) for _ in range(RETRIEVALS)]
+                reading = timed(lambda: retrieve_all(engine, sample))
+                reading_threads = timed(lambda: threaded(
+                    lambda n: retrieve_all(engine, sample[:n]), RETRIEVALS))
+                pages = RETRIEVALS // 10
+                listing = timed(lambda: list_pages(engine, pages))
+                listing_threads = timed(lambda: threaded(
+                    lambda n: list_pages(engine, n), pages))
+            finally:
+                engine.close()
+                shutil.rmtree(directory)
+            print("%9d %5s %8.0f /s %8.0f /s %8.0f /s %8.0f /s "
+                  "%8.1f us %8.1f us" % (
+                      count, "on" if sync else "off",
+                      SINGLE_WRITES / single, count / batched,
+                      RETRIEVALS / reading, RETRIEVALS / reading_threads,
+                      listing / pages * 1e6, listing_threads / pages * 1e6))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or SIZES)
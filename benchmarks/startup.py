@@ -0,0 +1,146 @@
+"""Cold start time of the application
+
+Runs every step in a fresh interpreter, the way a newly started worker or
+a short-lived job would, several times over, and reports the fastest run:
+how long the step took in the interpreter, how long the whole process
+took, and how many modules ended up loaded. The mongo step connects
+lazily, so it needs no MongoDB and measures what a worker pays before
+its first request.
+
+On Python 3.7 and later, `--importtime' adds the modules that took
+longest to import, as reported by `python -X importtime'.
+
+`--output' saves results as JSON. Given a `--baseline' saved that way, the
+run exits with status 1 if any step got slower by more than the
+tolerance, which makes the totals a regression target."""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Step names and the code they run
+STEPS = [("python", "pass"),
+         ("import birds.app", "import birds.app"),
+         ("setup memory", "from birds import app, storage\n"
+                          "app.setup(birds_storage = "
+                          "storage.ShardedMemoryStorage())"),
+         ("setup mongo, lazy", "from birds import app\n"
+                               "app.setup(lazy_connect = True)")]
+DEFAULT_RUNS = 5
+DEFAULT_TOLERANCE = 0.2
+IMPORTTIME_TOP = 15
+
+# Times the step from within the interpreter
+SCRIPT = """
+import time
+start = time.perf_counter()
+exec(compile(%r, "<step>", "exec"))
+elapsed = time.perf_counter() - start
+import json, sys
+print(json.dumps({"seconds" : elapsed, "modules" : len(sys.modules)}))
+"""
+
+TOP_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_step(code):
+    """Returns step time, process time, both in milliseconds, and the
+    number of modules loaded by a single run of `code'."""
+    start = time.perf_counter()
+    output = subprocess.check_output([sys.executable, "-c", SCRIPT % code],
+                                     cwd = TOP_DIRECTORY)
+    process = time.perf_counter() - start
+    result = json.loads(output.decode("utf-8").splitlines()[-1])
+    return result["seconds"] * 1e3, process * 1e3, result["modules"]
+
+def measure(code, runs):
+    """Returns the fastest of `runs' runs of the step."""
+    timings = [run_step(code) for _ in range(runs)]
+    return {"step" : min(step for step, _, _ in timings),
+            "process" : min(process for _, process, _ in timings),
+            "modules" : timings[0][2]}
+
+def importtime(code):
+    """Returns (cumulative microseconds, module) pairs reported by
+    `-X importtime' for `code', slowest first."""
+    finished = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                              cwd = TOP_DIRECTORY, stdout = subprocess.PIPE,
+                              stderr = subprocess.PIPE, check = True)
+    imports = []
+    for line in finished.stderr.decode("utf-8").splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        imports.append((int(fields[1]), fields[2].rstrip()))
+    return sorted(imports, reverse = True)
+
+
+def regressions(results, baseline, tolerance):
+    """Generates descriptions of what got slower than in `baseline'."""
+    for name, _ in STEPS:
+        result = results["steps"].get(name)
+        before = baseline["steps"].get(name)
+        if result is None or before is None:
+            continue
+        for key in ("step", "process"):
+            if result[key] > before[key] * (1 + tolerance):
+                yield "%s %s: %.1f ms, was %.1f ms" % (
+                    name, key, result[key], before[key])
+
+def report(results):
+    print("%-20s %10s %12s %8s" % ("step", "step ms", "process ms",
+                                   "modules"))
+    for name, _ in STEPS:
+        result = results["steps"][name]
+        print("%-20s %10.1f %12.1f %8d" % (
+            name, result["step"], result["process"], result["modules"]))
+
+
+parser = argparse.ArgumentParser(prog = "python -m benchmarks.startup",
+                                 description = __doc__.split("\n")[0])
+parser.add_argument("--runs", type = int, default = DEFAULT_RUNS,
+                    help = "runs of every step (default: %(default)s)")
+parser.add_argument("--importtime", action = "store_true",
+                    help = "list the slowest imports of the application, "
+                    "needs Python 3.7 or later")
+parser.add_argument("--output", help = "file to save results to, as JSON")
+parser.add_argument("--baseline", help = "results to compare against")
+parser.add_argument("--tolerance", type = float, default = DEFAULT_TOLERANCE,
+                    help = "allowed share of slowdown before calling it "
+                    "a regression (default: %(default)s)")
+
+def main(argv = None):
+    args = parser.parse_args(argv)
+    if args.importtime and sys.version_info < (3, 7):
+        parser.error("-X importtime needs Python 3.7 or later")
+    results = {"runs" : args.runs,
+               "steps" : {name : measure(code, args.runs)
+                          for name, code in STEPS}}
+    report(results)
+    if args.importtime:
+        print("\n%12s  %s" % ("cumulative", "imported by birds.app"))
+        for microseconds, module in importtime("import birds.app")[
+                :IMPORTTIME_TOP]:
+            print("%9.1f ms  %s" % (microseconds / 1e3, module))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent = 2, sort_keys = True)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        found = list(regressions(results, baseline, args.tolerance))
+        if found:
+            print("\nRegressions against %s:" % args.baseline)
+            for regression in found:
+                print("  " + regression)
+            return 1
+        print("\nNo regressions against %s" % args.baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
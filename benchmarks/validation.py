@@ -0,0 +1,39 @@
+"""POST /birds validation cost: jsonschema.validate vs. cached vs. compiled"""
+
+import jsonschema
+import timeit
+
+from birds import bird_schemas
+from birds import validation
+
+BIRD = {
+    "name" : "A Fancy Bird",
+    "family" : "Birdies",
+    "continents" : ["Europe", "Asia"],
+    "visible" : True
+}
+NUMBER = 20000
+
+
+def per_call(statement):
+    return min(timeit.repeat(statement, number = NUMBER, repeat = 3)) / NUMBER
+
+def main():
+    schema = bird_schemas.bird_input_schema
+    cached = jsonschema.Draft4Validator(schema)
+    compiled = validation.bird_input
+
+    results = [
+        ("jsonschema.validate", per_call(
+            lambda: jsonschema.validate(BIRD, schema))),
+        ("cached Draft4Validator", per_call(lambda: cached.is_valid(BIRD))),
+        ("compiled", per_call(lambda: compiled.is_valid(BIRD))),
+    ]
+    baseline = results[0][1]
+    for name, seconds in results:
+        print("%-24s %8.2f us/call %8.1fx" % (
+            name, seconds * 1e6, baseline / seconds))
+
+
+if __name__ == "__main__":
+    main()
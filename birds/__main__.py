@@ -1,5 +1,131 @@
-from wsgiref import simple_server
+import argparse
+import logging
+import os
+
 from . import app
+from . import compression
+from . import jsoncodec
+from . import server
+from . import snapshot
+from . import storage
+
+SQLITE_FILE_NAME = "birds.db"
+
+parser = argparse.ArgumentParser(prog = "python -m birds",
+                                 description = "Serves the bird API.")
+parser.add_argument("--host", default = server.DEFAULT_HOST,
+                    help = "address to bind (default: %(default)s)")
+parser.add_argument("--port", type = int, default = server.DEFAULT_PORT,
+                    help = "port to bind (default: %(default)s)")
+parser.add_argument("--workers", type = int, default = server.DEFAULT_WORKERS,
+                    help = "worker processes (default: %(default)s)")
+parser.add_argument("--threads", type = int, default = server.DEFAULT_THREADS,
+                    help = "request threads per worker (default: %(default)s)")
+parser.add_argument("--backlog", type = int, default = server.DEFAULT_BACKLOG,
+                    help = "listen queue length (default: %(default)s)")
+parser.add_argument("--keepalive-timeout", type = float,
+                    default = server.DEFAULT_KEEPALIVE_TIMEOUT,
+                    help = "seconds to keep idle connections open "
+                    "(default: %(default)s)")
+parser.add_argument("--storage",
+                    choices = ["mongo", "memory", "log", "sqlite"],
+                    default = "mongo",
+                    help = "where birds live; memory storage is separate "
+                    "for every worker, log and sqlite storage need "
+                    "--data-dir, log storage a single worker too "
+                    "(default: %(default)s)")
+parser.add_argument("--lazy-connect", action = "store_true",
+                    help = "connect to MongoDB on the first request instead "
+                    "of when a worker starts")
+parser.add_argument("--data-dir",
+                    help = "directory of the log or sqlite storage")
+parser.add_argument("--sync", action = "store_true",
+                    help = "make log or sqlite storage writes wait for "
+                    "the disk")
+parser.add_argument("--snapshot",
+                    help = "file to keep a snapshot of memory storage in, "
+                    "and to start from if it is there; needs a single worker")
+parser.add_argument("--snapshot-interval", type = float,
+                    default = snapshot.DEFAULT_SNAPSHOT_INTERVAL,
+                    help = "seconds between snapshots (default: %(default)s)")
+parser.add_argument("--coalesce-window", type = float,
+                    help = "milliseconds concurrent writes wait for each "
+                    "other to be stored together (default: every write "
+                    "on its own)")
+parser.add_argument("--coalesce-batch", type = int,
+                    default = storage.DEFAULT_COALESCE_BATCH_SIZE,
+                    help = "most writes stored together "
+                    "(default: %(default)s)")
+parser.add_argument("--storage-timeout", type = float,
+                    help = "seconds a storage call may take before the "
+                    "request fails, 0 for no limit (default: %s with "
+                    "MongoDB, no limit otherwise)"
+                    % storage.DEFAULT_OPERATION_TIMEOUT)
+parser.add_argument("--breaker-threshold", type = int,
+                    default = storage.DEFAULT_FAILURE_THRESHOLD,
+                    help = "storage failures in a row before failing "
+                    "requests right away (default: %(default)s)")
+parser.add_argument("--breaker-reset", type = float,
+                    default = storage.DEFAULT_RESET_TIMEOUT,
+                    help = "seconds to fail requests right away before "
+                    "trying storage again (default: %(default)s)")
+parser.add_argument("--no-compression", action = "store_true",
+                    help = "never compress response bodies")
+parser.add_argument("--compress-min-size", type = int,
+                    default = compression.DEFAULT_MIN_SIZE,
+                    help = "bytes of the smallest response body to compress "
+                    "(default: %(default)s)")
+parser.add_argument("--json", choices = jsoncodec.BACKENDS,
+                    help = "JSON library to use (default: %s, the first "
+                    "one installed)" % ", ".join(jsoncodec.BACKENDS))
+args = parser.parse_args()
+if args.json is not None:
+    try:
+        jsoncodec.use(args.json)
+    except ImportError:
+        parser.error("%s is not installed" % args.json)
+if args.storage in ("log", "sqlite") and args.data_dir is None:
+    parser.error("%s storage needs --data-dir" % args.storage)
+if args.storage == "log":
+    if args.workers != 1:
+        parser.error("log storage can only be used by a single worker")
+if args.snapshot is not None:
+    if args.storage != "memory":
+        parser.error("only memory storage can be snapshotted")
+    if args.workers != 1:
+        parser.error("a snapshot can only be used by a single worker")
+
+
+def make_app():
+    options = {"with_compression" : not args.no_compression,
+               "compress_min_size" : args.compress_min_size}
+    if args.coalesce_window is not None:
+        options["coalesce_window"] = args.coalesce_window / 1000.0
+        options["coalesce_batch_size"] = args.coalesce_batch
+    timeout = args.storage_timeout
+    if timeout is None and args.storage == "mongo":
+        timeout = storage.DEFAULT_OPERATION_TIMEOUT
+    if timeout:
+        options["operation_timeout"] = timeout
+        options["failure_threshold"] = args.breaker_threshold
+        options["reset_timeout"] = args.breaker_reset
+    if args.snapshot is not None:
+        options["snapshot_path"] = args.snapshot
+        options["snapshot_interval"] = args.snapshot_interval
+    if args.storage == "memory":
+        return app.setup(birds_storage = storage.ShardedMemoryStorage(),
+                         **options)
+    elif args.storage == "log":
+        from . import logstorage
+        return app.setup(birds_storage = logstorage.LogStorage(
+            args.data_dir, sync = args.sync), **options)
+    elif args.storage == "sqlite":
+        os.makedirs(args.data_dir, exist_ok = True)
+        return app.setup(birds_storage = storage.SqliteStorage(
+            os.path.join(args.data_dir, SQLITE_FILE_NAME), sync = args.sync),
+                         **options)
+    return app.setup(lazy_connect = args.lazy_connect, **options)
 
-httpd = simple_server.make_server('127.0.0.1', 8000, app.setup())
-httpd.serve_forever()
\ No newline at end of file
+logging.basicConfig(level = logging.INFO)
+server.serve(make_app, args.host, args.port, args.workers, args.threads,
+             args.backlog, args.keepalive_timeout)
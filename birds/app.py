@@ -1,25 +1,146 @@
 import falcon
-from pymongo import MongoClient
+import os
 
+from . import compression
+from . import metrics
 from . import resources
+from . import snapshot
 from . import storage
 
 
-def setup_routes(the_app, collection, resource):
+class BirdAPI(falcon.API):
+    """The application, with whatever needs closing when it is done."""
+
+    def __init__(self, middleware = None, closing = ()):
+        super(BirdAPI, self).__init__(middleware = middleware)
+        self.closing = list(closing)
+
+    def close(self):
+        """Closes what the application opened, in reverse order."""
+        while self.closing:
+            self.closing.pop().close()
+
+
+def setup_routes(the_app, collection, resource, bulk = None,
+                 metrics_resource = None, multi_get = None, changes = None):
     the_app.add_route("/birds", collection)
     the_app.add_route("/birds/{bird_id}", resource)
+    if bulk is not None:
+        the_app.add_route("/birds/_bulk", bulk)
+    if multi_get is not None:
+        the_app.add_route("/birds/_mget", multi_get)
+    if changes is not None:
+        the_app.add_route("/birds/changes", changes)
+    if metrics_resource is not None:
+        the_app.add_route("/metrics", metrics_resource)
+
+
+def setup(mongo_collection = None,
+          bulk_batch_size = resources.DEFAULT_BULK_BATCH_SIZE,
+          plan_check = None,
+          cache_size = 0,
+          cache_ttl = storage.DEFAULT_CACHE_TTL,
+          birds_storage = None,
+          with_metrics = True,
+          coalesce_window = None,
+          coalesce_batch_size = storage.DEFAULT_COALESCE_BATCH_SIZE,
+          snapshot_path = None,
+          snapshot_interval = snapshot.DEFAULT_SNAPSHOT_INTERVAL,
+          lazy_connect = False,
+          with_compression = True,
+          compress_min_size = compression.DEFAULT_MIN_SIZE,
+          operation_timeout = None,
+          failure_threshold = storage.DEFAULT_FAILURE_THRESHOLD,
+          reset_timeout = storage.DEFAULT_RESET_TIMEOUT):
+    """Creates the application.
+
+    `plan_check' is None, or one of storage.PLAN_CHECK_WARN and
+    storage.PLAN_CHECK_FAIL to verify query plans at startup and before
+    every query. A positive `cache_size' puts a storage.CachingStorage of
+    that many items, kept for `cache_ttl' seconds, in front of the
+    database. Passing `birds_storage' uses that StorageEngine instead of
+    MongoDB altogether. `with_metrics' times requests and storage calls,
+    exposing the numbers on /metrics. Given a `coalesce_window' in
+    seconds, concurrent writes are stored together by a
+    storage.CoalescingStorage, up to `coalesce_batch_size' at a time.
+
+    `snapshot_path' makes an in-memory `birds_storage' start from the
+    snapshot at that path, if there is one, and keep it up to date every
+    `snapshot_interval' seconds and when the application is closed.
+
+    `lazy_connect' leaves connecting to MongoDB, creating indexes and
+    checking query plans to the first request, instead of doing it all
+    before the application is returned.
+
+    `with_compression' compresses response bodies of at least
+    `compress_min_size' bytes when the client accepts it.
 
+    Given an `operation_timeout' in seconds, a storage.GuardedStorage
+    gives up on storage calls taking longer than that, and fails them
+    right away for `reset_timeout' seconds after `failure_threshold'
+    failures in a row, so an unreachable database costs requests no more
+    than the timeout. MongoDB is told to give up selecting a server after
+    as long."""
+    if birds_storage is None:
+        def open_mongo():
+            collection = mongo_collection
+            if collection is None:
+                from pymongo import MongoClient
+                options = {}
+                if operation_timeout is not None:
+                    options["serverSelectionTimeoutMS"] = int(
+                        operation_timeout * 1000)
+                # Evil database not ready for production
+                client = MongoClient(**options)
+                db = client.birds
+                collection = db.birds
+            engine = storage.MongoStorage(collection, plan_check = plan_check)
+            engine.ensure_indexes()
+            engine.ensure_change_log()
+            if plan_check is not None:
+                engine.verify_query_plans(plan_check)
+            return engine
 
-def setup(mongo_collection = None):
-    if mongo_collection is None:
-        # Evil database not ready for production
-        client = MongoClient()
-        db = client.birds
-        mongo_collection = db.birds
-    birds_storage = storage.MongoStorage(mongo_collection)
+        if lazy_connect:
+            birds_storage = storage.DeferredStorage(open_mongo)
+        else:
+            birds_storage = open_mongo()
+    closing = []
+    if snapshot_path is not None:
+        if not hasattr(birds_storage, "restore"):
+            raise ValueError("Only in-memory storage can be snapshotted")
+        if os.path.exists(snapshot_path):
+            birds_storage.restore(snapshot_path)
+        closing.append(snapshot.Snapshotter(birds_storage, snapshot_path,
+                                            snapshot_interval).start())
+    if operation_timeout is not None:
+        birds_storage = storage.GuardedStorage(
+            birds_storage, operation_timeout,
+            failure_threshold = failure_threshold,
+            reset_timeout = reset_timeout)
+        closing.append(birds_storage)
+    if cache_size > 0:
+        birds_storage = storage.CachingStorage(birds_storage, cache_size,
+                                               cache_ttl)
+    if coalesce_window is not None:
+        birds_storage = storage.CoalescingStorage(
+            birds_storage, coalesce_batch_size, coalesce_window)
+    middleware = []
+    metrics_resource = None
+    if with_metrics:
+        bird_metrics = metrics.BirdMetrics()
+        birds_storage = storage.TimedStorage(birds_storage, bird_metrics)
+        middleware.append(metrics.RequestTimer(bird_metrics))
+        metrics_resource = metrics.MetricsResource(bird_metrics)
+    if with_compression:
+        middleware.append(compression.CompressionMiddleware(compress_min_size))
     bird_collection = resources.BirdCollection(birds_storage)
     bird_resource = resources.BirdResource(birds_storage)
-    bird_app = falcon.API()
+    bird_bulk = resources.BirdBulk(birds_storage, bulk_batch_size)
+    bird_multi_get = resources.BirdMultiGet(birds_storage)
+    bird_changes = resources.BirdChanges(birds_storage)
+    bird_app = BirdAPI(middleware = middleware, closing = closing)
 
-    setup_routes(bird_app, bird_collection, bird_resource)
+    setup_routes(bird_app, bird_collection, bird_resource, bird_bulk,
+                 metrics_resource, bird_multi_get, bird_changes)
     return bird_app
@@ -137,4 +137,97 @@ bird_added_schema = {
             "description": "Determines if the bird should be visible in lists"
         }
     }
-}
\ No newline at end of file
+}
+
+bird_bulk_response_schema = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "title": "POST /birds/_bulk [response]",
+    "description": "Outcome of adding many birds at once",
+    "type": "object",
+    "required": [
+        "stored",
+        "rejected",
+        "items"
+    ],
+    "additionalProperties": False,
+    "properties": {
+        "stored": {
+            "type": "integer",
+            "description": "Number of birds added"
+        },
+        "rejected": {
+            "type": "integer",
+            "description": "Number of birds that were not added"
+        },
+        "items": {
+            "type": "array",
+            "description": "Outcome for each bird, in request order",
+            "items": {
+                "type": "object",
+                "additionalProperties": False,
+                "properties": {
+                    "id": {
+                        "type": "string",
+                        "description": "Object id of the added bird"
+                    },
+                    "error": {
+                        "type": "string",
+                        "description": "Why the bird was not added"
+                    }
+                }
+            }
+        }
+    }
+}
+
+bird_mget_response_schema = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "title": "POST /birds/_mget [response]",
+    "description": "Birds with the requested ids, in request order",
+    "type": "array",
+    "items": {
+        "description": "The bird, or null if there is none with the id",
+        "anyOf": [
+            bird_output_schema,
+            { "type": "null" }
+        ]
+    }
+}
+
+bird_changes_response_schema = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "title": "GET /birds/changes [response]",
+    "description": "Changes to birds after a token, in order",
+    "type": "object",
+    "required": ["changes", "next"],
+    "additionalProperties": False,
+    "properties": {
+        "changes": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "required": ["id", "change", "visible"],
+                "additionalProperties": False,
+                "properties": {
+                    "id": {
+                        "type": "string",
+                        "description": "Object id of the bird"
+                    },
+                    "change": {
+                        "enum": ["insert", "delete"],
+                        "description": "Whether the bird was added or "
+                                       "deleted"
+                    },
+                    "visible": {
+                        "type": "boolean",
+                        "description": "Whether the bird is, or was, listed"
+                    }
+                }
+            }
+        },
+        "next": {
+            "type": "string",
+            "description": "Token to ask for the changes after these with"
+        }
+    }
+}
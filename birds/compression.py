@@ -0,0 +1,148 @@
+"""Compression of response bodies
+
+Content codings are negotiated from the Accept-Encoding request header,
+preferring gzip to deflate when both are as welcome. Bodies smaller than
+a threshold are sent as they are, since compressing them costs more time
+than it saves bytes. Streamed bodies have no known size and are always
+compressed, a chunk at a time.
+
+Resources may compress bodies themselves, typically to compress them
+once and keep them, with the Compressor the middleware leaves in the
+request context under "compressor" once a coding was negotiated."""
+
+import zlib
+
+GZIP = "gzip"
+DEFLATE = "deflate"
+# Codings in order of preference
+CODINGS = [GZIP, DEFLATE]
+# Window bits of the zlib formats of the codings, gzip adds 16 for its
+# header and trailer
+WINDOW_BITS = {GZIP : 16 + zlib.MAX_WBITS, DEFLATE : zlib.MAX_WBITS}
+
+DEFAULT_MIN_SIZE = 1024
+DEFAULT_LEVEL = 6
+
+
+def parse_accept_encoding(header):
+    """Returns dictionary of codings in an Accept-Encoding header to their
+    quality values."""
+    accepted = {}
+    for element in header.split(","):
+        coding, _, params = element.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding] = quality
+    return accepted
+
+def negotiate(header, codings = CODINGS):
+    """Returns the most welcome of `codings' according to an
+    Accept-Encoding header, None if none of them is, or there is no
+    header."""
+    if not header:
+        return None
+    accepted = parse_accept_encoding(header)
+    anything = accepted.get("*", 0.0)
+    best, best_quality = None, 0.0
+    for coding in codings:
+        quality = accepted.get(coding, anything)
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+class Compressor(object):
+    """Compresses bodies with one content coding."""
+
+    def __init__(self, coding, min_size = DEFAULT_MIN_SIZE,
+                 level = DEFAULT_LEVEL):
+        self.coding = coding
+        self.min_size = min_size
+        self.level = level
+
+    def compressobj(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED,
+                                WINDOW_BITS[self.coding])
+
+    def compress(self, data):
+        """Returns compressed `data', or None if it's too small to bother."""
+        if len(data) < self.min_size:
+            return None
+        compressor = self.compressobj()
+        return compressor.compress(data) + compressor.flush()
+
+    def compress_chunks(self, chunks):
+        """Generates compressed stream of `chunks'."""
+        compressor = self.compressobj()
+        for chunk in chunks:
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+
+def weak_etag(etag):
+    """Returns weak version of an entity tag. A compressed body is not the
+    same bytes as the one the tag was made for, but means the same."""
+    if etag.startswith("W/"):
+        return etag
+    return "W/" + etag
+
+
+class CompressionMiddleware(object):
+    """Middleware compressing response bodies of at least `min_size' bytes
+    with the negotiated coding.
+
+    Responses a resource compressed itself, telling so with their
+    Content-Encoding header, are left alone."""
+
+    def __init__(self, min_size = DEFAULT_MIN_SIZE, level = DEFAULT_LEVEL):
+        self.compressors = {coding : Compressor(coding, min_size, level)
+                            for coding in CODINGS}
+
+    def process_request(self, req, resp):
+        coding = negotiate(req.get_header("Accept-Encoding"))
+        req.context["compressor"] = self.compressors.get(coding)
+
+    def process_response(self, req, resp, resource):
+        if "compressor" not in req.context:
+            # Already done, if falcon calls this again for an error
+            return
+        compressor = req.context.pop("compressor")
+        # Any response could have been compressed for another client
+        resp.append_header("Vary", "Accept-Encoding")
+        if compressor is None:
+            return
+        if resp.get_header("Content-Encoding") is None:
+            self.compress(compressor, resp)
+        # Weak whether or not this body was compressed, so that a 304,
+        # which has none, carries the same tag as the 200 it stands for
+        etag = resp.get_header("ETag")
+        if etag is not None:
+            resp.etag = weak_etag(etag)
+
+    def compress(self, compressor, resp):
+        if resp.body is not None or resp.data is not None:
+            data = resp.body if resp.body is not None else resp.data
+            if isinstance(data, str):
+                data = data.encode("utf-8")
+            compressed = compressor.compress(data)
+            if compressed is None:
+                return
+            resp.body = None
+            resp.data = compressed
+        elif resp.stream is not None and not hasattr(resp.stream, "read"):
+            resp.stream = compressor.compress_chunks(resp.stream)
+            resp.stream_len = None
+        else:
+            return
+        resp.set_header("Content-Encoding", compressor.coding)
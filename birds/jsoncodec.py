@@ -0,0 +1,71 @@
+"""JSON encoding and decoding with a pluggable backend
+
+Resources encode and decode JSON through `encode' and `decode' here, which
+use orjson or ujson when either is installed, and the json module from the
+standard library otherwise. use() picks another backend. They all encode
+to UTF-8 bytes and decode from them, raising ValueError for anything that
+is not a valid UTF-8 encoded JSON document."""
+
+import json
+
+# In order of preference
+BACKENDS = ("orjson", "ujson", "json")
+
+
+def stdlib_backend():
+    def encode(document):
+        return json.dumps(document).encode("utf-8")
+
+    def decode(data):
+        return json.loads(data.decode("utf-8"))
+    return encode, decode
+
+def orjson_backend():
+    import orjson
+    return orjson.dumps, orjson.loads
+
+def ujson_backend():
+    import ujson
+
+    def encode(document):
+        return ujson.dumps(document, escape_forward_slashes = False).encode(
+            "utf-8")
+
+    def decode(data):
+        return ujson.loads(data.decode("utf-8"))
+    return encode, decode
+
+LOADERS = {"json" : stdlib_backend,
+           "orjson" : orjson_backend,
+           "ujson" : ujson_backend}
+
+
+def load(name):
+    """Returns (encode, decode) functions of the backend, raising
+    ImportError if it is not installed."""
+    return LOADERS[name]()
+
+def available():
+    """Returns names of the installed backends, in order of preference."""
+    names = []
+    for name in BACKENDS:
+        try:
+            load(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+def use(name = None):
+    """Switches to the named backend, or the preferred installed one."""
+    global backend, encode, decode
+    if name is None:
+        name = available()[0]
+    encode, decode = load(name)
+    backend = name
+
+
+backend = None
+encode = None
+decode = None
+use()
@@ -0,0 +1,458 @@
+"""Append-only log storage engine
+
+Persists items to segment files in a local directory, without any database
+server. Every change is an entry appended to the active segment: stored
+items as BSON documents, removals as tombstones. An in-memory index maps
+item ids to where their entry is, and items are read back through memory
+maps of the segments.
+
+Removed items leave garbage behind. Once garbage makes up more than a given
+share of the log, a background thread seals the active segment and
+rewrites the live entries of all sealed segments into a single new one.
+Writes go on meanwhile, to the new active segment.
+
+Opening the storage replays the segments to rebuild the index. A torn
+entry at the end of the newest segment, left by a crash in the middle of
+a write, is cut off; damage anywhere else raises CorruptLogError."""
+
+from bson import BSON
+from bson.objectid import ObjectId
+import collections
+import fcntl
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+
+from .storage import (StorageEngine, VisibleIndex, ID_KEY, add_default_fields,
+                      add_etag, assigned_id, filter_values, is_visible)
+
+# Kinds of entries. Visibility is in the kind, so that replaying the log
+# does not have to decode items.
+PUT = 1
+TOMBSTONE = 2
+PUT_VISIBLE = 3
+PUTS = (PUT, PUT_VISIBLE)
+# crc32 of the rest, entry kind, payload length, item id
+HEADER = struct.Struct("<IBI12s")
+
+SEGMENT_NAME = re.compile(r"^segment-(\d{8})\.log$")
+# Output of a compaction while it's written, and once it's complete
+COMPACTING_SUFFIX = ".compacting"
+COMPACTED_SUFFIX = ".compacted"
+COMPACTED_NAME = re.compile(r"^segment-(\d{8})\.log\.compacted$")
+LOCK_NAME = "lock"
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+DEFAULT_GARBAGE_RATIO = 0.5
+DEFAULT_COMPACTION_INTERVAL = 1.0
+
+
+class CorruptLogError(Exception):
+    """Log damaged other than by an interrupted write."""
+
+
+def segment_name(number):
+    return "segment-%08d.log" % number
+
+def compacted_numbers(path):
+    """Returns sorted numbers of complete compaction outputs in `path'."""
+    return sorted(int(match.group(1))
+                  for match in map(COMPACTED_NAME.match, os.listdir(path))
+                  if match)
+
+def remove_file(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def encode_entry(kind, item_id, payload = b""):
+    body = HEADER.pack(0, kind, len(payload), item_id.binary)[4:] + payload
+    return struct.pack("<I", zlib.crc32(body)) + body
+
+def iter_entries(data):
+    """Generates (offset, kind, item_id, payload_offset, payload_length)
+    for valid entries in `data', stopping at the first invalid one."""
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        crc, kind, length, raw_id = HEADER.unpack_from(data, offset)
+        end = offset + HEADER.size + length
+        if end > len(data) or kind not in (PUT, TOMBSTONE, PUT_VISIBLE):
+            return
+        if zlib.crc32(data[offset + 4:end]) != crc:
+            return
+        yield offset, kind, ObjectId(raw_id), offset + HEADER.size, length
+        offset = end
+
+
+class Segment(object):
+    """Segment file, appended to through a descriptor, read through a map."""
+
+    def __init__(self, path, number):
+        self.path = path
+        self.number = number
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = os.fstat(self.fd).st_size
+        self.map = None
+        self.garbage = 0
+
+    def append(self, data, sync):
+        offset = self.size
+        os.write(self.fd, data)
+        if sync:
+            os.fsync(self.fd)
+        self.size += len(data)
+        return offset
+
+    def read(self, offset, length):
+        if self.map is None or offset + length > len(self.map):
+            # Active segment grew past what was mapped
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.fd, self.size, access = mmap.ACCESS_READ)
+        return self.map[offset:offset + length]
+
+    def contents(self):
+        """Maps the whole segment, or returns empty bytes if it's empty."""
+        if self.size == 0:
+            return b""
+        return mmap.mmap(self.fd, self.size, access = mmap.ACCESS_READ)
+
+    def truncate(self, size):
+        os.ftruncate(self.fd, size)
+        self.size = size
+        self.map = None
+
+    def sync(self):
+        os.fsync(self.fd)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        os.close(self.fd)
+
+
+class LogStorage(StorageEngine):
+    """Storage engine persisting items to an append-only log in `path'.
+
+    `sync' makes every write wait for the disk, so it survives power loss
+    and not just the process crashing. The active segment is sealed once it
+    grows past `segment_size' bytes, and compaction starts when garbage is
+    more than `garbage_ratio' of the log, checked every
+    `compaction_interval' seconds, or never if that is None.
+
+    Only one LogStorage can have a directory open at a time, so it must not
+    be shared by forked workers."""
+
+    def __init__(self, path, sync = False, segment_size = DEFAULT_SEGMENT_SIZE,
+                 garbage_ratio = DEFAULT_GARBAGE_RATIO,
+                 compaction_interval = DEFAULT_COMPACTION_INTERVAL):
+        self.path = path
+        self.sync = sync
+        self.segment_size = segment_size
+        self.garbage_ratio = garbage_ratio
+        self.logger = logging.getLogger("birds-api")
+        self.lock = threading.RLock()
+        # Serializes compactions, which mostly run without self.lock
+        self.compaction_lock = threading.Lock()
+        # id -> (segment, offset, length, visible)
+        self.index = {}
+        self.visible = VisibleIndex()
+        self.segments = []
+        # Tells list versions apart across restarts
+        self.epoch = str(ObjectId())
+        self.generation = 0
+
+        os.makedirs(path, exist_ok = True)
+        self.lock_file = open(os.path.join(path, LOCK_NAME), "w")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.lock_file.close()
+            raise RuntimeError("Log storage %s is already in use" % path)
+        try:
+            self.recover()
+        except Exception:
+            for segment in self.segments:
+                segment.close()
+            self.lock_file.close()
+            raise
+
+        self.stopping = threading.Event()
+        self.compactor = None
+        if compaction_interval is not None:
+            self.compactor = threading.Thread(
+                target = self.compact_periodically,
+                args = (compaction_interval,), daemon = True)
+            self.compactor.start()
+
+    def finish_compactions(self):
+        """Completes compactions a crash interrupted after their output was
+        complete, and drops the output of those interrupted before."""
+        for name in os.listdir(self.path):
+            if name.endswith(COMPACTING_SUFFIX):
+                os.unlink(os.path.join(self.path, name))
+        for number in compacted_numbers(self.path):
+            for match in map(SEGMENT_NAME.match, os.listdir(self.path)):
+                if match and int(match.group(1)) < number:
+                    os.unlink(os.path.join(self.path, match.group(0)))
+            path = os.path.join(self.path, segment_name(number))
+            os.rename(path + COMPACTED_SUFFIX, path)
+
+    def recover(self):
+        """Rebuilds the index by replaying all segments in order."""
+        self.finish_compactions()
+        numbers = sorted(int(match.group(1))
+                         for match in map(SEGMENT_NAME.match,
+                                          os.listdir(self.path))
+                         if match)
+        # Sorted once at the end, much cheaper than keeping it sorted
+        visible = set()
+        for position, number in enumerate(numbers):
+            segment = Segment(os.path.join(self.path, segment_name(number)),
+                              number)
+            self.segments.append(segment)
+            data = segment.contents()
+            end = 0
+            for offset, kind, item_id, start, length in iter_entries(data):
+                end = start + length
+                if kind in PUTS:
+                    previous = self.index.get(item_id)
+                    if previous is not None:
+                        # Left behind by a crash in the middle of compaction
+                        previous[0].garbage += previous[2]
+                    elif kind == PUT_VISIBLE:
+                        visible.add(item_id)
+                    self.index[item_id] = (segment, offset, end - offset,
+                                           kind == PUT_VISIBLE)
+                else:
+                    segment.garbage += end - offset
+                    previous = self.index.pop(item_id, None)
+                    if previous is not None:
+                        previous[0].garbage += previous[2]
+                        visible.discard(item_id)
+            if end < segment.size:
+                if position != len(numbers) - 1:
+                    raise CorruptLogError(
+                        "Damaged entry at %d in %s" % (end, segment.path))
+                self.logger.warning("Dropping torn entry at %d in %s",
+                                    end, segment.path)
+                segment.truncate(end)
+        self.visible = VisibleIndex.build(
+            (item_id,) + filter_values(self.read_item(item_id))
+            for item_id in visible)
+        if not self.segments:
+            self.roll()
+
+    def roll(self):
+        """Starts a new active segment."""
+        number = self.segments[-1].number + 1 if self.segments else 1
+        self.segments.append(
+            Segment(os.path.join(self.path, segment_name(number)), number))
+
+    @property
+    def active(self):
+        return self.segments[-1]
+
+    def apply_put(self, item_id, item, segment, offset, length, visible):
+        if visible:
+            self.visible.add(item_id, item)
+            self.generation += 1
+        self.index[item_id] = (segment, offset, length, visible)
+
+    def apply_tombstone(self, item_id, segment, length):
+        segment.garbage += length
+        if item_id not in self.index:
+            return
+        entry = self.index[item_id]
+        if entry[3]:
+            self.visible.remove(item_id, self.read_item(item_id))
+            self.generation += 1
+        del self.index[item_id]
+        entry[0].garbage += entry[2]
+
+    def append(self, entries):
+        """Appends encoded entries to the active segment with a single
+        write, returning the segment and offset of the first one. Must be
+        called with the lock held."""
+        if self.active.size >= self.segment_size:
+            self.roll()
+        return self.active, self.active.append(b"".join(entries), self.sync)
+
+    def store(self, item):
+        item_id = self.store_many([item])[0]
+        if item_id is None:
+            raise ValueError("Id %s is already used" % item[ID_KEY])
+        return item_id
+
+    def store_many(self, items):
+        prepared = []
+        for item in items:
+            add_etag(add_default_fields(item))
+            item_id = assigned_id(item)
+            item[ID_KEY] = item_id
+            visible = is_visible(item)
+            prepared.append((item_id, item, visible, encode_entry(
+                PUT_VISIBLE if visible else PUT, item_id, BSON.encode(item))))
+        if not prepared:
+            return []
+        with self.lock:
+            ids = []
+            kept = collections.OrderedDict()
+            for item_id, item, visible, entry in prepared:
+                # Assigned ids may already be used, new ones are unique
+                if item_id in self.index or item_id in kept:
+                    ids.append(None)
+                    continue
+                ids.append(item_id)
+                kept[item_id] = (item, visible, entry)
+            if kept:
+                segment, offset = self.append(
+                    entry for _, _, entry in kept.values())
+            for item_id, (item, visible, entry) in kept.items():
+                self.apply_put(item_id, item, segment, offset, len(entry),
+                               visible)
+                offset += len(entry)
+        return ids
+
+    def read_item(self, item_id):
+        """Decodes the stored item. Must be called with the lock held."""
+        segment, offset, length, _ = self.index[item_id]
+        return BSON(segment.read(offset + HEADER.size,
+                                 length - HEADER.size)).decode()
+
+    def retrieve(self, item_id):
+        item_id = self.parse_oid(item_id)
+        with self.lock:
+            entry = self.index.get(item_id)
+            if entry is None:
+                return None
+            segment, offset, length, _ = entry
+            data = segment.read(offset + HEADER.size, length - HEADER.size)
+        return BSON(data).decode()
+
+    def retrieve_many(self, item_ids):
+        found = []
+        with self.lock:
+            for item_id in item_ids:
+                entry = self.index.get(self.parse_oid(item_id))
+                if entry is None:
+                    found.append(None)
+                    continue
+                segment, offset, length, _ = entry
+                found.append(segment.read(offset + HEADER.size,
+                                          length - HEADER.size))
+        return [None if data is None else BSON(data).decode()
+                for data in found]
+
+    def remove(self, item_id):
+        item_id = self.parse_oid(item_id)
+        with self.lock:
+            if item_id not in self.index:
+                return False
+            entry = encode_entry(TOMBSTONE, item_id)
+            segment, _ = self.append([entry])
+            self.apply_tombstone(item_id, segment, len(entry))
+        return True
+
+    def list(self, after = None, limit = None, family = None,
+             continent = None):
+        if after is not None:
+            after = self.parse_oid(after)
+        with self.lock:
+            return iter(self.visible.list(after, limit, family, continent))
+
+    def list_version(self):
+        return "%s.%d" % (self.epoch, self.generation)
+
+    def all_ids(self):
+        with self.lock:
+            return list(self.index)
+
+    def garbage(self):
+        """Returns share of the log taken by garbage."""
+        with self.lock:
+            size = sum(segment.size for segment in self.segments)
+            garbage = sum(segment.garbage for segment in self.segments)
+        return garbage / size if size else 0.0
+
+    def compact(self):
+        """Rewrites live entries of every segment but the new active one.
+
+        The compacted segment takes the number of the newest segment it
+        replaces. Renaming it to its `.compacted' name once it's complete
+        commits the compaction: from then on, opening the log deletes the
+        segments it replaces instead of replaying them, so a crash at any
+        point leaves a log that replays to the same items."""
+        with self.compaction_lock:
+            with self.lock:
+                self.roll()
+                sealed = self.segments[:-1]
+            target = sealed[-1]
+            temporary = target.path + COMPACTING_SUFFIX
+            if os.path.exists(temporary):
+                os.unlink(temporary)
+            output = Segment(temporary, target.number)
+            moved = []
+            for segment in sealed:
+                data = segment.contents()
+                for offset, kind, item_id, _, length in iter_entries(data):
+                    if kind not in PUTS:
+                        continue
+                    with self.lock:
+                        entry = self.index.get(item_id)
+                    if entry is None or entry[0] is not segment or \
+                       entry[1] != offset:
+                        continue
+                    end = offset + HEADER.size + length
+                    new_offset = output.append(data[offset:end], False)
+                    moved.append((item_id, entry, new_offset))
+            output.sync()
+
+            committed = target.path + COMPACTED_SUFFIX
+            os.rename(temporary, committed)
+            # Left behind by an earlier compaction that failed after its
+            # commit; this one replaces everything they hold
+            for number in compacted_numbers(self.path):
+                if number < target.number:
+                    os.unlink(os.path.join(
+                        self.path, segment_name(number) + COMPACTED_SUFFIX))
+            for segment in sealed:
+                if segment is not target:
+                    # Already gone if an earlier compaction got that far
+                    remove_file(segment.path)
+            with self.lock:
+                os.rename(committed, target.path)
+                output.path = target.path
+                for item_id, entry, new_offset in moved:
+                    # Items removed meanwhile stay removed
+                    if self.index.get(item_id) is entry:
+                        self.index[item_id] = (output, new_offset) + entry[2:]
+                    else:
+                        output.garbage += entry[2]
+                self.segments = [output] + self.segments[len(sealed):]
+            for segment in sealed:
+                segment.close()
+
+    def compact_periodically(self, interval):
+        while not self.stopping.wait(interval):
+            try:
+                if self.garbage() > self.garbage_ratio:
+                    self.compact()
+            except Exception as ex:
+                self.logger.exception(ex)
+
+    def close(self):
+        self.stopping.set()
+        if self.compactor is not None:
+            self.compactor.join()
+        with self.lock:
+            for segment in self.segments:
+                segment.close()
+            self.segments = []
+        self.lock_file.close()
@@ -0,0 +1,256 @@
+"""Request and storage metrics in the Prometheus text format
+
+Counters and histograms are aggregated per thread: every thread updates
+series of its own, without taking any lock, and the series of all threads
+are only added up when exposed. Every worker process has metrics of its
+own, so scraping the server gets those of whichever worker answers."""
+
+import bisect
+import sys
+import threading
+import time
+
+import falcon
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+# Upper bounds of histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def format_labels(labels, extra = ()):
+    pairs = tuple(labels) + tuple(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\")
+                     .replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs) + "}"
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """Named family of series, told apart by their labels."""
+
+    kind = None
+
+    def __init__(self, registry, name, documentation, label_names):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.local = registry.local
+
+    def series(self, label_values):
+        """Returns series of the calling thread for given label values."""
+        try:
+            shard = self.local.shard
+        except AttributeError:
+            shard = self.registry.shard()
+        key = (self, label_values)
+        series = shard.get(key)
+        if series is None:
+            series = shard[key] = self.new_series()
+        return series
+
+    def labels(self, label_values):
+        return zip(self.label_names, label_values)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def new_series(self):
+        return [0]
+
+    def increment(self, *label_values):
+        self.series(label_values)[0] += 1
+
+    def expose(self, totals):
+        for label_values, (count,) in sorted(totals.items()):
+            yield "%s%s %s" % (self.name,
+                               format_labels(self.labels(label_values)),
+                               format_value(count))
+
+    @staticmethod
+    def merge(total, series):
+        total[0] += series[0]
+
+
+class Histogram(Metric):
+    """Distribution of values, counted in cumulative buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, registry, name, documentation, label_names,
+                 buckets = DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(registry, name, documentation,
+                                        label_names)
+        self.buckets = tuple(buckets)
+
+    def new_series(self):
+        # Counts per bucket, then one for the values past all of them,
+        # then the sum
+        return [0] * (len(self.buckets) + 1) + [0.0]
+
+    def observe(self, value, *label_values):
+        series = self.series(label_values)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def expose(self, totals):
+        bounds = self.buckets + (float("inf"),)
+        for label_values, series in sorted(totals.items()):
+            labels = list(self.labels(label_values))
+            cumulative = 0
+            for bound, count in zip(bounds, series):
+                cumulative += count
+                yield "%s_bucket%s %d" % (
+                    self.name, format_labels(labels, [("le",
+                                                       format_value(bound))]),
+                    cumulative)
+            yield "%s_sum%s %s" % (self.name, format_labels(labels),
+                                   format_value(series[-1]))
+            yield "%s_count%s %d" % (self.name, format_labels(labels),
+                                     cumulative)
+
+    @staticmethod
+    def merge(total, series):
+        for index, value in enumerate(series):
+            total[index] += value
+
+
+class Registry(object):
+    """Metrics of a process, with series of every thread."""
+
+    def __init__(self):
+        self.metrics = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []
+
+    def shard(self):
+        """Returns series of the calling thread, keyed by metric and labels."""
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def counter(self, name, documentation, label_names = ()):
+        metric = Counter(self, name, documentation, label_names)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, label_names = (),
+                  buckets = DEFAULT_BUCKETS):
+        metric = Histogram(self, name, documentation, label_names, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def totals(self):
+        """Adds up series of all threads, by metric and label values."""
+        totals = {metric : {} for metric in self.metrics}
+        with self.lock:
+            shards = list(self.shards)
+        for shard in shards:
+            # Copying a dictionary or a list does not let other threads
+            # run, so this sees every series whole
+            for (metric, label_values), series in list(shard.items()):
+                series = list(series)
+                total = totals[metric].get(label_values)
+                if total is None:
+                    totals[metric][label_values] = series
+                else:
+                    metric.merge(total, series)
+        return totals
+
+    def expose(self):
+        """Returns all metrics in the Prometheus text format."""
+        lines = []
+        totals = self.totals()
+        for metric in self.metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.documentation))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            lines.extend(metric.expose(totals[metric]))
+        return "\n".join(lines) + "\n"
+
+
+class BirdMetrics(object):
+    """Metrics the application keeps about itself."""
+
+    def __init__(self, registry = None):
+        self.registry = registry or Registry()
+        self.request_duration = self.registry.histogram(
+            "birds_request_duration_seconds",
+            "Time to handle requests, up to the response body.",
+            ("resource", "method"))
+        self.requests = self.registry.counter(
+            "birds_requests_total", "Requests handled, by response status.",
+            ("resource", "method", "status"))
+        self.storage_duration = self.registry.histogram(
+            "birds_storage_duration_seconds",
+            "Time spent in storage engine operations.", ("operation",))
+        self.storage_errors = self.registry.counter(
+            "birds_storage_errors_total",
+            "Storage engine operations that raised an error.",
+            ("operation",))
+
+
+def response_status(resp):
+    """Returns status code of the response.
+
+    Falcon 1.0 runs response middleware before turning an HTTPError into
+    the response, while the error is being handled, so that's where its
+    status is."""
+    error = sys.exc_info()[1]
+    if error is None:
+        return resp.status[:3]
+    status = getattr(error, "status", None)
+    return status[:3] if isinstance(status, str) else "500"
+
+
+class RequestTimer(object):
+    """Middleware timing requests and counting responses by status.
+
+    Requests are told apart by the class of the resource handling them,
+    so they do not make a series per bird. Streamed response bodies are
+    produced after the response middleware runs, and are not timed."""
+
+    def __init__(self, metrics, clock = time.perf_counter):
+        self.metrics = metrics
+        self.clock = clock
+
+    def process_request(self, req, resp):
+        req.context["started"] = self.clock()
+
+    def process_response(self, req, resp, resource):
+        started = req.context.get("started")
+        if started is None:
+            return
+        # Only count it once, if falcon calls this again for an error
+        del req.context["started"]
+        name = "none" if resource is None else type(resource).__name__
+        self.metrics.request_duration.observe(self.clock() - started,
+                                              name, req.method)
+        self.metrics.requests.increment(name, req.method,
+                                        response_status(resp))
+
+
+class MetricsResource(object):
+    """Exposes the metrics for Prometheus to scrape."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def on_get(self, req, resp):
+        resp.content_type = CONTENT_TYPE
+        resp.body = self.metrics.registry.expose()
+        resp.status = falcon.HTTP_200
@@ -0,0 +1,266 @@
+"""Compact representation of stored birds
+
+A bird held as a plain dictionary costs a hash table, a list of continents
+and a handful of strings apiece. BirdRecord keeps the same information in
+slots instead: family names are interned, continents in the usual order
+become a bit mask, dates become day ordinals and visibility a bit. Anything
+else an item carries is kept in a dictionary of extras, so any item can be
+turned into a record and back.
+
+Records are read-only mappings, so they can be handed out without copying,
+and know how to serialize themselves as JSON."""
+
+from bson.objectid import ObjectId
+from json.encoder import encode_basestring_ascii
+import collections.abc
+import copy
+import datetime
+import sys
+
+ID_FIELD = "id"
+NAME_FIELD = "name"
+FAMILY_FIELD = "family"
+CONTINENTS_FIELD = "continents"
+ADDED_FIELD = "added"
+VISIBLE_FIELD = "visible"
+ETAG_FIELD = "etag"
+
+# Order of bits in continent masks. Lists of these in this order, with no
+# repetition, are stored as masks. Anything else is stored as a tuple.
+CONTINENTS = ("Africa", "Antarctica", "Asia", "Australia", "Europe",
+              "North America", "Oceania", "South America")
+CONTINENT_BITS = {name : bit for bit, name in enumerate(CONTINENTS)}
+CONTINENT_MASKS = [tuple(name for bit, name in enumerate(CONTINENTS)
+                         if mask & (1 << bit))
+                   for mask in range(1 << len(CONTINENTS))]
+
+VISIBLE_SET = 1
+VISIBLE_TRUE = 2
+
+# Values that can be shared between an item and its copies
+_IMMUTABLE_TYPES = frozenset([str, int, float, bool, type(None), bytes,
+                              ObjectId])
+
+def _copy_value(value):
+    if type(value) in _IMMUTABLE_TYPES:
+        return value
+    elif type(value) is list:
+        return [_copy_value(element) for element in value]
+    elif type(value) is dict:
+        return copy_item(value)
+    return copy.deepcopy(value)
+
+def copy_item(item):
+    """Copies item so that the copy shares nothing mutable with it.
+
+    Much cheaper than copy.deepcopy for the strings, lists and ids items
+    are made of, as only the containers get copied."""
+    return {k : v if type(v) in _IMMUTABLE_TYPES else _copy_value(v)
+            for k, v in item.items()}
+
+
+def filter_values(item):
+    """Returns family of the item and set of its continents, leaving out
+    whatever is not a string."""
+    family = item.get(FAMILY_FIELD)
+    if not isinstance(family, str):
+        family = None
+    continents = item.get(CONTINENTS_FIELD)
+    if not isinstance(continents, list):
+        return family, frozenset()
+    return family, frozenset(continent for continent in continents
+                             if isinstance(continent, str))
+
+def encode_continents(continents):
+    """Returns mask or tuple of interned names, or None if not a list of
+    strings."""
+    if type(continents) is not list:
+        return None
+    mask = 0
+    last = -1
+    for name in continents:
+        bit = CONTINENT_BITS.get(name) if type(name) is str else None
+        if bit is None or bit <= last:
+            break
+        mask |= 1 << bit
+        last = bit
+    else:
+        return mask
+    if any(type(name) is not str for name in continents):
+        return None
+    return tuple(sys.intern(name) for name in continents)
+
+def decode_continents(encoded):
+    if type(encoded) is int:
+        return list(CONTINENT_MASKS[encoded])
+    return list(encoded)
+
+def encode_date(value):
+    """Returns day ordinal of a YYYY-MM-DD date, or the string itself."""
+    if len(value) == 10:
+        try:
+            date = datetime.date(int(value[0:4]), int(value[5:7]),
+                                 int(value[8:10]))
+        except ValueError:
+            return value
+        if date.isoformat() == value:
+            return date.toordinal()
+    return value
+
+def decode_date(encoded):
+    if type(encoded) is int:
+        return datetime.date.fromordinal(encoded).isoformat()
+    return encoded
+
+def encode_etag(value):
+    """Returns hexadecimal content hash as bytes, or None if it's not one."""
+    if len(value) == 40:
+        try:
+            return bytes.fromhex(value)
+        except ValueError:
+            pass
+    return None
+
+
+class BirdRecord(collections.abc.Mapping):
+    """Read-only mapping of a stored bird's attributes.
+
+    Slots hold the attributes birds have, when they have the expected type.
+    None in a slot means the attribute is missing, or kept in `extra' with
+    all the attributes that did not fit a slot. `encoded' holds the JSON
+    once it's been serialized."""
+
+    __slots__ = ("id", "name", "family", "continents", "added", "flags",
+                 "digest", "extra", "encoded")
+
+    def __init__(self, item):
+        self.id = None
+        self.name = None
+        self.family = None
+        self.continents = None
+        self.added = None
+        self.flags = 0
+        self.digest = None
+        extra = {}
+        for key, value in item.items():
+            if not self.fill_slot(key, value):
+                extra[key] = _copy_value(value)
+        self.extra = extra or None
+        self.encoded = None
+
+    def fill_slot(self, key, value):
+        """Stores value in the slot for key, if it fits, returning True."""
+        kind = type(value)
+        if key == ID_FIELD and kind is ObjectId:
+            self.id = value
+        elif key == NAME_FIELD and kind is str:
+            self.name = value
+        elif key == FAMILY_FIELD and kind is str:
+            self.family = sys.intern(value)
+        elif key == ADDED_FIELD and kind is str:
+            self.added = encode_date(value)
+        elif key == VISIBLE_FIELD and kind is bool:
+            self.flags = VISIBLE_SET | (VISIBLE_TRUE if value else 0)
+        elif key == CONTINENTS_FIELD:
+            self.continents = encode_continents(value)
+            return self.continents is not None
+        elif key == ETAG_FIELD and kind is str:
+            self.digest = encode_etag(value)
+            return self.digest is not None
+        else:
+            return False
+        return True
+
+    def slot_value(self, key):
+        """Returns decoded value of slot for `key', or None if it's empty."""
+        if key == ID_FIELD:
+            return self.id
+        elif key == NAME_FIELD:
+            return self.name
+        elif key == FAMILY_FIELD:
+            return self.family
+        elif key == CONTINENTS_FIELD:
+            if self.continents is not None:
+                return decode_continents(self.continents)
+        elif key == ADDED_FIELD:
+            if self.added is not None:
+                return decode_date(self.added)
+        elif key == VISIBLE_FIELD:
+            if self.flags & VISIBLE_SET:
+                return bool(self.flags & VISIBLE_TRUE)
+        elif key == ETAG_FIELD:
+            if self.digest is not None:
+                return self.digest.hex()
+        return None
+
+    def is_visible(self):
+        if self.flags & VISIBLE_SET:
+            return bool(self.flags & VISIBLE_TRUE)
+        return bool(self.extra and self.extra.get(VISIBLE_FIELD))
+
+    def __getitem__(self, key):
+        value = self.slot_value(key)
+        if value is not None:
+            return value
+        if self.extra is not None and key in self.extra:
+            return _copy_value(self.extra[key])
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return (self.slot_value(key) is not None or
+                (self.extra is not None and key in self.extra))
+
+    def __iter__(self):
+        for key in (ID_FIELD, NAME_FIELD, FAMILY_FIELD, CONTINENTS_FIELD,
+                    ADDED_FIELD, VISIBLE_FIELD, ETAG_FIELD):
+            if self.slot_value(key) is not None:
+                yield key
+        if self.extra is not None:
+            for key in self.extra:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "BirdRecord(%r)" % dict(self.items())
+
+    def dump_json(self):
+        """Serializes the bird attributes, without the etag and extras.
+
+        Returns None if any of them is kept among the extras, in which case
+        the record has to be serialized the long way, as a dictionary."""
+        if self.extra is not None and any(
+                key in self.extra for key in (ID_FIELD, NAME_FIELD,
+                                              FAMILY_FIELD, CONTINENTS_FIELD,
+                                              ADDED_FIELD, VISIBLE_FIELD)):
+            return None
+        parts = []
+        if self.id is not None:
+            parts.append('"id": "%s"' % self.id)
+        if self.name is not None:
+            parts.append('"name": ' + encode_basestring_ascii(self.name))
+        if self.family is not None:
+            parts.append('"family": ' + encode_basestring_ascii(self.family))
+        if self.continents is not None:
+            parts.append('"continents": [' + ", ".join(
+                encode_basestring_ascii(name)
+                for name in decode_continents(self.continents)) + "]")
+        if self.added is not None:
+            parts.append('"added": ' +
+                         encode_basestring_ascii(decode_date(self.added)))
+        if self.flags & VISIBLE_SET:
+            parts.append('"visible": ' +
+                         ("true" if self.flags & VISIBLE_TRUE else "false"))
+        return "{" + ", ".join(parts) + "}"
+
+    def encoded_json(self):
+        """Returns dump_json() encoded as UTF-8, or None.
+
+        Records never change, so this is only serialized once."""
+        if self.encoded is None:
+            dumped = self.dump_json()
+            if dumped is not None:
+                # Escaped to ASCII
+                self.encoded = dumped.encode("ascii")
+        return self.encoded
@@ -1,17 +1,34 @@
 """API resource classes"""
-import json
-import jsonschema
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+import base64
+import binascii
+import collections
+import itertools
 import logging
+import math
+import threading
+import urllib.parse
 import falcon
 
-from . import bird_schemas
+from . import jsoncodec
+from . import validation
+from .records import BirdRecord
+from .storage import ChangesExpired, CircuitOpen, item_etag
 
 
-def service_outage():
+OUTAGE_RETRY_AFTER = 30
+
+def service_outage(error = None):
+    """Raises 503 for a storage failure. Clients are told to retry once an
+    open storage circuit, if that is what `error' is, will be closing."""
+    retry_after = OUTAGE_RETRY_AFTER
+    if isinstance(error, CircuitOpen):
+        retry_after = max(1, int(math.ceil(error.retry_after)))
     raise falcon.HTTPServiceUnavailable(
         "Service outage",
         "Why is the rum gone? We'll be back as soon as the "
-        "rum arrives.", 30)
+        "rum arrives.", retry_after)
 
 
 EXPOSED_BIRD_ATTRIBUTES = ["id",
@@ -25,50 +42,330 @@ def filter_dictionary(d, allowed_keys):
     return {k : v for k, v in d.items() if k in allowed_keys}
 
 def dump_bird(bird):
+    """Serializes exposed attributes of the bird as UTF-8 encoded JSON.
+
+    Records keep what they serialized to, so it's only done once."""
+    if isinstance(bird, BirdRecord):
+        dumped = bird.encoded_json()
+        if dumped is not None:
+            return dumped
     exposed_bird = filter_dictionary(bird, EXPOSED_BIRD_ATTRIBUTES)
     exposed_bird["id"] = str(exposed_bird["id"])
-    return json.dumps(exposed_bird)
+    return jsoncodec.encode(exposed_bird)
+
+def decode_json(body):
+    """Decodes UTF-8 encoded JSON document, raising ValueError if invalid."""
+    return jsoncodec.decode(body)
+
+def read_request_body(req):
+    body = req.stream.read()
+    if not body:
+        raise falcon.HTTPBadRequest("Empty request body",
+                                    "A valid JSON document is required.")
+    try:
+        document = decode_json(body)
+    except (ValueError, UnicodeDecodeError):
+        raise falcon.HTTPBadRequest(
+            "Malformed JSON",
+            "Could not decode the request body. It was either not "
+            "correctly formatted JSON document, or not encoded as "
+            "UTF-8.")
+    return document
+
+def quote_etag(tag):
+    return '"%s"' % tag
+
+def etag_matches(if_none_match, etag):
+    """Checks If-None-Match header value against quoted `etag'.
+
+    Comparison is weak, as required for If-None-Match."""
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+def not_modified(req, resp, etag):
+    """Sets the ETag, returning True if the response is 304 Not Modified."""
+    resp.etag = etag
+    if req.if_none_match is not None and etag_matches(req.if_none_match,
+                                                      etag):
+        resp.status = falcon.HTTP_304
+        return True
+    return False
+
+def started(iterable):
+    """Starts iterating eagerly, so that errors surface before responding."""
+    iterator = iter(iterable)
+    try:
+        first = next(iterator)
+    except StopIteration:
+        return iter(())
+    return itertools.chain([first], iterator)
+
+
+LIST_CHUNK_SIZE = 1000
+
+def iter_json_array(items, chunk_size = LIST_CHUNK_SIZE):
+    """Generates UTF-8 encoded JSON array of `items', a chunk at a time."""
+    separator = b"["
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield separator + jsoncodec.encode(chunk)[1:-1]
+            separator = b","
+            chunk = []
+    if chunk:
+        yield separator + jsoncodec.encode(chunk)[1:-1]
+        separator = b","
+    yield b"]" if separator == b"," else b"[]"
+
+def iter_chunks(items, chunk_size):
+    """Generates lists of up to `chunk_size' consecutive items."""
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+def iter_encoded_array(documents, chunk_size = LIST_CHUNK_SIZE):
+    """Generates JSON array of already encoded `documents', a chunk of them
+    at a time."""
+    separator = b"["
+    for chunk in iter_chunks(documents, chunk_size):
+        yield separator + b",".join(chunk)
+        separator = b","
+    yield b"]" if separator == b"," else b"[]"
+
+def iter_birds(storage, bird_ids, chunk_size = LIST_CHUNK_SIZE):
+    """Generates serialized birds with given ids, or null for unknown ones,
+    retrieving a chunk of them at a time."""
+    for chunk in iter_chunks(bird_ids, chunk_size):
+        for bird in storage.retrieve_many(chunk):
+            yield b"null" if bird is None else dump_bird(bird)
+
+def cut_short(chunks, logger):
+    """Streams response body chunks, stopping if the storage fails.
+
+    Status has been sent by then, so all that can be done is to log it
+    and leave the client with an unterminated document."""
+    try:
+        for chunk in chunks:
+            yield chunk
+    except Exception as ex:
+        logger.exception(ex)
+
+def stream_birds(storage, bird_ids, logger):
+    """Returns response body streaming JSON array of the birds, retrieving
+    the first chunk of them before responding, so that an outage can
+    still be reported."""
+    birds = None
+    try:
+        birds = started(iter_birds(storage, bird_ids))
+    except Exception as ex:
+        logger.exception(ex)
+        service_outage(ex)
+    return cut_short(iter_encoded_array(birds), logger)
+
+
+def encode_cursor(bird_id):
+    """Turns id of the last bird on a page into an opaque cursor."""
+    raw = base64.urlsafe_b64encode(ObjectId(bird_id).binary)
+    return raw.rstrip(b"=").decode("ascii")
+
+def decode_cursor(cursor):
+    """Recovers bird id from a cursor, raising ValueError if invalid."""
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        return ObjectId(base64.urlsafe_b64decode(cursor + padding))
+    except (binascii.Error, InvalidId, TypeError, UnicodeEncodeError):
+        raise ValueError("Invalid cursor: %r" % cursor)
+
+
+MAX_PAGE_SIZE = 10000
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+DEFAULT_LIST_CACHE_BYTES = 16 * 1024 * 1024
+
+class ListCache(object):
+    """Bodies of list responses, serialized and compressed, for as long as
+    the list version they were made from is current.
+
+    Responses are told apart by a key of whatever they depend on besides
+    the version. All of them are dropped once the version changes, which
+    is only when an item becomes or stops being visible. At most
+    `max_bytes' of bodies are kept, dropping the least recently used
+    first. Safe to share between threads."""
+
+    def __init__(self, max_bytes = DEFAULT_LIST_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.version = None
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, version, key):
+        """Returns the entry for `key' made from list `version', or None."""
+        with self.lock:
+            if version != self.version:
+                return None
+            kept = self.entries.get(key)
+            if kept is None:
+                return None
+            self.entries.move_to_end(key)
+            return kept[0]
+
+    def put(self, version, key, entry, size):
+        """Keeps `entry' of `size' bytes for `key', made from list
+        `version'."""
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.size = 0
+                self.version = version
+            if key in self.entries:
+                return
+            self.entries[key] = (entry, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, dropped) = self.entries.popitem(last = False)
+                self.size -= dropped
 
 
 class BirdCollection(object):
-    def __init__(self, storage):
+    def __init__(self, storage, list_cache_bytes = DEFAULT_LIST_CACHE_BYTES):
         """Initialises collection resource.
 
-        `storage' is the StorageEngine used."""
+        `storage' is the StorageEngine used. Pages of ids are kept
+        serialized, and compressed if the client takes that, in a
+        ListCache of `list_cache_bytes', so asking for the same page again
+        costs neither. Zero keeps none."""
         self.storage = storage
+        self.list_cache = None
+        if list_cache_bytes > 0:
+            self.list_cache = ListCache(list_cache_bytes)
         self.logger = logging.getLogger("birds-api")
 
-    def on_get(self, req, resp):
-        id_list = []
+    def stream_list(self, ids):
+        """Streams the list, cutting it short if the storage fails."""
+        return cut_short(iter_json_array(map(str, ids)), self.logger)
+
+    def read_page_params(self, req):
+        """Returns (after, limit) from the query string, None if missing."""
+        limit = req.get_param_as_int("limit", min = 1, max = MAX_PAGE_SIZE)
+        after = req.get_param("after")
+        if after is not None:
+            try:
+                after = decode_cursor(after)
+            except ValueError:
+                raise falcon.HTTPInvalidParam("Not a valid cursor.", "after")
+        return after, limit
+
+    def read_filter_params(self, req):
+        """Returns (family, continent) from the query string, None if
+        missing."""
+        return req.get_param("family"), req.get_param("continent")
+
+    def list_page(self, after, limit, family, continent):
+        """Returns ids of the page and cursor of the next one, or None.
+
+        Without a `limit', ids are an iterator, started so that errors
+        surface before responding."""
+        ids = None
         try:
-            id_list = list(map(str, self.storage.list()))
+            if limit is None:
+                ids = started(self.storage.list(after, None, family,
+                                                continent))
+            else:
+                # One more than asked tells if there is a next page
+                ids = list(self.storage.list(after, limit + 1, family,
+                                             continent))
         except Exception as ex:
             self.logger.exception(ex)
-            service_outage()
+            service_outage(ex)
+        if limit is not None and len(ids) > limit:
+            ids = ids[:limit]
+            return ids, encode_cursor(ids[-1])
+        return ids, None
 
-        resp.body = json.dumps(id_list)
-        resp.status = falcon.HTTP_200
+    def encoded_page(self, compressor, after, limit, family, continent):
+        """Returns the page of ids as JSON, compressed by `compressor'
+        unless it's None or the page is too small, the coding used and
+        the cursor of the next page."""
+        ids, cursor = self.list_page(after, limit, family, continent)
+        data = b"".join(iter_json_array(map(str, ids)))
+        if compressor is not None:
+            compressed = compressor.compress(data)
+            if compressed is not None:
+                return compressed, compressor.coding, cursor
+        return data, None, cursor
 
-    def read_request_body(self, req):
-        body = req.stream.read()
-        if not body:
-            raise falcon.HTTPBadRequest("Empty request body",
-                                        "A valid JSON document is required.")
+    def cached_page(self, req, version, after, limit, family, continent):
+        """Returns encoded_page, from the ListCache if it has it."""
+        compressor = req.context.get("compressor")
+        if self.list_cache is None:
+            return self.encoded_page(compressor, after, limit, family,
+                                     continent)
+        key = (after, limit, family, continent,
+               None if compressor is None else compressor.coding)
+        cached = self.list_cache.get(version, key)
+        if cached is None:
+            cached = self.encoded_page(compressor, after, limit, family,
+                                       continent)
+            self.list_cache.put(version, key, cached, len(cached[0]))
+        return cached
+
+    def on_get(self, req, resp):
+        after, limit = self.read_page_params(req)
+        family, continent = self.read_filter_params(req)
+        expand = req.get_param_as_bool("expand")
+        version = None
         try:
-            document = json.loads(body.decode("utf-8"))
-        except (ValueError, UnicodeDecodeError):
-            raise falcon.HTTPBadRequest(
-                "Malformed JSON",
-                "Could not decode the request body. It was either not "
-                "correctly formatted JSON document, or not encoded as "
-                "UTF-8.")
-        return document
+            # Read first: if the list changes meanwhile, the tag is stale
+            # and the next conditional request gets a full response.
+            version = self.storage.list_version()
+        except Exception as ex:
+            self.logger.exception(ex)
+            service_outage(ex)
+        if not_modified(req, resp, quote_etag("list-%s" % version)):
+            return
+
+        if expand:
+            ids, cursor = self.list_page(after, limit, family, continent)
+            resp.stream = stream_birds(self.storage, ids, self.logger)
+        elif limit is None:
+            # Streamed, and compressed a chunk at a time, rather than
+            # held in memory whole
+            ids, cursor = self.list_page(after, limit, family, continent)
+            resp.stream = self.stream_list(ids)
+        else:
+            resp.data, coding, cursor = self.cached_page(
+                req, version, after, limit, family, continent)
+            if coding is not None:
+                resp.set_header("Content-Encoding", coding)
+
+        if cursor is not None:
+            resp.set_header(NEXT_CURSOR_HEADER, cursor)
+            params = [("limit", limit), ("after", cursor)]
+            if family is not None:
+                params.append(("family", family))
+            if continent is not None:
+                params.append(("continent", continent))
+            if expand:
+                params.append(("expand", "true"))
+            resp.add_link("/birds?" + urllib.parse.urlencode(params), "next")
+        resp.status = falcon.HTTP_200
 
     def on_post(self, req, resp):
-        bird = self.read_request_body(req)
-        try:
-            jsonschema.validate(bird, bird_schemas.bird_input_schema)
-        except jsonschema.ValidationError:
+        bird = read_request_body(req)
+        if not validation.bird_input.is_valid(bird):
             raise falcon.HTTPBadRequest(
                 "Incorrect bird data",
                 "Supplied bird information does not conform to required "
@@ -78,13 +375,207 @@ class BirdCollection(object):
             bird_id = self.storage.store(bird)
         except Exception as ex:
             self.logger.exception(ex)
-            service_outage()
+            service_outage(ex)
 
-        resp.body = dump_bird(bird)
+        resp.data = dump_bird(bird)
         resp.status = falcon.HTTP_201
         resp.location = "/birds/" + str(bird_id)
 
 
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+DEFAULT_BULK_BATCH_SIZE = 1000
+READ_CHUNK_SIZE = 64 * 1024
+
+def iter_lines(stream, chunk_size = READ_CHUNK_SIZE):
+    """Generates lines of the stream, reading it in chunks.
+
+    Falcon's stream wrapper gets readline wrong, it counts every line as
+    the rest of the body, so lines are split here instead."""
+    pending = b""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+class BirdBulk(object):
+    """Adds many birds in one request.
+
+    Accepts either a JSON array of birds, or newline delimited JSON with one
+    bird per line, which is read as it streams in. Every bird is validated
+    on its own and the response reports the outcome for each of them, in
+    request order. Accepted birds are written in batches."""
+
+    def __init__(self, storage, batch_size = DEFAULT_BULK_BATCH_SIZE):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.logger = logging.getLogger("birds-api")
+
+    def read_ndjson(self, req):
+        """Generates decoded documents, or None for undecodable lines."""
+        for line in iter_lines(req.stream):
+            if not line.strip():
+                continue
+            try:
+                yield decode_json(line)
+            except (ValueError, UnicodeDecodeError):
+                yield None
+
+    def read_documents(self, req):
+        content_type = req.content_type or ""
+        if content_type.startswith(NDJSON_MEDIA_TYPE):
+            return self.read_ndjson(req)
+        documents = read_request_body(req)
+        if not isinstance(documents, list):
+            raise falcon.HTTPBadRequest(
+                "Incorrect bulk data",
+                "Expected a JSON array of birds, or newline delimited "
+                "JSON with " + NDJSON_MEDIA_TYPE + " content type.")
+        return documents
+
+    def flush(self, batch):
+        """Stores batch of (result, bird) pairs, filling in the results.
+
+        Returns the error, leaving the batch as it was, if the storage
+        failed, and None otherwise."""
+        try:
+            ids = self.storage.store_many([bird for _, bird in batch])
+        except Exception as ex:
+            self.logger.exception(ex)
+            return ex
+        for (result, _), bird_id in zip(batch, ids):
+            if bird_id is None:
+                result["error"] = "Could not store bird"
+            else:
+                result["id"] = str(bird_id)
+        del batch[:]
+        return None
+
+    def on_post(self, req, resp):
+        results = []
+        batch = []
+        outage = None
+        for document in self.read_documents(req):
+            result = {}
+            results.append(result)
+            if document is None:
+                result["error"] = "Malformed JSON"
+            elif not validation.bird_input.is_valid(document):
+                result["error"] = "Incorrect bird data"
+            else:
+                batch.append((result, document))
+                if outage is None and len(batch) >= self.batch_size:
+                    outage = self.flush(batch)
+        if batch and outage is None:
+            outage = self.flush(batch)
+        if not results:
+            raise falcon.HTTPBadRequest("Empty request body",
+                                        "At least one bird is required.")
+
+        stored = sum(1 for result in results if "id" in result)
+        if outage is not None and stored == 0:
+            service_outage(outage)
+        # Whatever is left in the batch after an outage was never stored
+        for result, _ in batch:
+            result["error"] = "Service outage"
+        resp.data = jsoncodec.encode({"stored" : stored,
+                                      "rejected" : len(results) - stored,
+                                      "items" : results})
+        resp.status = falcon.HTTP_200
+
+
+class BirdMultiGet(object):
+    """Retrieves many birds in one request.
+
+    Takes a JSON array of bird ids, and answers with an array of the birds,
+    in the same order, with null for every unknown id. Birds are retrieved
+    from the storage a chunk at a time, as the response streams out."""
+
+    def __init__(self, storage, max_size = MAX_PAGE_SIZE):
+        self.storage = storage
+        self.max_size = max_size
+        self.logger = logging.getLogger("birds-api")
+
+    def on_post(self, req, resp):
+        bird_ids = read_request_body(req)
+        if not isinstance(bird_ids, list) or \
+           not all(isinstance(bird_id, str) for bird_id in bird_ids):
+            raise falcon.HTTPBadRequest(
+                "Incorrect bird ids", "Expected a JSON array of bird ids.")
+        if len(bird_ids) > self.max_size:
+            raise falcon.HTTPBadRequest(
+                "Too many bird ids",
+                "At most %d birds can be retrieved at once." % self.max_size)
+        resp.stream = stream_birds(self.storage, bird_ids, self.logger)
+        resp.status = falcon.HTTP_200
+
+
+MAX_CHANGES_WAIT = 30.0
+
+class BirdChanges(object):
+    """Feed of changes to birds, for clients keeping a copy in sync.
+
+    Without `since', answers with no changes and the token of the current
+    position, which is where to follow changes from after listing all the
+    birds. Given a `since' token, answers with up to `limit' changes made
+    after it, in order, and the `next' token to ask for the ones after.
+    Given `wait' seconds, at most `max_wait', the request waits that long
+    for a change if there is none yet. Once the changes after a token are
+    no longer kept the answer is 410 Gone, and the client has to list all
+    the birds again."""
+
+    def __init__(self, storage, max_wait = MAX_CHANGES_WAIT):
+        self.storage = storage
+        self.max_wait = max_wait
+        self.logger = logging.getLogger("birds-api")
+
+    def read_wait_param(self, req):
+        wait = req.get_param("wait")
+        if wait is None:
+            return 0
+        try:
+            wait = float(wait)
+        except ValueError:
+            wait = -1
+        if not 0 <= wait <= self.max_wait:
+            raise falcon.HTTPInvalidParam(
+                "Seconds to wait must be between 0 and %g." % self.max_wait,
+                "wait")
+        return wait
+
+    def on_get(self, req, resp):
+        since = req.get_param("since")
+        limit = req.get_param_as_int("limit", min = 1,
+                                     max = MAX_PAGE_SIZE) or MAX_PAGE_SIZE
+        wait = self.read_wait_param(req)
+        changes, token = None, None
+        try:
+            changes, token = self.storage.changes_since(since, limit, wait)
+        except ChangesExpired:
+            raise falcon.HTTPError(
+                falcon.HTTP_410, "Changes expired",
+                "Changes since then are no longer kept. List all the birds "
+                "again, after asking for a new token.")
+        except ValueError:
+            raise falcon.HTTPInvalidParam("Not a valid token.", "since")
+        except NotImplementedError:
+            raise falcon.HTTPError(
+                falcon.HTTP_501, "No change feed",
+                "This storage does not keep changes.")
+        except Exception as ex:
+            self.logger.exception(ex)
+            service_outage(ex)
+        for change in changes:
+            change["id"] = str(change["id"])
+        resp.data = jsoncodec.encode({"changes" : changes, "next" : token})
+        resp.status = falcon.HTTP_200
+
+
 class BirdResource(object):
     def __init__(self, storage):
         """Initialises bird resource with supplied StorageEngine"""
@@ -92,15 +583,29 @@ class BirdResource(object):
         self.logger = logging.getLogger("birds-api")
 
     def on_get(self, req, resp, bird_id):
+        if req.if_none_match is not None:
+            # Conditional request only needs the tag to answer 304
+            etag = None
+            try:
+                etag = self.storage.etag(bird_id)
+            except Exception as ex:
+                self.logger.exception(ex)
+                service_outage(ex)
+            if etag is None:
+                raise falcon.HTTPNotFound()
+            if not_modified(req, resp, quote_etag(etag)):
+                return
+
         bird = None
         try:
             bird = self.storage.retrieve(bird_id)
         except Exception as ex:
             self.logger.exception(ex)
-            service_outage()
+            service_outage(ex)
         if bird is None:
             raise falcon.HTTPNotFound()
-        resp.body = dump_bird(bird)
+        resp.etag = quote_etag(item_etag(bird))
+        resp.data = dump_bird(bird)
         resp.status = falcon.HTTP_200
 
     def on_delete(self, req, resp, bird_id):
@@ -109,7 +614,7 @@ class BirdResource(object):
             removed = self.storage.remove(bird_id)
         except Exception as ex:
             self.logger.exception(ex)
-            service_outage()
+            service_outage(ex)
         if not removed:
             raise falcon.HTTPNotFound
         resp.status = falcon.HTTP_200
\ No newline at end of file
@@ -0,0 +1,386 @@
+"""Pre-forking, threaded HTTP/1.1 server for the WSGI application
+
+The master process binds the listening socket and forks worker processes,
+each creating its own application, and with it its own storage and
+database connection, only after the fork. Workers serve requests from a
+bounded pool of threads and keep connections alive between requests.
+
+The master restarts workers that die, and on SIGTERM or SIGINT asks all of
+them to finish the requests in progress and exit. Only works where there
+is os.fork, which is to say not on Windows."""
+
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref import simple_server
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8000
+DEFAULT_WORKERS = 1
+DEFAULT_THREADS = 8
+DEFAULT_BACKLOG = 128
+DEFAULT_KEEPALIVE_TIMEOUT = 5.0
+# Largest unread request body drained to keep the connection alive
+MAX_DRAIN = 64 * 1024
+# Longest line of chunked framing, the size and extensions of a chunk
+MAX_CHUNK_LINE = 1024
+READ_CHUNK_SIZE = 16 * 1024
+
+logger = logging.getLogger("birds-api")
+
+
+class RequestBody(object):
+    """Request stream that cannot be read past the request body.
+
+    Keeps track of what is left, so that the rest can be drained before
+    reading the next request from the same connection."""
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def read(self, size = -1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size = -1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        line = self.stream.readline(size)
+        self.remaining -= len(line)
+        return line
+
+    def readlines(self, hint = -1):
+        return list(iter(self.readline, b""))
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+    def drain(self):
+        """Skips unread body, returning False if there is too much left."""
+        if self.remaining > MAX_DRAIN:
+            return False
+        while self.remaining > 0:
+            if not self.read(self.remaining):
+                return False
+        return True
+
+
+class ChunkedRequestBody(RequestBody):
+    """Request stream of a body sent in chunks, with the chunked framing
+    taken off.
+
+    Framing that does not parse ends the body where it went wrong, and
+    `broken' tells so, since the rest of the connection cannot be read
+    as requests any more."""
+
+    def __init__(self, stream):
+        super(ChunkedRequestBody, self).__init__(stream, 0)
+        self.done = False
+        self.broken = False
+
+    def next_chunk(self):
+        """Reads size of the next chunk, and the trailer after the last
+        one. Returns False if there are no more chunks."""
+        if self.done:
+            return False
+        line = self.stream.readline(MAX_CHUNK_LINE)
+        try:
+            size = int(line.split(b";", 1)[0].strip(), 16)
+        except ValueError:
+            size = -1
+        if size < 0 or not line.endswith(b"\n"):
+            self.done = self.broken = True
+            return False
+        if size == 0:
+            self.done = True
+            # Trailer fields, up to the empty line
+            while True:
+                line = self.stream.readline(MAX_CHUNK_LINE)
+                if not line.endswith(b"\n"):
+                    self.broken = True
+                    break
+                if line in (b"\r\n", b"\n"):
+                    break
+            return False
+        self.remaining = size
+        return True
+
+    def end_chunk(self):
+        """Reads the line break after the data of a chunk."""
+        if self.stream.readline(3) not in (b"\r\n", b"\n"):
+            self.done = self.broken = True
+
+    def read(self, size = -1):
+        chunks = []
+        while size is None or size < 0 or size > 0:
+            if self.remaining == 0 and not self.next_chunk():
+                break
+            want = self.remaining
+            if size is not None and 0 <= size < want:
+                want = size
+            data = self.stream.read(want)
+            if not data:
+                self.done = self.broken = True
+                break
+            self.remaining -= len(data)
+            if self.remaining == 0:
+                self.end_chunk()
+            chunks.append(data)
+            if size is not None and size >= 0:
+                size -= len(data)
+        return b"".join(chunks)
+
+    def readline(self, size = -1):
+        parts = []
+        while size is None or size < 0 or size > 0:
+            if self.remaining == 0 and not self.next_chunk():
+                break
+            want = self.remaining
+            if size is not None and 0 <= size < want:
+                want = size
+            part = self.stream.readline(want)
+            if not part:
+                self.done = self.broken = True
+                break
+            self.remaining -= len(part)
+            if self.remaining == 0:
+                self.end_chunk()
+            parts.append(part)
+            if size is not None and size >= 0:
+                size -= len(part)
+            if part.endswith(b"\n"):
+                break
+        return b"".join(parts)
+
+    def drain(self):
+        drained = 0
+        while not self.done and drained <= MAX_DRAIN:
+            drained += len(self.read(READ_CHUNK_SIZE))
+        return self.done and not self.broken
+
+
+class ServerHandler(simple_server.ServerHandler):
+    """Speaks HTTP/1.1, sending bodies of unknown length in chunks."""
+
+    http_version = "1.1"
+    chunked = False
+
+    def cleanup_headers(self):
+        super(ServerHandler, self).cleanup_headers()
+        bodiless = (self.status[:3] in ("204", "304") or
+                    self.environ["REQUEST_METHOD"] == "HEAD")
+        if "Content-Length" not in self.headers and not bodiless:
+            if self.request_handler.request_version == "HTTP/1.1":
+                self.headers["Transfer-Encoding"] = "chunked"
+                self.chunked = True
+            else:
+                # Only closing the connection can end the body
+                self.request_handler.close_connection = True
+        if self.request_handler.close_connection:
+            self.headers["Connection"] = "close"
+
+    def write(self, data):
+        if not self.headers_sent:
+            # Decides whether the body is chunked
+            self.send_headers()
+        if self.chunked:
+            if not data:
+                # Empty chunk would end the body
+                return
+            data = b"%x\r\n%s\r\n" % (len(data), data)
+        super(ServerHandler, self).write(data)
+
+    def finish_content(self):
+        super(ServerHandler, self).finish_content()
+        if self.chunked:
+            self._write(b"0\r\n\r\n")
+            self._flush()
+
+
+class RequestHandler(simple_server.WSGIRequestHandler):
+    """Handles requests of a connection until either side closes it."""
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes, which Nagle's algorithm would
+    # hold back waiting for delayed acknowledgements on kept alive
+    # connections.
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        # Undo the single request override of WSGIRequestHandler
+        simple_server.BaseHTTPRequestHandler.handle(self)
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.timeout:
+            self.close_connection = True
+            return
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ""
+            self.request_version = ""
+            self.command = ""
+            self.send_error(414)
+            return
+        if not self.parse_request():
+            return
+
+        environ = self.get_environ()
+        if "chunked" in environ.get("HTTP_TRANSFER_ENCODING", "").lower():
+            body = ChunkedRequestBody(self.rfile)
+        else:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+            body = RequestBody(self.rfile, length)
+        if self.server.shutting_down:
+            self.close_connection = True
+        handler = ServerHandler(body, self.wfile, self.get_stderr(), environ,
+                                multithread = True, multiprocess = True)
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        if not self.close_connection and not body.drain():
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class WorkerServer(simple_server.WSGIServer):
+    """WSGI server on an inherited socket, with a pool of threads."""
+
+    def __init__(self, listener, app, threads, keepalive_timeout):
+        simple_server.WSGIServer.__init__(
+            self, listener.getsockname()[:2], RequestHandler,
+            bind_and_activate = False)
+        self.socket.close()
+        self.socket = listener
+        self.server_name, self.server_port = listener.getsockname()[:2]
+        self.setup_environ()
+        self.set_app(app)
+        self.pool = ThreadPoolExecutor(max_workers = threads)
+        self.shutting_down = False
+        RequestHandler.timeout = keepalive_timeout
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def handle_error(self, request, client_address):
+        logger.exception("Error handling request from %s", client_address)
+
+    def stop_accepting(self):
+        """Makes serve_forever return, closing idle connections as they
+        come back. Must not be called from the thread running it."""
+        self.shutting_down = True
+        self.shutdown()
+
+
+def bind(host, port, backlog):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(backlog)
+    return listener
+
+
+def run_worker(listener, app_factory, threads, keepalive_timeout):
+    """Serves requests until SIGTERM, in a freshly forked worker."""
+    application = app_factory()
+    server = WorkerServer(listener, application, threads, keepalive_timeout)
+
+    def stop(signum, frame):
+        threading.Thread(target = server.stop_accepting).start()
+    signal.signal(signal.SIGTERM, stop)
+    # The master tells workers when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server.serve_forever()
+    # Let requests in progress finish
+    server.pool.shutdown(wait = True)
+    if hasattr(application, "close"):
+        application.close()
+
+
+class Master(object):
+    """Forks the workers and keeps the right number of them running."""
+
+    def __init__(self, listener, app_factory, workers, threads,
+                 keepalive_timeout):
+        self.listener = listener
+        self.app_factory = app_factory
+        self.workers = workers
+        self.threads = threads
+        self.keepalive_timeout = keepalive_timeout
+        self.children = set()
+        self.stopping = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid != 0:
+            self.children.add(pid)
+            return
+        status = 0
+        try:
+            run_worker(self.listener, self.app_factory, self.threads,
+                       self.keepalive_timeout)
+        except Exception:
+            logger.exception("Worker %d failed", os.getpid())
+            status = 1
+        finally:
+            logging.shutdown()
+            os._exit(status)
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for _ in range(self.workers):
+            self.spawn()
+        while self.children:
+            try:
+                pid, _ = os.wait()
+            except ChildProcessError:
+                break
+            self.children.discard(pid)
+            if not self.stopping:
+                logger.warning("Worker %d died, starting another", pid)
+                # Do not spin if workers die right away
+                time.sleep(0.1)
+                self.spawn()
+        self.listener.close()
+
+
+def serve(app_factory, host = DEFAULT_HOST, port = DEFAULT_PORT,
+          workers = DEFAULT_WORKERS, threads = DEFAULT_THREADS,
+          backlog = DEFAULT_BACKLOG,
+          keepalive_timeout = DEFAULT_KEEPALIVE_TIMEOUT):
+    """Serves application made by `app_factory' until SIGTERM or SIGINT.
+
+    The factory is called once in every worker process."""
+    listener = bind(host, port, backlog)
+    logger.info("Serving on %s:%d with %d workers of %d threads",
+                host, port, workers, threads)
+    Master(listener, app_factory, workers, threads, keepalive_timeout).run()
@@ -0,0 +1,219 @@
+"""Snapshots of in-memory storage
+
+A snapshot is a file of every stored item, written to a temporary file
+and renamed over the previous snapshot once complete, so there always is
+a whole one. Every item is a BSON document, after a header with its id,
+visibility, family and continents.
+
+Restoring a snapshot maps the file and only reads the headers, which is
+all the listing indexes need. Items stay in the file as SnapshotRecords
+until they are retrieved for the first time, and only then get decoded,
+so a restored storage is ready long before all of it has been parsed."""
+
+from bson import BSON
+from bson.objectid import ObjectId
+import contextlib
+import gc
+import logging
+import mmap
+import os
+import struct
+from sys import intern
+import threading
+
+from .records import (BirdRecord, FAMILY_FIELD, CONTINENTS_FIELD,
+                      filter_values)
+
+MAGIC = b"BIRDSNP1"
+# Id, flags, number of continents, length of the filter values and of
+# the BSON document
+HEADER = struct.Struct("<12sBHII")
+STRING_LENGTH = struct.Struct("<H")
+
+VISIBLE = 1
+HAS_FAMILY = 2
+
+DEFAULT_SNAPSHOT_INTERVAL = 60.0
+
+
+class SnapshotError(Exception):
+    """Snapshot file is damaged or not a snapshot at all."""
+
+
+class SnapshotRecord(object):
+    """Item still in the snapshot file, not decoded yet.
+
+    Knows the visibility, family and continents of the item, so it can be
+    indexed and removed without decoding it."""
+
+    __slots__ = ("data", "offset", "length", "visible", "family",
+                 "continents")
+
+    def __init__(self, data, offset, length, visible, family, continents):
+        self.data = data
+        self.offset = offset
+        self.length = length
+        self.visible = visible
+        self.family = family
+        self.continents = continents
+
+    def is_visible(self):
+        return self.visible
+
+    def get(self, key, default = None):
+        if key == FAMILY_FIELD:
+            return self.family
+        elif key == CONTINENTS_FIELD:
+            return list(self.continents)
+        return default
+
+    def raw(self):
+        """Returns the BSON document of the item."""
+        return self.data[self.offset:self.offset + self.length]
+
+    def load(self):
+        return BirdRecord(BSON(self.raw()).decode())
+
+
+def encode_filter_values(family, continents):
+    """Returns flags and encoded family and continents."""
+    flags = 0
+    values = list(continents)
+    if family is not None:
+        flags |= HAS_FAMILY
+        values.insert(0, family)
+    encoded = []
+    for value in values:
+        value = value.encode("utf-8")
+        encoded.append(STRING_LENGTH.pack(len(value)))
+        encoded.append(value)
+    return flags, b"".join(encoded)
+
+def decode_filter_values(values, flags, count):
+    """Returns family and tuple of continents encoded in `values'."""
+    strings = []
+    offset = 0
+    for _ in range(count + bool(flags & HAS_FAMILY)):
+        length, = STRING_LENGTH.unpack_from(values, offset)
+        offset += STRING_LENGTH.size
+        strings.append(intern(values[offset:offset + length].decode("utf-8")))
+        offset += length
+    if flags & HAS_FAMILY:
+        return strings[0], tuple(strings[1:])
+    return None, tuple(strings)
+
+def encode_entry(item_id, record):
+    """Returns snapshot entry of a record, or of a SnapshotRecord without
+    decoding it."""
+    if isinstance(record, SnapshotRecord):
+        document = record.raw()
+        family, continents = record.family, record.continents
+    else:
+        document = BSON.encode(dict(record))
+        family, continents = filter_values(record)
+    flags, values = encode_filter_values(family, continents)
+    if record.is_visible():
+        flags |= VISIBLE
+    return HEADER.pack(item_id.binary, flags, len(continents), len(values),
+                       len(document)) + values + document
+
+
+def write(path, records):
+    """Writes (id, record) pairs as the snapshot at `path'."""
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as output:
+        output.write(MAGIC)
+        for item_id, record in records:
+            output.write(encode_entry(item_id, record))
+        output.flush()
+        os.fsync(output.fileno())
+    os.rename(temporary, path)
+
+@contextlib.contextmanager
+def collection_paused():
+    """Pauses the garbage collector, which would otherwise go over every
+    restored record again and again while they are being allocated, none
+    of them in a reference cycle."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def read(path):
+    """Generates (id, SnapshotRecord) pairs from the snapshot at `path'.
+
+    The file stays mapped for as long as any of the records is around."""
+    with open(path, "rb") as snapshot:
+        size = os.fstat(snapshot.fileno()).st_size
+        if size == 0:
+            raise SnapshotError("Empty snapshot %s" % path)
+        data = mmap.mmap(snapshot.fileno(), 0, access = mmap.ACCESS_READ)
+    if data[:len(MAGIC)] != MAGIC:
+        raise SnapshotError("Not a snapshot: %s" % path)
+    offset = len(MAGIC)
+    # Many birds share their family and continents, which are only decoded
+    # the first time
+    decoded = {}
+    try:
+        while offset < size:
+            binary, flags, count, values_length, length = \
+                HEADER.unpack_from(data, offset)
+            offset += HEADER.size
+            values = data[offset:offset + values_length]
+            key = (flags & HAS_FAMILY, count, values)
+            filters = decoded.get(key)
+            if filters is None:
+                filters = decoded[key] = decode_filter_values(values, flags,
+                                                              count)
+            offset += values_length
+            if offset + length > size:
+                raise SnapshotError("Truncated snapshot %s" % path)
+            yield ObjectId(binary), SnapshotRecord(
+                data, offset, length, bool(flags & VISIBLE), *filters)
+            offset += length
+    except (struct.error, UnicodeDecodeError):
+        raise SnapshotError("Damaged snapshot %s at %d" % (path, offset))
+
+
+class Snapshotter(object):
+    """Snapshots a storage engine every `interval' seconds from a thread
+    of its own, if anything changed since the last time, and once more
+    when closed.
+
+    The engine needs `changes', a counter of writes, and a
+    snapshot(path) method."""
+
+    def __init__(self, engine, path, interval = DEFAULT_SNAPSHOT_INTERVAL):
+        self.engine = engine
+        self.path = path
+        self.interval = interval
+        self.saved = engine.changes
+        self.logger = logging.getLogger("birds-api")
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target = self.run, daemon = True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def save(self):
+        changes = self.engine.changes
+        if changes == self.saved:
+            return
+        self.engine.snapshot(self.path)
+        self.saved = changes
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.save()
+            except Exception as ex:
+                self.logger.exception(ex)
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
+        self.save()
@@ -1,15 +1,42 @@
 """Birds storage engine
 
 Abstracts away exact method/location of storing data from the rest of the
-system, including persistence, ways to identify the resource, and the like."""
+system, including persistence, ways to identify the resource, and the like.
 
+pymongo is only imported by the MongoStorage methods needing it, so that
+engines doing without MongoDB do not pay for loading it."""
+
+from bson import BSON
+from bson.errors import BSONError
 from bson.objectid import ObjectId, InvalidId
-import copy
+from .records import BirdRecord, copy_item, filter_values
+from . import snapshot
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import random
+import threading
 import time
 
 VISIBLE_KEY = "visible"
 ADDED_KEY = "added"
 ID_KEY = "id"
+ETAG_KEY = "etag"
+FAMILY_KEY = "family"
+CONTINENTS_KEY = "continents"
+
+# Where an item may carry the ObjectId it is to be stored under
+ASSIGNED_ID_KEY = "_id"
+
+# Kinds of changes in the change feed
+CHANGE_INSERT = "insert"
+CHANGE_DELETE = "delete"
 
 
 def add_default_fields(item):
@@ -19,30 +46,127 @@ def add_default_fields(item):
         item[ADDED_KEY] = time.strftime("%Y-%m-%d", time.gmtime())
     return item
 
+def content_hash(item):
+    """Hashes item content, leaving out identifiers and the hash itself."""
+    content = {k : v for k, v in item.items()
+               if k not in (ID_KEY, "_id", ETAG_KEY)}
+    encoded = json.dumps(content, sort_keys = True, default = str)
+    return hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+def add_etag(item):
+    """Stores content hash in the item. Items never change once stored,
+    so the hash can be computed once, up front."""
+    item[ETAG_KEY] = content_hash(item)
+    return item
+
+def assigned_id(item):
+    """Returns the ObjectId an item was given to be stored under, taking it
+    out of the item, or a new one if it was given none."""
+    item_id = item.pop(ASSIGNED_ID_KEY, None)
+    return item_id if isinstance(item_id, ObjectId) else ObjectId()
+
+def item_etag(item):
+    """Returns stored content hash of an item, computing it if missing."""
+    return item.get(ETAG_KEY) or content_hash(item)
+
+def is_visible(item):
+    return VISIBLE_KEY in item and bool(item[VISIBLE_KEY])
+
+def matches(item, family, continent):
+    """Tells if item passes the listing filters, None meaning any value."""
+    item_family, item_continents = filter_values(item)
+    return ((family is None or item_family == family) and
+            (continent is None or continent in item_continents))
+
+def change_entry(change, item_id, visible):
+    """Returns a change of the change feed, as a dictionary."""
+    return {"id" : item_id, "change" : change, "visible" : visible}
+
+class ChangesExpired(Exception):
+    """Changes past a change feed token are no longer kept."""
 
 class StorageEngine(object):
-    """Dysfunctional storage base class. Fails at everything.
+    """Dysfunctional storage base class. Fails at everything it cannot do
+    in terms of other methods.
 
     Note how methods accepting item ID need to be able to handle
     string representation of originally returned ID."""
 
     def store(self, item):
-        """Stores `item' in the database, returning its identifier."""
+        """Stores `item' in the database, returning its identifier.
+
+        An item with an ObjectId under ASSIGNED_ID_KEY is stored under that
+        id, rather than a new one. ValueError is raised if an item is
+        already stored under it, which is left as it is."""
         raise NotImplementedError
 
+    def store_many(self, items):
+        """Stores all `items', returning list of their identifiers.
+
+        Identifiers are in the same order as the items. Items that could
+        not be stored get None instead, like ones assigned an id that is
+        already used. Default implementation stores items one by one."""
+        return [self.store(item) for item in items]
+
     def retrieve(self, item_id):
         """Retrieve item with given identifier, or None."""
         raise NotImplementedError
 
+    def retrieve_many(self, item_ids):
+        """Retrieves items with given identifiers, returning list of them
+        in the same order, with None for the unknown ones.
+
+        Default implementation retrieves items one by one."""
+        return [self.retrieve(item_id) for item_id in item_ids]
+
     def remove(self, item_id):
         """Removes indicated item. Returns False if item_id is unknown."""
         raise NotImplementedError
 
-    def list(self):
-        """Generates sequence of visible items.
+    def etag(self, item_id):
+        """Returns content hash of indicated item, or None if it's unknown.
+
+        Default implementation retrieves the whole item."""
+        item = self.retrieve(item_id)
+        return None if item is None else item_etag(item)
+
+    def list_version(self):
+        """Returns version of the visible item list.
+
+        Version changes whenever an item becomes or stops being visible, so
+        equal versions mean equal listings."""
+        raise NotImplementedError
+
+    def list(self, after = None, limit = None, family = None,
+             continent = None):
+        """Generates sequence of visible item identifiers, in their order.
 
         Item is visible if it can be indexed with "visible" attribute
-        and it results in true value."""
+        and it results in true value. Listing starts past the identifier
+        `after', if given, and yields at most `limit' identifiers. Given a
+        `family', only items of that family are listed, and given a
+        `continent', only items with it among their continents."""
+        raise NotImplementedError
+
+    def all_ids(self):
+        """Returns list of identifiers of every item, visible or not."""
+        raise NotImplementedError
+
+    def changes_since(self, token = None, limit = None, wait = 0):
+        """Returns list of changes past `token' in the change feed, in the
+        order they were made, at most `limit' of them, and the token to
+        ask for the next ones with.
+
+        Changes are dictionaries of the item "id", the "change", which is
+        CHANGE_INSERT or CHANGE_DELETE, and whether the item is "visible".
+        Items never change once stored, so an item only becomes visible by
+        being inserted and stops being visible by being deleted. Without a
+        `token', returns no changes and the token of the current position.
+        Given `wait' seconds, waits at most that long for a change if there
+        is none yet.
+
+        Raises ChangesExpired if the changes past `token' are no longer
+        kept, and ValueError if `token' is not a token of this storage."""
         raise NotImplementedError
 
     def parse_oid(self, item_id):
@@ -55,63 +179,2033 @@ class StorageEngine(object):
         return item_id
 
 
+def sort_key(item_id):
+    """Returns bytes of an ObjectId, which sort the same way it compares,
+    and any other id as it is."""
+    if isinstance(item_id, ObjectId):
+        return item_id.binary
+    return item_id
+
+class SortedIds(object):
+    """Identifiers in increasing order, with a set of them for lookups.
+
+    ObjectIds compare in Python code, so looking one up with a binary
+    search costs a dozen or more such calls, while hashing costs one."""
+
+    def __init__(self):
+        self.ids = []
+        self.members = set()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, item_id):
+        return item_id in self.members
+
+    def append(self, item_id):
+        """Adds an id greater than all the others."""
+        self.ids.append(item_id)
+        self.members.add(item_id)
+
+    def add(self, item_id):
+        # Ids are generated in increasing order, so this is usually an
+        # append
+        if not self.ids or self.ids[-1] < item_id:
+            self.ids.append(item_id)
+        else:
+            bisect.insort(self.ids, item_id)
+        self.members.add(item_id)
+
+    def remove(self, item_id):
+        del self.ids[bisect.bisect_left(self.ids, item_id)]
+        self.members.discard(item_id)
+
+    def start(self, after):
+        """Returns position of the first id past `after'."""
+        return 0 if after is None else bisect.bisect_right(self.ids, after)
+
+
+class VisibleIndex(object):
+    """Identifiers of visible items, all of them, by family and by
+    continent.
+
+    A page is a binary search and a slice. Filters are combined by walking
+    the shortest list and looking the ids up in the others."""
+
+    def __init__(self):
+        self.ids = SortedIds()
+        self.families = {}
+        self.continents = {}
+
+    @classmethod
+    def build(cls, items):
+        """Indexes (id, family, continents) triples, in any order, sorting
+        them once instead of inserting one id at a time."""
+        index = cls()
+        # Sorting by the bytes spares the comparisons in Python code
+        items = sorted(items, key = lambda item: sort_key(item[0]))
+        for item_id, family, continents in items:
+            index.ids.append(item_id)
+            if family is not None:
+                index.families.setdefault(family, SortedIds()).append(
+                    item_id)
+            for continent in continents:
+                index.continents.setdefault(continent, SortedIds()).append(
+                    item_id)
+        return index
+
+    def add(self, item_id, item):
+        self.ids.add(item_id)
+        family, continents = filter_values(item)
+        if family is not None:
+            self.families.setdefault(family, SortedIds()).add(item_id)
+        for continent in continents:
+            self.continents.setdefault(continent, SortedIds()).add(item_id)
+
+    def remove(self, item_id, item):
+        self.ids.remove(item_id)
+        family, continents = filter_values(item)
+        if family is not None:
+            self.remove_value(self.families, family, item_id)
+        for continent in continents:
+            self.remove_value(self.continents, continent, item_id)
+
+    @staticmethod
+    def remove_value(index, value, item_id):
+        ids = index[value]
+        ids.remove(item_id)
+        if not ids:
+            del index[value]
+
+    def list(self, after = None, limit = None, family = None,
+             continent = None):
+        """Returns list of matching ids, as StorageEngine.list."""
+        lists = []
+        if family is not None:
+            lists.append(self.families.get(family, EMPTY_IDS))
+        if continent is not None:
+            lists.append(self.continents.get(continent, EMPTY_IDS))
+        if not lists:
+            lists.append(self.ids)
+        lists.sort(key = len)
+        shortest, others = lists[0], lists[1:]
+        start = shortest.start(after)
+        if not others:
+            stop = None if limit is None else start + limit
+            return shortest.ids[start:stop]
+        found = []
+        for item_id in itertools.islice(shortest.ids, start, None):
+            if all(item_id in ids for ids in others):
+                found.append(item_id)
+                if len(found) == limit:
+                    break
+        return found
+
+EMPTY_IDS = SortedIds()
+
+
+DEFAULT_CHANGE_LOG_SIZE = 10000
+
+class ChangeLog(object):
+    """Latest changes to the items of a storage, in a ring buffer of at
+    most `size' of them, for StorageEngine.changes_since.
+
+    Changes are numbered in sequence, and a token is the number of the
+    last change seen after a random epoch of the log. Tokens of another
+    log, like the one of the storage before a restart, are expired rather
+    than mistaken for positions in this one. Safe to share between
+    threads, which can wait for the next change."""
+
+    def __init__(self, size = DEFAULT_CHANGE_LOG_SIZE):
+        self.entries = collections.deque(maxlen = size)
+        self.sequence = 0
+        self.epoch = "%08x" % random.getrandbits(32)
+        self.condition = threading.Condition()
+
+    def token(self, sequence):
+        return "%s-%d" % (self.epoch, sequence)
+
+    def parse(self, token):
+        """Returns number of the change of `token'."""
+        epoch, _, sequence = token.partition("-")
+        sequence = int(sequence)
+        if sequence < 0:
+            raise ValueError("Invalid token: %r" % token)
+        if epoch != self.epoch:
+            raise ChangesExpired(token)
+        if sequence > self.sequence:
+            raise ValueError("Token of a change yet to come: %r" % token)
+        return sequence
+
+    def append(self, changes):
+        """Logs (change, item id, visible) triples, waking up whoever waits
+        for changes."""
+        with self.condition:
+            for change in changes:
+                self.sequence += 1
+                self.entries.append(change)
+            self.condition.notify_all()
+
+    def since(self, token = None, limit = None, wait = 0):
+        """Does StorageEngine.changes_since."""
+        with self.condition:
+            if token is None:
+                return [], self.token(self.sequence)
+            since = self.parse(token)
+            if wait > 0:
+                self.condition.wait_for(lambda: self.sequence > since, wait)
+            # Number of the oldest change kept
+            oldest = self.sequence - len(self.entries) + 1
+            if since + 1 < oldest:
+                raise ChangesExpired(token)
+            start = since + 1 - oldest
+            stop = None if limit is None else start + limit
+            changes = [change_entry(*change) for change in
+                       itertools.islice(self.entries, start, stop)]
+            return changes, self.token(since + len(changes))
+
+
 class MemoryStorage(StorageEngine):
     """In-memory storage engine.
 
-    Stores objects in memory without persistence. Mostly useful for testing."""
+    Stores objects in memory without persistence. Mostly useful for testing.
+    Not safe to share between threads, ShardedMemoryStorage is.
+    Identifiers of visible items are also kept in a VisibleIndex, so
+    listing costs as much as there are matching items, however many are
+    hidden, and a page is a binary search and a slice.
 
-    def __init__(self):
+    Items are kept as compact, read-only records.BirdRecord mappings, which
+    is also what retrieve returns, without any copying. Items restored from
+    a snapshot are only decoded into records once retrieved.
+
+    The latest `change_log_size' changes are kept in a ChangeLog."""
+
+    def __init__(self, change_log_size = DEFAULT_CHANGE_LOG_SIZE):
         self.database = {}
+        self.visible = VisibleIndex()
+        # Tells this instance's generations apart from other processes'
+        self.epoch = str(ObjectId())
+        self.generation = 0
+        # Counts writes, for snapshot.Snapshotter to tell if there are any
+        self.changes = 0
+        self.change_log = ChangeLog(change_log_size)
 
-    def store(self, item):
-        add_default_fields(item)
-        item_id = ObjectId()
+    def index(self, item_id, item):
+        if item.is_visible():
+            self.visible.add(item_id, item)
+            self.generation += 1
+
+    @staticmethod
+    def record(item):
+        """Gives the item its default fields and a new id, returning the
+        id and the record to keep."""
+        add_etag(add_default_fields(item))
+        item_id = assigned_id(item)
         item[ID_KEY] = item_id
-        self.database[item_id] = item
+        return item_id, BirdRecord(item)
+
+    def store(self, item):
+        item_id, record = self.record(item)
+        if item_id in self.database:
+            raise ValueError("Id %s is already used" % item_id)
+        self.database[item_id] = record
+        self.index(item_id, record)
+        self.changes += 1
+        self.change_log.append([(CHANGE_INSERT, item_id,
+                                 record.is_visible())])
         return item_id
 
+    def store_many(self, items):
+        ids = []
+        batch = collections.OrderedDict()
+        for item in items:
+            item_id, record = self.record(item)
+            if item_id in batch or item_id in self.database:
+                ids.append(None)
+                continue
+            ids.append(item_id)
+            batch[item_id] = record
+        self.database.update(batch)
+        for item_id, record in batch.items():
+            self.index(item_id, record)
+        self.changes += 1
+        self.change_log.append([(CHANGE_INSERT, item_id, record.is_visible())
+                                for item_id, record in batch.items()])
+        return ids
+
     def retrieve(self, item_id):
-        item = self.database.get(self.parse_oid(item_id))
-        return copy.deepcopy(item) if item else None
+        item_id = self.parse_oid(item_id)
+        record = self.database.get(item_id)
+        if type(record) is snapshot.SnapshotRecord:
+            record = self.database[item_id] = record.load()
+        return record
+
+    def retrieve_many(self, item_ids):
+        return [self.retrieve(item_id) for item_id in item_ids]
+
+    def etag(self, item_id):
+        item = self.retrieve(item_id)
+        return None if item is None else item_etag(item)
+
+    def list_version(self):
+        return "%s.%d" % (self.epoch, self.generation)
+
+    def all_ids(self):
+        return list(self.database)
 
     def remove(self, item_id):
-        """Removes indicated item. Raises KeyError if it's missing."""
+        """Removes indicated item. Returns False if it's missing."""
         parsed_id = self.parse_oid(item_id)
-        if not parsed_id in self.database:
+        record = self.database.pop(parsed_id, None)
+        if record is None:
             return False
-        del self.database[self.parse_oid(item_id)]
+        if record.is_visible():
+            self.visible.remove(parsed_id, record)
+            self.generation += 1
+        self.changes += 1
+        self.change_log.append([(CHANGE_DELETE, parsed_id,
+                                 record.is_visible())])
         return True
 
-    def list(self):
+    def list(self, after = None, limit = None, family = None,
+             continent = None):
         """Generates sequence of visible items."""
-        for key, item in self.database.items():
-            if VISIBLE_KEY in item and item[VISIBLE_KEY]:
-                yield key
+        if after is not None:
+            after = self.parse_oid(after)
+        return iter(self.visible.list(after, limit, family, continent))
+
+    def changes_since(self, token = None, limit = None, wait = 0):
+        return self.change_log.since(token, limit, wait)
+
+    def snapshot(self, path):
+        """Writes all items to the snapshot file at `path'."""
+        snapshot.write(path, list(self.database.items()))
+
+    def restore(self, path):
+        """Replaces all items with the ones in the snapshot at `path'.
+
+        Changes are not in snapshots, so every change feed token given out
+        before expires."""
+        with snapshot.collection_paused():
+            self.database = dict(snapshot.read(path))
+            self.visible = VisibleIndex.build(
+                (item_id, record.family, record.continents)
+                for item_id, record in self.database.items()
+                if record.is_visible())
+        self.epoch = str(ObjectId())
+        self.generation = 0
+        self.change_log = ChangeLog(self.change_log.entries.maxlen)
+
+
+DEFAULT_STRIPES = 16
+
+class ShardedMemoryStorage(StorageEngine):
+    """In-memory storage engine safe to share between threads.
+
+    Items are spread over `stripes' dictionaries by the hash of their id,
+    and every one of them has a lock of its own, so writes of different
+    stripes do not wait for each other. Reading an item is a dictionary
+    lookup, which needs no lock. Visible ids are kept in a single
+    VisibleIndex behind a lock of its own, only held for as long as it
+    takes to add or remove an id or to slice a page, so a page is a
+    consistent snapshot and needs no merging.
+
+    The interpreter lock still lets a single thread run Python code at a
+    time, so stripes spare threads waiting for each other, not the work
+    itself. Snapshots copy one stripe at a time, and are written without
+    holding any lock. Changes are logged while the stripe is locked, so
+    they are in the same order as the writes of every item."""
+
+    def __init__(self, stripes = DEFAULT_STRIPES,
+                 change_log_size = DEFAULT_CHANGE_LOG_SIZE):
+        self.shards = [{} for _ in range(stripes)]
+        self.locks = [threading.Lock() for _ in range(stripes)]
+        self.visible = VisibleIndex()
+        self.visible_lock = threading.Lock()
+        self.epoch = str(ObjectId())
+        self.generation = 0
+        self.changes = 0
+        self.change_log = ChangeLog(change_log_size)
+
+    def stripe(self, item_id):
+        """Returns index of the stripe the item is in."""
+        return hash(item_id) % len(self.shards)
 
+    def insert(self, stripe, records):
+        """Keeps records from a dictionary of them by id, all of them of
+        the same stripe, but for ones whose id is already used. Returns
+        the ids of those."""
+        with self.locks[stripe]:
+            shard = self.shards[stripe]
+            used = [item_id for item_id in records if item_id in shard]
+            for item_id in used:
+                del records[item_id]
+            if not records:
+                return used
+            visible = [(item_id, record)
+                       for item_id, record in records.items()
+                       if record.is_visible()]
+            shard.update(records)
+            self.changes += 1
+            if visible:
+                with self.visible_lock:
+                    for item_id, record in visible:
+                        self.visible.add(item_id, record)
+                    self.generation += 1
+            self.change_log.append([(CHANGE_INSERT, item_id,
+                                     record.is_visible())
+                                    for item_id, record in records.items()])
+        return used
+
+    def store(self, item):
+        item_id, record = MemoryStorage.record(item)
+        if self.insert(self.stripe(item_id), {item_id : record}):
+            raise ValueError("Id %s is already used" % item_id)
+        return item_id
+
+    def store_many(self, items):
+        ids = []
+        batches = collections.defaultdict(dict)
+        for item in items:
+            item_id, record = MemoryStorage.record(item)
+            batch = batches[self.stripe(item_id)]
+            if item_id in batch:
+                ids.append(None)
+                continue
+            ids.append(item_id)
+            batch[item_id] = record
+        used = set()
+        for stripe, records in batches.items():
+            used.update(self.insert(stripe, records))
+        return [None if item_id in used else item_id for item_id in ids]
+
+    def retrieve(self, item_id):
+        item_id = self.parse_oid(item_id)
+        stripe = self.stripe(item_id)
+        record = self.shards[stripe].get(item_id)
+        if type(record) is snapshot.SnapshotRecord:
+            loaded = record.load()
+            with self.locks[stripe]:
+                # Unless it was removed meanwhile
+                if self.shards[stripe].get(item_id) is record:
+                    self.shards[stripe][item_id] = loaded
+            record = loaded
+        return record
+
+    def etag(self, item_id):
+        item = self.retrieve(item_id)
+        return None if item is None else item_etag(item)
+
+    def list_version(self):
+        return "%s.%d" % (self.epoch, self.generation)
+
+    def all_ids(self):
+        ids = []
+        for lock, shard in zip(self.locks, self.shards):
+            with lock:
+                ids.extend(shard)
+        return ids
+
+    def remove(self, item_id):
+        item_id = self.parse_oid(item_id)
+        stripe = self.stripe(item_id)
+        with self.locks[stripe]:
+            record = self.shards[stripe].pop(item_id, None)
+            if record is None:
+                return False
+            self.changes += 1
+            if record.is_visible():
+                with self.visible_lock:
+                    self.visible.remove(item_id, record)
+                    self.generation += 1
+            self.change_log.append([(CHANGE_DELETE, item_id,
+                                     record.is_visible())])
+        return True
+
+    def list(self, after = None, limit = None, family = None,
+             continent = None):
+        if after is not None:
+            after = self.parse_oid(after)
+        with self.visible_lock:
+            return iter(self.visible.list(after, limit, family, continent))
+
+    def changes_since(self, token = None, limit = None, wait = 0):
+        return self.change_log.since(token, limit, wait)
+
+    def snapshot(self, path):
+        records = []
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                records.extend(shard.items())
+        snapshot.write(path, records)
+
+    def restore(self, path):
+        """Replaces all items with the ones in the snapshot at `path'. Must
+        be done before any other thread uses the storage."""
+        shards = [{} for _ in self.shards]
+        visible = []
+        with snapshot.collection_paused():
+            for item_id, record in snapshot.read(path):
+                shards[self.stripe(item_id)][item_id] = record
+                if record.is_visible():
+                    visible.append((item_id, record.family,
+                                    record.continents))
+            self.shards = shards
+            self.visible = VisibleIndex.build(visible)
+        self.epoch = str(ObjectId())
+        self.generation = 0
+        self.change_log = ChangeLog(self.change_log.entries.maxlen)
+
+
+class CollectionScanError(Exception):
+    """Query would have to scan the whole collection."""
+
+
+PLAN_CHECK_WARN = "warn"
+PLAN_CHECK_FAIL = "fail"
+
+def collection_scans(plan):
+    """Generates COLLSCAN stages found anywhere in a query plan."""
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            yield plan
+        for value in plan.values():
+            for stage in collection_scans(value):
+                yield stage
+    elif isinstance(plan, list):
+        for value in plan:
+            for stage in collection_scans(value):
+                yield stage
+
+def check_query_plan(explanation, mode):
+    """Warns or raises CollectionScanError if winning plan scans collection.
+
+    `explanation' is what explain() returned for the query."""
+    winning_plan = explanation.get("queryPlanner", {}).get("winningPlan", {})
+    if not any(collection_scans(winning_plan)):
+        return
+    message = "Query plan is a collection scan: %r" % (winning_plan,)
+    if mode == PLAN_CHECK_FAIL:
+        raise CollectionScanError(message)
+    logging.getLogger("birds-api").warning(message)
+
+
+DEFAULT_CURSOR_BATCH_SIZE = 1000
+# Codes of failures meaning somebody else is creating the same index.
+INDEX_ALREADY_EXISTS = 68
+INDEX_BUILD_ALREADY_IN_PROGRESS = 276
+# Failure of creating a collection somebody else just created
+NAMESPACE_EXISTS = 48
+# Same as pymongo.ASCENDING
+ASCENDING = 1
+DEFAULT_CHANGE_LOG_BYTES = 16 * 1024 * 1024
+# Seconds between looking for changes when waiting for them
+CHANGES_POLL_INTERVAL = 0.25
+# Seconds a change number may be missing from the log before the write
+# it was taken for is given up on
+CHANGE_GAP_TIMEOUT = 10.0
 
 class MongoStorage(StorageEngine):
-    """Database storage for items."""
+    """Database storage for items.
+
+    `batch_size' is the number of documents fetched per round trip when
+    listing items. `plan_check' turns on explaining every query before
+    running it: PLAN_CHECK_WARN logs collection scans, PLAN_CHECK_FAIL
+    raises CollectionScanError instead. It costs an extra round trip per
+    query, so it is meant for diagnostics only.
+
+    Changes are logged in a capped collection of at most
+    `change_log_size' of them, created by ensure_change_log. Every write
+    takes as many numbers as it makes changes from a counter, then logs
+    them, which costs two more round trips. Writers in other processes
+    may log their changes out of order, so reading stops short of a
+    missing number until CHANGE_GAP_TIMEOUT seconds have passed."""
 
-    def __init__(self, collection):
+    # Names and keys of the indexes the queries below rely on
+    INDEXES = [
+        ("visible_id", [(VISIBLE_KEY, ASCENDING), ("_id", ASCENDING)]),
+        ("visible_family_id", [(VISIBLE_KEY, ASCENDING),
+                               (FAMILY_KEY, ASCENDING), ("_id", ASCENDING)]),
+        # Multikey, continents are arrays
+        ("visible_continents_id", [(VISIBLE_KEY, ASCENDING),
+                                   (CONTINENTS_KEY, ASCENDING),
+                                   ("_id", ASCENDING)]),
+    ]
+
+    def __init__(self, collection, batch_size = DEFAULT_CURSOR_BATCH_SIZE,
+                 plan_check = None, change_log_size = DEFAULT_CHANGE_LOG_SIZE,
+                 clock = time.time):
         self.collection = collection
+        self.batch_size = batch_size
+        self.plan_check = plan_check
+        self.change_log_size = change_log_size
+        self.clock = clock
+
+    @property
+    def meta(self):
+        """Collection of storage metadata, shared by every process using
+        the item collection."""
+        return self.collection.database[self.collection.name + ".meta"]
+
+    @property
+    def change_log(self):
+        """Capped collection of changes, keyed by their number."""
+        return self.collection.database[self.collection.name + ".changes"]
+
+    def ensure_indexes(self):
+        """Creates the indexes needed by storage queries, unless they exist.
+
+        Creating an index that already exists with the same name and keys
+        does nothing, so every worker can safely do this at startup."""
+        from pymongo import IndexModel
+        from pymongo.errors import OperationFailure
+        try:
+            self.collection.create_indexes(
+                [IndexModel(keys, name = name) for name, keys in self.INDEXES])
+        except OperationFailure as ex:
+            if ex.code not in (INDEX_ALREADY_EXISTS,
+                               INDEX_BUILD_ALREADY_IN_PROGRESS):
+                raise
+
+    def ensure_change_log(self):
+        """Creates the capped collection of changes, unless it exists."""
+        from pymongo.errors import CollectionInvalid, OperationFailure
+        try:
+            self.collection.database.create_collection(
+                self.change_log.name, capped = True,
+                size = DEFAULT_CHANGE_LOG_BYTES, max = self.change_log_size)
+        except CollectionInvalid:
+            pass
+        except OperationFailure as ex:
+            if ex.code != NAMESPACE_EXISTS:
+                raise
+
+    def checked(self, cursor):
+        """Checks query plan of `cursor' if plan checking is on."""
+        if self.plan_check is not None:
+            check_query_plan(cursor.explain(), self.plan_check)
+        return cursor
+
+    def verify_query_plans(self, mode = PLAN_CHECK_FAIL):
+        """Checks plans of every kind of query the storage runs."""
+        some_id = ObjectId()
+        for cursor in (self.id_cursor(some_id),
+                       self.ids_cursor([some_id, ObjectId()]),
+                       self.list_cursor(None, None),
+                       self.list_cursor(some_id, 10),
+                       self.list_cursor(some_id, 10, family = "Birdies"),
+                       self.list_cursor(some_id, 10, continent = "Europe"),
+                       self.list_cursor(some_id, 10, "Birdies", "Europe")):
+            check_query_plan(cursor.explain(), mode)
+
+    def id_cursor(self, item_id, *fields):
+        """Cursor for the item, with only given `fields' if there are any."""
+        projection = {field : True for field in fields} or None
+        return self.collection.find({"_id" : self.parse_oid(item_id)},
+                                    projection = projection, limit = 1)
+
+    def ids_cursor(self, item_ids):
+        return self.collection.find({"_id" : {"$in" : item_ids}},
+                                    batch_size = self.batch_size)
+
+    def list_cursor(self, after, limit, family = None, continent = None):
+        query = {VISIBLE_KEY : True}
+        if family is not None:
+            query[FAMILY_KEY] = family
+        if continent is not None:
+            query[CONTINENTS_KEY] = continent
+        if after is not None:
+            query["_id"] = {"$gt" : self.parse_oid(after)}
+        return self.collection.find(query,
+                                    projection = {"_id" : True},
+                                    sort = [("_id", ASCENDING)],
+                                    limit = limit or 0,
+                                    batch_size = self.batch_size)
 
     def retrieve(self, item_id):
-        item = self.collection.find_one(self.parse_oid(item_id))
+        item = next(self.checked(self.id_cursor(item_id)), None)
         if item:
             item[ID_KEY] = item["_id"]
         return item
 
-    def list(self):
-        cursor = self.collection.find({"visible" : True})
-        for item in cursor:
+    def retrieve_many(self, item_ids):
+        """Fetches all the items with a single $in query on _id."""
+        keys = [self.parse_oid(item_id) for item_id in item_ids]
+        found = {}
+        wanted = [key for key in set(keys) if isinstance(key, ObjectId)]
+        if wanted:
+            for item in self.checked(self.ids_cursor(wanted)):
+                item[ID_KEY] = item["_id"]
+                found[item["_id"]] = item
+        items = []
+        for key in keys:
+            item = found.get(key)
+            if item is not None:
+                # Every id gets an item of its own, even if asked for twice
+                found[key] = copy_item(item)
+            items.append(item)
+        return items
+
+    def list(self, after = None, limit = None, family = None,
+             continent = None):
+        """Generates visible ids with a range query on _id.
+
+        Filtering on visibility and sorting by _id with only _id projected
+        is covered entirely by a (visible, _id) index, and by a (visible,
+        family, _id) one when filtering by family. The index with
+        continents instead is multikey, which cannot cover queries, so
+        only documents it matched are fetched. Filtering by both uses
+        either index and checks the other value in those documents."""
+        for item in self.checked(self.list_cursor(after, limit, family,
+                                                  continent)):
             yield item["_id"]
 
+    def etag(self, item_id):
+        """Fetches just the stored content hash of the item."""
+        item = next(self.checked(self.id_cursor(item_id, ETAG_KEY)), None)
+        if item is not None and ETAG_KEY not in item:
+            # Stored before items had hashes
+            return StorageEngine.etag(self, item_id)
+        return None if item is None else item[ETAG_KEY]
+
+    def list_version(self):
+        meta = self.meta.find_one({"_id" : "generation"})
+        return 0 if meta is None else meta["value"]
+
+    def all_ids(self):
+        return [item["_id"] for item in self.collection.find(
+            {}, projection = {"_id" : True}, batch_size = self.batch_size)]
+
+    def bump_generation(self):
+        self.meta.update_one({"_id" : "generation"},
+                             {"$inc" : {"value" : 1}}, upsert = True)
+
+    def log_changes(self, changes):
+        """Logs (change, item id, visible) triples."""
+        from pymongo import ReturnDocument
+        if not changes:
+            return
+        counter = self.meta.find_one_and_update(
+            {"_id" : "changes"}, {"$inc" : {"value" : len(changes)}},
+            upsert = True, return_document = ReturnDocument.AFTER)
+        first = counter["value"] - len(changes) + 1
+        logged = self.clock()
+        self.change_log.insert_many(
+            [{"_id" : first + index, "change" : change, "item" : item_id,
+              "visible" : visible, "logged" : logged}
+             for index, (change, item_id, visible) in enumerate(changes)])
+
+    def read_changes(self, since, limit):
+        """Returns changes logged past number `since', and the number of
+        the last one."""
+        oldest = self.change_log.find_one(sort = [("_id", ASCENDING)])
+        if oldest is not None and since + 1 < oldest["_id"]:
+            raise ChangesExpired(since)
+        changes = []
+        expected = since + 1
+        for entry in self.change_log.find({"_id" : {"$gt" : since}},
+                                          sort = [("_id", ASCENDING)],
+                                          limit = limit or 0):
+            if entry["_id"] != expected and \
+               self.clock() - entry["logged"] < CHANGE_GAP_TIMEOUT:
+                # Somebody took the number and is yet to log the change
+                break
+            changes.append(change_entry(entry["change"], entry["item"],
+                                        entry["visible"]))
+            expected = entry["_id"] + 1
+        return changes, expected - 1
+
+    def changes_since(self, token = None, limit = None, wait = 0):
+        """Reads the change log, looking for new changes every
+        CHANGES_POLL_INTERVAL seconds while waiting for them. Tokens are
+        plain change numbers."""
+        if token is None:
+            counter = self.meta.find_one({"_id" : "changes"})
+            return [], str(0 if counter is None else counter["value"])
+        since = int(token)
+        if since < 0:
+            raise ValueError("Invalid token: %r" % token)
+        deadline = time.monotonic() + wait
+        while True:
+            changes, last = self.read_changes(since, limit)
+            remaining = deadline - time.monotonic()
+            if changes or remaining <= 0:
+                return changes, str(last)
+            time.sleep(min(CHANGES_POLL_INTERVAL, remaining))
+
     def remove(self, item_id):
-        result = self.collection.delete_one({"_id" : self.parse_oid(item_id)})
-        return False if result.deleted_count == 0 else True
+        # Same filter as retrieving, so same plan
+        if self.plan_check is not None:
+            self.checked(self.id_cursor(item_id))
+        item = self.collection.find_one_and_delete(
+            {"_id" : self.parse_oid(item_id)},
+            projection = {VISIBLE_KEY : True})
+        if item is None:
+            return False
+        if is_visible(item):
+            self.bump_generation()
+        self.log_changes([(CHANGE_DELETE, item["_id"], is_visible(item))])
+        return True
 
     def store(self, item):
-        add_default_fields(item)
-        result = self.collection.insert_one(item)
+        from pymongo.errors import DuplicateKeyError
+        add_etag(add_default_fields(item))
+        try:
+            result = self.collection.insert_one(item)
+        except DuplicateKeyError:
+            raise ValueError("Id %s is already used" % item["_id"])
         item[ID_KEY] = result.inserted_id
-        return result.inserted_id
\ No newline at end of file
+        if is_visible(item):
+            self.bump_generation()
+        self.log_changes([(CHANGE_INSERT, result.inserted_id,
+                           is_visible(item))])
+        return result.inserted_id
+
+    def store_many(self, items):
+        """Inserts `items' in one unordered bulk write.
+
+        The driver assigns ids before sending the batch, so items that fail
+        individually do not prevent the rest from being stored."""
+        from pymongo.errors import BulkWriteError
+        items = list(items)
+        if not items:
+            return []
+        for item in items:
+            add_etag(add_default_fields(item))
+        failed = set()
+        try:
+            self.collection.insert_many(items, ordered = False)
+        except BulkWriteError as ex:
+            failed = {error["index"]
+                      for error in ex.details.get("writeErrors", [])}
+            if not failed:
+                raise
+        ids = []
+        for index, item in enumerate(items):
+            if index in failed:
+                ids.append(None)
+            else:
+                item[ID_KEY] = item["_id"]
+                ids.append(item["_id"])
+        if any(is_visible(item) for item, item_id in zip(items, ids)
+               if item_id is not None):
+            self.bump_generation()
+        self.log_changes([(CHANGE_INSERT, item_id, is_visible(item))
+                          for item, item_id in zip(items, ids)
+                          if item_id is not None])
+        return ids
+
+SQLITE_TIMEOUT = 30.0
+SQLITE_CACHED_STATEMENTS = 32
+# Well below the limit of older SQLite versions, 999
+SQLITE_MAX_PARAMETERS = 500
+
+class SqliteStorage(StorageEngine):
+    """Storage for items in an SQLite database file at `path'.
+
+    Items are stored as BSON, keyed by the binary ObjectId, next to their
+    visibility and content hash. A partial index of visible ids makes
+    listing an index-only range scan. Family and continents of visible
+    items are kept in tables of their own, keyed by value and id, so
+    filtered listing is a range scan of those. The database is in WAL
+    mode, so reads never wait for writes, and every thread gets its own
+    connection, with its own cache of prepared statements. `sync' makes
+    every commit wait for the disk, which is only needed to survive power
+    loss.
+
+    Every process opens its own connections, so forked workers can share
+    the database file."""
+
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS birds ("
+        " id BLOB PRIMARY KEY,"
+        " visible INTEGER NOT NULL,"
+        " etag TEXT NOT NULL,"
+        " item BLOB NOT NULL"
+        ") WITHOUT ROWID",
+        # Only the visible column makes the index cover listing queries
+        "CREATE INDEX IF NOT EXISTS visible_birds ON birds (visible, id)"
+        " WHERE visible = 1",
+        "CREATE TABLE IF NOT EXISTS meta ("
+        " name TEXT PRIMARY KEY,"
+        " value INTEGER NOT NULL"
+        ")",
+        "INSERT OR IGNORE INTO meta VALUES ('generation', 0)",
+        "CREATE TABLE IF NOT EXISTS visible_families ("
+        " family TEXT NOT NULL,"
+        " id BLOB NOT NULL,"
+        " PRIMARY KEY (family, id)"
+        ") WITHOUT ROWID",
+        "CREATE TABLE IF NOT EXISTS visible_continents ("
+        " continent TEXT NOT NULL,"
+        " id BLOB NOT NULL,"
+        " PRIMARY KEY (continent, id)"
+        ") WITHOUT ROWID",
+    ]
+    # Databases created before there were filter tables need them filled
+    SCHEMA_VERSION = 1
+
+    INSERT = "INSERT INTO birds VALUES (?, ?, ?, ?)"
+    SELECT_ITEM = "SELECT item FROM birds WHERE id = ?"
+    SELECT_ITEMS = "SELECT id, item FROM birds WHERE id IN (%s)"
+    SELECT_ETAG = "SELECT etag FROM birds WHERE id = ?"
+    SELECT_VISIBLE = "SELECT visible, item FROM birds WHERE id = ?"
+    SELECT_ALL_VISIBLE = "SELECT id, item FROM birds WHERE visible = 1"
+    SELECT_IDS = "SELECT id FROM birds"
+    SELECT_USED_IDS = "SELECT id FROM birds WHERE id IN (%s)"
+    INSERT_FAMILY = "INSERT INTO visible_families VALUES (?, ?)"
+    INSERT_CONTINENT = "INSERT INTO visible_continents VALUES (?, ?)"
+    DELETE_FAMILY = "DELETE FROM visible_families WHERE family = ? AND id = ?"
+    DELETE_CONTINENT = ("DELETE FROM visible_continents"
+                        " WHERE continent = ? AND id = ?")
+    DELETE = "DELETE FROM birds WHERE id = ?"
+    # Same condition as the partial index, so it can be used
+    LIST = ("SELECT id FROM birds WHERE visible = 1 AND id > ?"
+            " ORDER BY id LIMIT ?")
+    LIST_FAMILY = ("SELECT id FROM visible_families"
+                   " WHERE family = ? AND id > ? ORDER BY id LIMIT ?")
+    LIST_CONTINENT = ("SELECT id FROM visible_continents"
+                      " WHERE continent = ? AND id > ? ORDER BY id LIMIT ?")
+    LIST_BOTH = ("SELECT f.id FROM visible_families AS f"
+                 " JOIN visible_continents AS c"
+                 " ON c.continent = ? AND c.id = f.id"
+                 " WHERE f.family = ? AND f.id > ? ORDER BY f.id LIMIT ?")
+    SELECT_GENERATION = "SELECT value FROM meta WHERE name = 'generation'"
+    BUMP_GENERATION = ("UPDATE meta SET value = value + 1"
+                       " WHERE name = 'generation'")
+
+    def __init__(self, path, sync = False):
+        self.path = path
+        self.sync = sync
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+        with self.transaction() as connection:
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version < 1:
+                visible = connection.execute(self.SELECT_ALL_VISIBLE)
+                for key, item in visible.fetchall():
+                    self.index(connection, key, BSON(item).decode())
+            if version < self.SCHEMA_VERSION:
+                connection.execute("PRAGMA user_version = %d" %
+                                   self.SCHEMA_VERSION)
+
+    def connection(self):
+        """Returns connection of the calling thread, opening it if needed."""
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            import sqlite3
+            # Only ever used by this thread, but closed by whoever calls close
+            connection = sqlite3.connect(
+                self.path, timeout = SQLITE_TIMEOUT, isolation_level = None,
+                check_same_thread = False,
+                cached_statements = SQLITE_CACHED_STATEMENTS)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = " +
+                               ("FULL" if self.sync else "NORMAL"))
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Runs the block in a write transaction, rolled back on errors."""
+        connection = self.connection()
+        # Takes the write lock right away, instead of failing to upgrade a
+        # read lock when another connection writes first
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def key(self, item_id):
+        """Returns database key of the item, or None if it can't have one."""
+        item_id = self.parse_oid(item_id)
+        return item_id.binary if isinstance(item_id, ObjectId) else None
+
+    def row(self, item):
+        add_etag(add_default_fields(item))
+        item_id = assigned_id(item)
+        item[ID_KEY] = item_id
+        return (item_id.binary, int(is_visible(item)), item[ETAG_KEY],
+                BSON.encode(item))
+
+    def index(self, connection, key, item):
+        """Adds filter values of a visible item to their tables."""
+        family, continents = filter_values(item)
+        if family is not None:
+            connection.execute(self.INSERT_FAMILY, (family, key))
+        connection.executemany(self.INSERT_CONTINENT,
+                               ((continent, key) for continent in continents))
+
+    def store(self, item):
+        import sqlite3
+        row = self.row(item)
+        with self.transaction() as connection:
+            try:
+                connection.execute(self.INSERT, row)
+            except sqlite3.IntegrityError:
+                raise ValueError("Id %s is already used" % item[ID_KEY])
+            if row[1]:
+                self.index(connection, row[0], item)
+                connection.execute(self.BUMP_GENERATION)
+        return item[ID_KEY]
+
+    def used_keys(self, connection, keys):
+        """Returns the set of `keys' some item is already stored under."""
+        keys = list(keys)
+        used = set()
+        for start in range(0, len(keys), SQLITE_MAX_PARAMETERS):
+            chunk = keys[start:start + SQLITE_MAX_PARAMETERS]
+            statement = self.SELECT_USED_IDS % ", ".join("?" * len(chunk))
+            used.update(row[0] for row in connection.execute(statement,
+                                                             chunk))
+        return used
+
+    def store_many(self, items):
+        """Stores `items' in a single transaction.
+
+        Items that cannot be encoded, or were assigned an id already used,
+        get None and are left out of it."""
+        ids = []
+        rows = collections.OrderedDict()
+        assigned = set()
+        for item in items:
+            if isinstance(item.get(ASSIGNED_ID_KEY), ObjectId):
+                assigned.add(item[ASSIGNED_ID_KEY].binary)
+            try:
+                row = self.row(item)
+            except BSONError:
+                ids.append(None)
+                continue
+            if row[0] in rows:
+                ids.append(None)
+                continue
+            ids.append(item[ID_KEY])
+            rows[row[0]] = (row, item)
+        if rows:
+            with self.transaction() as connection:
+                # Only assigned ids can be, new ones are unique
+                for key in self.used_keys(connection, assigned):
+                    rows.pop(key, None)
+                connection.executemany(self.INSERT, (
+                    row for row, _ in rows.values()))
+                visible = [(key, item) for key, (row, item) in rows.items()
+                           if row[1]]
+                for key, item in visible:
+                    self.index(connection, key, item)
+                if visible:
+                    connection.execute(self.BUMP_GENERATION)
+        return [item_id if item_id is not None and item_id.binary in rows
+                else None for item_id in ids]
+
+    def fetch(self, statement, item_id):
+        """Returns the only column of the item's row, or None."""
+        key = self.key(item_id)
+        if key is None:
+            return None
+        row = self.connection().execute(statement, (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def retrieve(self, item_id):
+        item = self.fetch(self.SELECT_ITEM, item_id)
+        return None if item is None else BSON(item).decode()
+
+    def retrieve_many(self, item_ids):
+        """Fetches items with IN queries of up to SQLITE_MAX_PARAMETERS
+        ids each."""
+        keys = [self.key(item_id) for item_id in item_ids]
+        wanted = list(set(key for key in keys if key is not None))
+        found = {}
+        connection = self.connection()
+        for start in range(0, len(wanted), SQLITE_MAX_PARAMETERS):
+            chunk = wanted[start:start + SQLITE_MAX_PARAMETERS]
+            statement = self.SELECT_ITEMS % ", ".join("?" * len(chunk))
+            found.update(connection.execute(statement, chunk))
+        return [BSON(found[key]).decode() if key in found else None
+                for key in keys]
+
+    def etag(self, item_id):
+        return self.fetch(self.SELECT_ETAG, item_id)
+
+    def list_version(self):
+        return self.connection().execute(self.SELECT_GENERATION).fetchone()[0]
+
+    def all_ids(self):
+        return [ObjectId(row[0]) for row in
+                self.connection().execute(self.SELECT_IDS)]
+
+    def remove(self, item_id):
+        key = self.key(item_id)
+        if key is None:
+            return False
+        with self.transaction() as connection:
+            row = connection.execute(self.SELECT_VISIBLE, (key,)).fetchone()
+            if row is None:
+                return False
+            connection.execute(self.DELETE, (key,))
+            if row[0]:
+                family, continents = filter_values(BSON(row[1]).decode())
+                if family is not None:
+                    connection.execute(self.DELETE_FAMILY, (family, key))
+                connection.executemany(
+                    self.DELETE_CONTINENT,
+                    ((continent, key) for continent in continents))
+                connection.execute(self.BUMP_GENERATION)
+        return True
+
+    def list_query(self, start, limit, family, continent):
+        """Returns statement and parameters listing matching ids."""
+        limit = -1 if limit is None else limit
+        if family is not None and continent is not None:
+            return self.LIST_BOTH, (continent, family, start, limit)
+        elif family is not None:
+            return self.LIST_FAMILY, (family, start, limit)
+        elif continent is not None:
+            return self.LIST_CONTINENT, (continent, start, limit)
+        return self.LIST, (start, limit)
+
+    def list(self, after = None, limit = None, family = None,
+             continent = None):
+        """Generates visible ids from the partial index, or the filter
+        tables, in id order."""
+        start = b"" if after is None else self.key(after)
+        if start is None:
+            return
+        cursor = self.connection().execute(
+            *self.list_query(start, limit, family, continent))
+        for row in cursor:
+            yield ObjectId(row[0])
+
+    def query_plan(self, statement, parameters):
+        """Returns details of the plan SQLite picked for the statement."""
+        return [row[-1] for row in self.connection().execute(
+            "EXPLAIN QUERY PLAN " + statement, parameters)]
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+        self.local = threading.local()
+
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_CACHE_TTL = 60.0
+LIST_CACHE_SIZE = 16
+
+# Cached answer for items known not to exist
+_MISSING = object()
+
+class CachingStorage(StorageEngine):
+    """Read-through cache in front of another storage engine.
+
+    Retrieved items, including the ones found missing, are kept in a least
+    recently used cache of at most `size' entries, each for at most `ttl'
+    seconds. Storing or removing items through the cache invalidates what
+    it knew about them. Listings are cached too, under the list version of
+    the engine, so they are never older than the version, and a change of
+    the list made elsewhere, by other processes sharing the database, is
+    seen by the next listing. Changes of items made elsewhere are only
+    seen once their entries expire.
+
+    Hits, misses and evictions are counted in the attributes of the same
+    names."""
+
+    def __init__(self, engine, size = DEFAULT_CACHE_SIZE,
+                 ttl = DEFAULT_CACHE_TTL, clock = time.monotonic):
+        self.engine = engine
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.items = collections.OrderedDict()
+        self.lists = collections.OrderedDict()
+        self.version = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        """Returns dictionary of the cache counters."""
+        with self.lock:
+            return {"hits" : self.hits,
+                    "misses" : self.misses,
+                    "evictions" : self.evictions,
+                    "size" : len(self.items)}
+
+    def lookup(self, cache, key):
+        """Returns cached value, or None if there is no fresh one."""
+        with self.lock:
+            entry = cache.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > self.clock():
+                    cache.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del cache[key]
+            self.misses += 1
+            return None
+
+    def insert(self, cache, key, value, limit, version):
+        """Caches value read from the engine at given cache version.
+
+        Nothing is cached if a write happened since then, because the
+        value may or may not reflect it."""
+        with self.lock:
+            if version != self.version:
+                return
+            cache[key] = (self.clock() + self.ttl, value)
+            cache.move_to_end(key)
+            while len(cache) > limit:
+                cache.popitem(last = False)
+                self.evictions += 1
+
+    def invalidate(self, item_ids):
+        with self.lock:
+            for item_id in item_ids:
+                self.items.pop(self.parse_oid(item_id), None)
+            self.version += 1
+            self.lists.clear()
+
+    def store(self, item):
+        item_id = self.engine.store(item)
+        self.invalidate([item_id])
+        return item_id
+
+    def store_many(self, items):
+        ids = self.engine.store_many(items)
+        self.invalidate(item_id for item_id in ids if item_id is not None)
+        return ids
+
+    def retrieve(self, item_id):
+        key = self.parse_oid(item_id)
+        item = self.lookup(self.items, key)
+        if item is None:
+            version = self.version
+            item = self.engine.retrieve(item_id)
+            if item is None:
+                item = _MISSING
+            self.insert(self.items, key, item, self.size, version)
+        if item is _MISSING:
+            return None
+        return copy_item(item)
+
+    def retrieve_many(self, item_ids):
+        """Retrieves cached items, and the rest with a single call to the
+        engine."""
+        keys = [self.parse_oid(item_id) for item_id in item_ids]
+        items = [self.lookup(self.items, key) for key in keys]
+        missing = [index for index, item in enumerate(items) if item is None]
+        if missing:
+            version = self.version
+            fetched = self.engine.retrieve_many(
+                [item_ids[index] for index in missing])
+            for index, item in zip(missing, fetched):
+                if item is None:
+                    item = _MISSING
+                items[index] = item
+                self.insert(self.items, keys[index], item, self.size,
+                            version)
+        return [None if item is _MISSING else copy_item(item)
+                for item in items]
+
+    def remove(self, item_id):
+        try:
+            return self.engine.remove(item_id)
+        finally:
+            self.invalidate([item_id])
+
+    def etag(self, item_id):
+        with self.lock:
+            entry = self.items.get(self.parse_oid(item_id))
+        if entry is not None and entry[0] > self.clock():
+            item = entry[1]
+            return None if item is _MISSING else item_etag(item)
+        return self.engine.etag(item_id)
+
+    def list_version(self):
+        # Not cached, the version is what tells others' writes apart
+        return self.engine.list_version()
+
+    def all_ids(self):
+        return self.engine.all_ids()
+
+    def list(self, after = None, limit = None, family = None,
+             continent = None):
+        # The version tells whoever made it from list_version which list
+        # this is
+        key = (self.engine.list_version(), self.parse_oid(after), limit,
+               family, continent)
+        ids = self.lookup(self.lists, key)
+        if ids is None:
+            version = self.version
+            ids = tuple(self.engine.list(after, limit, family, continent))
+            self.insert(self.lists, key, ids, LIST_CACHE_SIZE, version)
+        return iter(ids)
+
+    def changes_since(self, token = None, limit = None, wait = 0):
+        # Not cached, followers of the feed want the latest changes
+        return self.engine.changes_since(token, limit, wait)
+
+
+DEFAULT_COALESCE_BATCH_SIZE = 100
+DEFAULT_COALESCE_WINDOW = 0.002
+
+class PendingWrite(object):
+    """Item waiting in a CoalescingStorage queue, and what came of it."""
+
+    __slots__ = ("item", "queued", "done", "item_id", "error")
+
+    def __init__(self, item, queued):
+        self.item = item
+        self.queued = queued
+        self.done = False
+        self.item_id = None
+        self.error = None
+
+
+class CoalescingStorage(StorageEngine):
+    """Stores items of concurrent store calls together.
+
+    Calls to store queue their item and wait. The first of them to find
+    nobody flushing the queue takes up to `batch_size' items from it, once
+    there are that many or the oldest one has waited `window' seconds, and
+    stores them with a single store_many call to the engine. Items queued
+    meanwhile wait for that to finish, and are stored by one of their own
+    callers in the next batch. Every call gets the id of its own item, or
+    the error that storing it raised. An item the batch could not store is
+    stored once more on its own, so its caller gets the actual error.
+
+    Everything else goes straight to the engine. Writes only wait for each
+    other, so lone writes cost up to `window' of added latency."""
+
+    def __init__(self, engine, batch_size = DEFAULT_COALESCE_BATCH_SIZE,
+                 window = DEFAULT_COALESCE_WINDOW, clock = time.monotonic):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.window = window
+        self.clock = clock
+        self.queue = []
+        self.flushing = False
+        self.condition = threading.Condition()
+
+    def store(self, item):
+        # Engines take it out of the item, which storing it again needs
+        assigned = item.get(ASSIGNED_ID_KEY)
+        with self.condition:
+            write = PendingWrite(item, self.clock())
+            self.queue.append(write)
+            if len(self.queue) >= self.batch_size:
+                self.condition.notify_all()
+            while not write.done:
+                if self.flushing:
+                    self.condition.wait()
+                    continue
+                self.flushing = True
+                try:
+                    batch = self.next_batch()
+                    self.condition.release()
+                    try:
+                        self.flush(batch)
+                    finally:
+                        self.condition.acquire()
+                finally:
+                    self.flushing = False
+                    self.condition.notify_all()
+        if write.error is not None:
+            raise write.error
+        if write.item_id is None:
+            if assigned is not None:
+                item[ASSIGNED_ID_KEY] = assigned
+            return self.engine.store(item)
+        return write.item_id
+
+    def next_batch(self):
+        """Waits for a full batch or the window of the oldest write to pass,
+        then takes the batch off the queue. Must be called with the
+        condition held."""
+        while len(self.queue) < self.batch_size:
+            remaining = self.queue[0].queued + self.window - self.clock()
+            if remaining <= 0:
+                break
+            self.condition.wait(remaining)
+        batch = self.queue[:self.batch_size]
+        del self.queue[:self.batch_size]
+        return batch
+
+    def flush(self, batch):
+        """Stores the batch, filling in the outcome of every write in it."""
+        try:
+            ids = self.engine.store_many([write.item for write in batch])
+        except Exception as ex:
+            for write in batch:
+                write.error = ex
+                write.done = True
+            return
+        for write, item_id in zip(batch, ids):
+            write.item_id = item_id
+            write.done = True
+
+    def store_many(self, items):
+        return self.engine.store_many(items)
+
+    def retrieve(self, item_id):
+        return self.engine.retrieve(item_id)
+
+    def retrieve_many(self, item_ids):
+        return self.engine.retrieve_many(item_ids)
+
+    def remove(self, item_id):
+        return self.engine.remove(item_id)
+
+    def etag(self, item_id):
+        return self.engine.etag(item_id)
+
+    def list_version(self):
+        return self.engine.list_version()
+
+    def all_ids(self):
+        return self.engine.all_ids()
+
+    def list(self, after = None, limit = None, family = None,
+             continent = None):
+        return self.engine.list(after, limit, family, continent)
+
+    def changes_since(self, token = None, limit = None, wait = 0):
+        return self.engine.changes_since(token, limit, wait)
+
+
+class DeferredStorage(StorageEngine):
+    """Storage engine only opened when it is first used.
+
+    `open_engine' is called without arguments by the first storage call,
+    and returns the engine that one and all the later calls go to. Until
+    then nothing is connected to, so starting up costs nothing and the
+    first request pays for it instead. If opening fails, the call raises
+    and the next one tries again."""
+
+    def __init__(self, open_engine):
+        self.open_engine = open_engine
+        self.opened = None
+        self.lock = threading.Lock()
+
+    @property
+    def engine(self):
+        engine = self.opened
+        if engine is None:
+            with self.lock:
+                if self.opened is None:
+                    self.opened = self.open_engine()
+                engine = self.opened
+        return engine
+
+    def store(self, item):
+        return self.engine.store(item)
+
+    def store_many(self, items):
+        return self.engine.store_many(items)
+
+    def retrieve(self, item_id):
+        return self.engine.retrieve(item_id)
+
+    def retrieve_many(self, item_ids):
+        return self.engine.retrieve_many(item_ids)
+
+    def remove(self, item_id):
+        return self.engine.remove(item_id)
+
+    def etag(self, item_id):
+        return self.engine.etag(item_id)
+
+    def list_version(self):
+        return self.engine.list_version()
+
+    def all_ids(self):
+        return self.engine.all_ids()
+
+    def list(self, after = None, limit = None, family = None,
+             continent = None):
+        return self.engine.list(after, limit, family, continent)
+
+    def changes_since(self, token = None, limit = None, wait = 0):
+        return self.engine.changes_since(token, limit, wait)
+
+
+DEFAULT_OPERATION_TIMEOUT = 5.0
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 10.0
+DEFAULT_GUARD_WORKERS = 32
+DEFAULT_GUARD_PAGE_SIZE = 1000
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half-open"
+
+# Errors meaning storage answered, just not what was hoped for
+ANSWERED_ERRORS = (ValueError, ChangesExpired, NotImplementedError)
+
+class StorageTimeout(Exception):
+    """Storage operation did not finish in the time it was given."""
+
+class CircuitOpen(Exception):
+    """Storage was not even asked, because it has been failing.
+
+    `retry_after' is seconds until it will be asked again."""
+
+    def __init__(self, retry_after):
+        super(CircuitOpen, self).__init__(
+            "Storage circuit open, retrying in %.1f s" % retry_after)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    """Keeps calls away from something that keeps failing.
+
+    The circuit starts closed, letting every call through. After
+    `failure_threshold' failures in a row it opens, and calls fail right
+    away for `reset_timeout' seconds. Then it is half open: the first call
+    goes through as a probe, while the others keep failing, and closes the
+    circuit again if it succeeds or opens it for another `reset_timeout'
+    if it fails.
+
+    Calls let through get a ticket to report how they went with. Reports
+    of calls let through before the circuit last changed state are
+    ignored, so a slow call from before it opened can neither close it
+    nor keep it open longer. Safe to share between threads."""
+
+    def __init__(self, failure_threshold = DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout = DEFAULT_RESET_TIMEOUT,
+                 clock = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = CIRCUIT_CLOSED
+        # Counts changes of state, tickets are the count they were given at
+        self.changes = 0
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def change(self, state):
+        self.state = state
+        self.changes += 1
+        self.probing = False
+
+    def allow(self):
+        """Returns ticket of a call going through now, or raises
+        CircuitOpen if it may not."""
+        with self.lock:
+            if self.state == CIRCUIT_CLOSED:
+                return self.changes
+            remaining = self.opened + self.reset_timeout - self.clock()
+            if self.state == CIRCUIT_OPEN and remaining <= 0:
+                self.change(CIRCUIT_HALF_OPEN)
+            if self.state == CIRCUIT_HALF_OPEN and not self.probing:
+                self.probing = True
+                return self.changes
+            raise CircuitOpen(max(remaining, 0.0))
+
+    def succeeded(self, ticket):
+        with self.lock:
+            if ticket != self.changes:
+                return
+            self.failures = 0
+            if self.state == CIRCUIT_HALF_OPEN:
+                self.change(CIRCUIT_CLOSED)
+
+    def failed(self, ticket):
+        with self.lock:
+            if ticket != self.changes:
+                return
+            self.failures += 1
+            if (self.state == CIRCUIT_HALF_OPEN or
+                    self.failures >= self.failure_threshold):
+                self.change(CIRCUIT_OPEN)
+                self.opened = self.clock()
+
+
+class GuardedStorage(StorageEngine):
+    """Passes calls on to another storage engine, giving up on the ones
+    that take too long, and on the engine while it keeps failing.
+
+    Calls run in a pool of `workers' threads, and the caller waits for at
+    most `timeout' seconds, or what `timeouts' gives for the name of the
+    operation, before StorageTimeout is raised. A call left running keeps
+    its pool thread until the engine returns, and calls waiting for a
+    thread count that against their timeout, so a stalled engine costs
+    callers no more than the timeout. Listing fetches `page_size'
+    identifiers at a time, each page a call of its own. Waiting for
+    changes asks for them every CHANGES_POLL_INTERVAL seconds without
+    waiting, and sleeps in the caller's thread in between, so followers
+    of the feed do not keep pool threads from other calls.
+
+    Timeouts and other errors, but not ones meaning the engine answered,
+    count as failures of a CircuitBreaker. While it is open, calls raise
+    CircuitOpen without reaching the engine."""
+
+    def __init__(self, engine, timeout = DEFAULT_OPERATION_TIMEOUT,
+                 timeouts = None,
+                 failure_threshold = DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout = DEFAULT_RESET_TIMEOUT,
+                 workers = DEFAULT_GUARD_WORKERS,
+                 page_size = DEFAULT_GUARD_PAGE_SIZE, clock = time.monotonic):
+        self.engine = engine
+        self.timeout = timeout
+        self.timeouts = dict(timeouts or {})
+        self.page_size = page_size
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout, clock)
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+
+    def guarded(self, operation, method, *args):
+        ticket = self.breaker.allow()
+        timeout = self.timeouts.get(operation, self.timeout)
+        future = self.executor.submit(method, *args)
+        try:
+            result = future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            # Not started yet, it need not be
+            future.cancel()
+            self.breaker.failed(ticket)
+            raise StorageTimeout("%s took longer than %.1f s" % (operation,
+                                                                 timeout))
+        except ANSWERED_ERRORS:
+            self.breaker.succeeded(ticket)
+            raise
+        except Exception:
+            self.breaker.failed(ticket)
+            raise
+        self.breaker.succeeded(ticket)
+        return result
+
+    def store(self, item):
+        return self.guarded("store", self.engine.store, item)
+
+    def store_many(self, items):
+        return self.guarded("store_many", self.engine.store_many, items)
+
+    def retrieve(self, item_id):
+        return self.guarded("retrieve", self.engine.retrieve, item_id)
+
+    def retrieve_many(self, item_ids):
+        return self.guarded("retrieve_many", self.engine.retrieve_many,
+                            item_ids)
+
+    def remove(self, item_id):
+        return self.guarded("remove", self.engine.remove, item_id)
+
+    def etag(self, item_id):
+        return self.guarded("etag", self.engine.etag, item_id)
+
+    def list_version(self):
+        return self.guarded("list_version", self.engine.list_version)
+
+    def all_ids(self):
+        return self.guarded("all_ids", self.engine.all_ids)
+
+    def fetch_page(self, after, limit, family, continent):
+        return list(self.engine.list(after, limit, family, continent))
+
+    def list(self, after = None, limit = None, family = None,
+             continent = None):
+        # Engines may not resume listing in another thread, so every page
+        # is a listing of its own
+        while limit is None or limit > 0:
+            page_size = (self.page_size if limit is None
+                         else min(limit, self.page_size))
+            page = self.guarded("list", self.fetch_page, after, page_size,
+                                family, continent)
+            yield from page
+            if len(page) < page_size:
+                return
+            after = page[-1]
+            if limit is not None:
+                limit -= len(page)
+
+    def changes_since(self, token = None, limit = None, wait = 0):
+        if token is None:
+            # No changes to wait for, just the current position
+            return self.guarded("changes_since", self.engine.changes_since,
+                                token, limit, 0)
+        deadline = time.monotonic() + wait
+        while True:
+            changes, token = self.guarded(
+                "changes_since", self.engine.changes_since, token, limit, 0)
+            remaining = deadline - time.monotonic()
+            if changes or remaining <= 0:
+                return changes, token
+            time.sleep(min(CHANGES_POLL_INTERVAL, remaining))
+
+    def close(self):
+        """Stops the pool, without waiting for calls left running."""
+        self.executor.shutdown(wait = False)
+
+
+class TimedStorage(StorageEngine):
+    """Passes calls on to another storage engine, timing them.
+
+    Durations go to the `storage_duration' histogram of `metrics', and
+    calls that raise are counted in its `storage_errors', both by the name
+    of the operation. Engines may fetch listed identifiers as they are
+    iterated through, so listing is timed from the first identifier asked
+    for to the last, including whatever the caller does in between.
+    Timing every identifier on its own would cost more than listing."""
+
+    def __init__(self, engine, metrics, clock = time.perf_counter):
+        self.engine = engine
+        self.metrics = metrics
+        self.clock = clock
+
+    def timed(self, operation, method, *args):
+        started = self.clock()
+        try:
+            return method(*args)
+        except Exception:
+            self.metrics.storage_errors.increment(operation)
+            raise
+        finally:
+            self.metrics.storage_duration.observe(self.clock() - started,
+                                                  operation)
+
+    def store(self, item):
+        return self.timed("store", self.engine.store, item)
+
+    def store_many(self, items):
+        return self.timed("store_many", self.engine.store_many, items)
+
+    def retrieve(self, item_id):
+        return self.timed("retrieve", self.engine.retrieve, item_id)
+
+    def retrieve_many(self, item_ids):
+        return self.timed("retrieve_many", self.engine.retrieve_many,
+                          item_ids)
+
+    def remove(self, item_id):
+        return self.timed("remove", self.engine.remove, item_id)
+
+    def etag(self, item_id):
+        return self.timed("etag", self.engine.etag, item_id)
+
+    def list_version(self):
+        return self.timed("list_version", self.engine.list_version)
+
+    def all_ids(self):
+        return self.timed("all_ids", self.engine.all_ids)
+
+    def list(self, after = None, limit = None, family = None,
+             continent = None):
+        started = self.clock()
+        try:
+            yield from self.engine.list(after, limit, family, continent)
+        except Exception:
+            self.metrics.storage_errors.increment("list")
+            raise
+        finally:
+            self.metrics.storage_duration.observe(self.clock() - started,
+                                                  "list")
+
+    def changes_since(self, token = None, limit = None, wait = 0):
+        return self.timed("changes_since", self.engine.changes_since, token,
+                          limit, wait)
+
+
+DEFAULT_SHARD_WORKERS = 16
+DEFAULT_SHARD_PAGE_SIZE = 1000
+DEFAULT_REBALANCE_BATCH_SIZE = 1000
+
+def shard_weight(item_id, shard):
+    """Returns weight of an ObjectId on the shard numbered `shard'."""
+    digest = hashlib.md5(item_id.binary + shard.to_bytes(4, "big")).digest()
+    return int.from_bytes(digest[:8], "big")
+
+def shard_of(item_id, count):
+    """Returns number of the shard, out of `count', an ObjectId belongs on.
+
+    The shard it weighs the most on wins, which is rendezvous hashing:
+    adding a shard only moves the items that now weigh the most on it,
+    about one in `count + 1', and moves them all onto it. It only depends
+    on the id, so every process agrees on it."""
+    return max(range(count), key = lambda shard: shard_weight(item_id, shard))
+
+
+class ShardedStorage(StorageEngine):
+    """Spreads items over several storage engines, the shards, by id.
+
+    Any engines will do, and any mix of them. Items are stored under an id
+    picked up front, on the shard it belongs on by shard_of, so retrieving
+    or removing them asks that shard alone. Storing many items stores each
+    shard's share of them at once, in a pool of `workers' threads.
+
+    Listing asks every shard for a page of at most `page_size' ids in the
+    pool, and merges them in id order. Without a limit, the next page of
+    each shard is fetched while the current one is merged. The list
+    version is made of the versions of all shards. Changes are not kept.
+
+    Adding a shard with add_shard makes new items belong on it right away,
+    and moves to it some of the existing ones, which are still on their
+    old shard until rebalance copies them over. Meanwhile, items missing
+    from the shard they belong on are looked for on their old shard too,
+    and removed from both. Processes that each have their own
+    ShardedStorage start as if the last of the `shards' was just added
+    given `adding', so that they can all look for items on the old shards
+    while one of them rebalances."""
+
+    def __init__(self, shards, workers = DEFAULT_SHARD_WORKERS,
+                 page_size = DEFAULT_SHARD_PAGE_SIZE, adding = False):
+        if len(shards) < (2 if adding else 1):
+            raise ValueError("Sharded storage needs at least one shard, "
+                             "besides the one being added")
+        # Shards, and how many there were before the last one was added
+        # until it has been rebalanced, replaced together
+        self.layout = (tuple(shards),
+                       len(shards) - 1 if adding else None)
+        self.page_size = page_size
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.lock = threading.Lock()
+
+    @property
+    def shards(self):
+        return self.layout[0]
+
+    def owners(self, item_id):
+        """Returns the shards an item may be on, the one it belongs on
+        first, and the one it belonged on before the last shard was added,
+        if it's still being moved from there."""
+        shards, previous = self.layout
+        item_id = self.parse_oid(item_id)
+        if not isinstance(item_id, ObjectId):
+            # Not an id anything is stored under, any shard can tell
+            return shards[:1]
+        owner = shard_of(item_id, len(shards))
+        if previous is None or owner < previous:
+            return shards[owner:owner + 1]
+        return (shards[owner], shards[shard_of(item_id, previous)])
+
+    def scatter(self, calls):
+        """Makes (function, arguments) calls in the pool, returning their
+        futures in the same order."""
+        return [self.executor.submit(function, *args)
+                for function, args in calls]
+
+    def gather(self, calls):
+        """Makes (function, arguments) calls in the pool, returning their
+        results in the same order."""
+        if len(calls) == 1:
+            function, args = calls[0]
+            return [function(*args)]
+        return [future.result() for future in self.scatter(calls)]
+
+    def find(self, method, item_id):
+        """Returns the first of what the method named `method' returns for
+        the item on the shards it may be on that isn't None."""
+        owners = self.owners(item_id)
+        result = getattr(owners[0], method)(item_id)
+        if result is None and len(owners) > 1:
+            result = getattr(owners[1], method)(item_id)
+            if result is None:
+                # Moved over meanwhile
+                result = getattr(owners[0], method)(item_id)
+        return result
+
+    @staticmethod
+    def assign_id(item):
+        item_id = item.get(ASSIGNED_ID_KEY)
+        if not isinstance(item_id, ObjectId):
+            item_id = item[ASSIGNED_ID_KEY] = ObjectId()
+        return item_id
+
+    def store(self, item):
+        return self.owners(self.assign_id(item))[0].store(item)
+
+    def store_many(self, items):
+        """Stores every shard's share of `items' at once. Items of a shard
+        that failed get None, unless all of them failed, which raises."""
+        items = list(items)
+        shards = self.shards
+        positions = collections.defaultdict(list)
+        for position, item in enumerate(items):
+            owner = shard_of(self.assign_id(item), len(shards))
+            positions[owner].append(position)
+        owners = list(positions)
+        futures = self.scatter([
+            (shards[owner].store_many,
+             ([items[position] for position in positions[owner]],))
+            for owner in owners])
+        ids = [None] * len(items)
+        errors = []
+        for owner, future in zip(owners, futures):
+            try:
+                stored = future.result()
+            except Exception as ex:
+                errors.append(ex)
+                continue
+            for position, item_id in zip(positions[owner], stored):
+                ids[position] = item_id
+        if errors and len(errors) == len(owners):
+            raise errors[0]
+        return ids
+
+    def retrieve(self, item_id):
+        return self.find("retrieve", item_id)
+
+    def retrieve_many(self, item_ids):
+        """Retrieves every shard's share of the items at once."""
+        item_ids = list(item_ids)
+        positions = collections.defaultdict(list)
+        for position, item_id in enumerate(item_ids):
+            positions[self.owners(item_id)[0]].append(position)
+        owners = list(positions)
+        results = self.gather([
+            (owner.retrieve_many,
+             ([item_ids[position] for position in positions[owner]],))
+            for owner in owners])
+        items = [None] * len(item_ids)
+        for owner, found in zip(owners, results):
+            for position, item in zip(positions[owner], found):
+                items[position] = item
+        if self.layout[1] is not None:
+            for position, item in enumerate(items):
+                if item is None:
+                    items[position] = self.retrieve(item_ids[position])
+        return items
+
+    def remove(self, item_id):
+        removed = False
+        for owner in self.owners(item_id):
+            removed = owner.remove(item_id) or removed
+        return removed
+
+    def etag(self, item_id):
+        return self.find("etag", item_id)
+
+    def list_version(self):
+        return ".".join(str(version) for version in self.gather(
+            [(shard.list_version, ()) for shard in self.shards]))
+
+    @staticmethod
+    def fetch(shard, after, limit, family, continent):
+        return list(shard.list(after, limit, family, continent))
+
+    def pages(self, shard, first, page_size, prefetch, family, continent):
+        """Generates ids a shard lists, starting from the `first' page,
+        fetching the next one meanwhile if `prefetch'."""
+        ids = first.result()
+        while len(ids) == page_size:
+            following = None
+            if prefetch:
+                following = self.executor.submit(
+                    self.fetch, shard, ids[-1], page_size, family, continent)
+            yield from ids
+            if following is not None:
+                ids = following.result()
+            else:
+                ids = self.fetch(shard, ids[-1], page_size, family,
+                                 continent)
+        yield from ids
+
+    def list(self, after = None, limit = None, family = None,
+             continent = None):
+        if after is not None:
+            after = self.parse_oid(after)
+        shards = self.shards
+        page_size = self.page_size if limit is None else min(limit,
+                                                             self.page_size)
+        firsts = self.scatter([(self.fetch, (shard, after, page_size, family,
+                                             continent))
+                               for shard in shards])
+        merged = heapq.merge(*[
+            self.pages(shard, first, page_size, limit is None, family,
+                       continent)
+            for shard, first in zip(shards, firsts)], key = sort_key)
+        listed = 0
+        previous = None
+        for item_id in merged:
+            # Copied to its new shard, not yet removed from the old one
+            if item_id == previous:
+                continue
+            yield item_id
+            previous = item_id
+            listed += 1
+            if listed == limit:
+                return
+
+    def all_ids(self):
+        ids = itertools.chain.from_iterable(self.gather(
+            [(shard.all_ids, ()) for shard in self.shards]))
+        return list(collections.OrderedDict.fromkeys(ids))
+
+    def add_shard(self, shard):
+        """Adds a shard. Items stored from now on may belong on it, and
+        some of those already stored too, which stay where they are until
+        rebalance moves them. Raises ValueError if the last shard added was
+        not rebalanced yet."""
+        with self.lock:
+            shards, previous = self.layout
+            if previous is not None:
+                raise ValueError("Rebalance before adding another shard")
+            self.layout = (shards + (shard,), len(shards))
+
+    def rebalance(self, batch_size = DEFAULT_REBALANCE_BATCH_SIZE):
+        """Moves items that belong on the shard added last onto it, up to
+        `batch_size' at a time, returning how many were moved.
+
+        Every batch is stored on the new shard before it is removed from
+        the old one, so an item is always on either. One removed meanwhile
+        is removed from the new shard as well. If a batch cannot be moved,
+        its error is raised and calling rebalance again picks up where it
+        stopped, leaving items it already copied as they are. Once
+        everything is moved, items are only looked for where they
+        belong."""
+        with self.lock:
+            shards, previous = self.layout
+            if previous is None:
+                return 0
+            target = shards[-1]
+            moved = 0
+            for source in shards[:previous]:
+                misplaced = [item_id for item_id in source.all_ids()
+                             if shard_of(item_id, len(shards)) == previous]
+                for start in range(0, len(misplaced), batch_size):
+                    moved += self.move(source, target,
+                                       misplaced[start:start + batch_size])
+            self.layout = (shards, None)
+            return moved
+
+    def move(self, source, target, item_ids):
+        """Moves items from shard `source' to `target', returning how many
+        there were to move."""
+        moving = []
+        copying = []
+        for item_id, item in zip(item_ids, source.retrieve_many(item_ids)):
+            if item is None:
+                # Removed meanwhile
+                continue
+            moving.append(item_id)
+            if target.etag(item_id) is not None:
+                # Copied by a rebalance interrupted before removing it
+                continue
+            item = copy_item(item)
+            item.pop(ID_KEY, None)
+            item[ASSIGNED_ID_KEY] = item_id
+            copying.append((item_id, item))
+        stored = target.store_many([item for _, item in copying])
+        for (item_id, _), stored_id in zip(copying, stored):
+            if stored_id is None:
+                raise RuntimeError("Could not move item %s" % item_id)
+        moved = 0
+        for item_id in moving:
+            if source.remove(item_id):
+                moved += 1
+            else:
+                target.remove(item_id)
+        return moved
+
+    def close(self):
+        self.executor.shutdown(wait = False)
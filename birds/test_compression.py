@@ -0,0 +1,160 @@
+"""Response compression tests"""
+
+import falcon.testing
+import json
+import time
+import unittest
+import zlib
+
+from . import app
+from . import compression
+from .storage import MemoryStorage
+from .test_storage import visible_item
+
+
+def decompress(data, coding):
+    return zlib.decompress(data, compression.WINDOW_BITS[coding])
+
+
+class NegotiateTest(unittest.TestCase):
+    def test_negotiate(self):
+        cases = [(None, None),
+                 ("", None),
+                 ("identity", None),
+                 ("gzip", "gzip"),
+                 ("deflate, gzip", "gzip"),
+                 ("DEFLATE", "deflate"),
+                 ("gzip;q=0, deflate;q=0.5", "deflate"),
+                 ("gzip; q=0.2, deflate; q=0.8", "deflate"),
+                 ("gzip;q=bogus", None),
+                 ("*", "gzip"),
+                 ("br, *;q=0", None),
+                 ("*;q=0.5, deflate", "deflate")]
+        for header, coding in cases:
+            self.assertEqual(compression.negotiate(header), coding, header)
+
+
+class CompressorTest(unittest.TestCase):
+    def test_round_trip(self):
+        data = b"birds " * 1000
+        for coding in compression.CODINGS:
+            compressor = compression.Compressor(coding, min_size = 10)
+            compressed = compressor.compress(data)
+            self.assertLess(len(compressed), len(data))
+            self.assertEqual(decompress(compressed, coding), data)
+            chunks = b"".join(compressor.compress_chunks([data, b"", data]))
+            self.assertEqual(decompress(chunks, coding), data + data)
+
+    def test_min_size(self):
+        compressor = compression.Compressor(compression.GZIP, min_size = 10)
+        self.assertIsNone(compressor.compress(b"x" * 9))
+        self.assertIsNotNone(compressor.compress(b"x" * 10))
+
+    def test_weak_etag(self):
+        self.assertEqual(compression.weak_etag('"a"'), 'W/"a"')
+        self.assertEqual(compression.weak_etag('W/"a"'), 'W/"a"')
+
+
+class CompressionMiddlewareTest(falcon.testing.TestCase):
+    def setUp(self):
+        super(CompressionMiddlewareTest, self).setUp()
+        self.storage = MemoryStorage()
+        self.api = app.setup(birds_storage = self.storage,
+                             with_metrics = False)
+        self.ids = [str(item_id) for item_id in self.storage.store_many(
+            [visible_item() for _ in range(100)])]
+
+    def get(self, path, coding = None, query_string = None, headers = None):
+        headers = dict(headers or {})
+        if coding is not None:
+            headers["Accept-Encoding"] = coding
+        return self.simulate_get(path, query_string = query_string,
+                                 headers = headers)
+
+    def test_list(self):
+        for coding in compression.CODINGS:
+            result = self.get("/birds", coding)
+            self.assertEqual(result.status_code, 200)
+            self.assertEqual(result.headers["content-encoding"], coding)
+            self.assertIn("Accept-Encoding", result.headers["vary"])
+            self.assertTrue(result.headers["etag"].startswith("W/"))
+            self.assertEqual(json.loads(decompress(
+                result.content, coding).decode("utf-8")), self.ids)
+
+    def test_not_accepted(self):
+        result = self.get("/birds")
+        self.assertNotIn("content-encoding", result.headers)
+        self.assertIn("Accept-Encoding", result.headers["vary"])
+        self.assertEqual(result.json, self.ids)
+        result = self.get("/birds", "identity")
+        self.assertNotIn("content-encoding", result.headers)
+        self.assertEqual(result.json, self.ids)
+
+    def test_small_body(self):
+        result = self.get("/birds/" + self.ids[0], compression.GZIP)
+        self.assertEqual(result.status_code, 200)
+        self.assertNotIn("content-encoding", result.headers)
+        # Weak all the same, like the tag of a 304 for it
+        self.assertTrue(result.headers["etag"].startswith("W/"))
+        self.assertFalse(self.get("/birds/" + self.ids[0]).headers[
+            "etag"].startswith("W/"))
+        self.assertEqual(result.json["id"], self.ids[0])
+        result = self.get("/birds", compression.GZIP,
+                          query_string = "limit=2")
+        self.assertNotIn("content-encoding", result.headers)
+        self.assertEqual(result.json, self.ids[:2])
+
+    def test_streamed(self):
+        result = self.get("/birds", compression.GZIP,
+                          query_string = "expand=true")
+        self.assertEqual(result.headers["content-encoding"],
+                         compression.GZIP)
+        birds = json.loads(decompress(result.content,
+                                      compression.GZIP).decode("utf-8"))
+        self.assertEqual([bird["id"] for bird in birds], self.ids)
+
+    def test_not_modified(self):
+        for path in ("/birds", "/birds/" + self.ids[0]):
+            etag = self.get(path, compression.GZIP).headers["etag"]
+            result = self.get(path, compression.GZIP,
+                              headers = {"If-None-Match" : etag})
+            self.assertEqual(result.status_code, 304)
+            self.assertEqual(result.headers["etag"], etag)
+
+    def test_list_cached(self):
+        page = "limit=%d" % len(self.ids)
+        first = self.get("/birds", compression.GZIP, page)
+        self.assertEqual(first.headers["content-encoding"], compression.GZIP)
+        self.storage.list = None
+        second = self.get("/birds", compression.GZIP, page)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.content, first.content)
+        # Each coding is cached on its own
+        self.assertEqual(self.get("/birds", query_string = page).status_code,
+                         503)
+        # Lists without a limit are streamed instead
+        self.assertEqual(self.get("/birds", compression.GZIP).status_code,
+                         503)
+
+    def test_not_cached_behind_caching_storage(self):
+        self.api = app.setup(birds_storage = self.storage,
+                             with_metrics = False, cache_size = 10,
+                             cache_ttl = 0.05)
+        page = "limit=%d" % (len(self.ids) + 1)
+        self.get("/birds", compression.GZIP, page)
+        # Stored by another process, so the caching storage keeps listing
+        # what it had until that expires
+        self.storage.store(visible_item())
+        self.get("/birds", compression.GZIP, page)
+        time.sleep(0.1)
+        result = self.get("/birds", compression.GZIP, page)
+        self.assertEqual(len(json.loads(decompress(
+            result.content, compression.GZIP).decode("utf-8"))),
+                         len(self.ids) + 1)
+
+def load_tests(loader, tests, pattern):
+    suite = unittest.TestSuite()
+    for test_class in (NegotiateTest, CompressorTest,
+                       CompressionMiddlewareTest):
+        suite.addTests(loader.loadTestsFromTestCase(test_class))
+    return suite
@@ -0,0 +1,61 @@
+"""JSON backend tests"""
+
+import falcon.testing
+import json
+import unittest
+
+from . import app
+from . import jsoncodec
+from .storage import MemoryStorage
+
+DOCUMENT = {"name" : "été \"/\"", "list" : [1, 2.5, True, None],
+            "nested" : {"empty" : []}}
+
+
+class BackendTest(unittest.TestCase):
+    def test_round_trip(self):
+        for name in jsoncodec.available():
+            encode, decode = jsoncodec.load(name)
+            encoded = encode(DOCUMENT)
+            self.assertIsInstance(encoded, bytes, name)
+            self.assertEqual(json.loads(encoded.decode("utf-8")), DOCUMENT,
+                             name)
+            self.assertEqual(decode(json.dumps(DOCUMENT).encode("utf-8")),
+                             DOCUMENT, name)
+
+    def test_invalid(self):
+        for name in jsoncodec.available():
+            _, decode = jsoncodec.load(name)
+            for data in (b"", b"{", b"[1,]", b'"\xff"'):
+                with self.assertRaises(ValueError, msg = name):
+                    decode(data)
+
+    def test_stdlib_always_available(self):
+        self.assertIn("json", jsoncodec.available())
+        self.assertEqual(jsoncodec.backend, jsoncodec.available()[0])
+
+
+class BackendResourcesTest(falcon.testing.TestCase):
+    def setUp(self):
+        super(BackendResourcesTest, self).setUp()
+        self.previous = jsoncodec.backend
+
+    def tearDown(self):
+        jsoncodec.use(self.previous)
+        super(BackendResourcesTest, self).tearDown()
+
+    def test_every_backend(self):
+        bird = {"name" : "Bird", "family" : "Birdies",
+                "continents" : ["Europe"], "visible" : True}
+        for name in jsoncodec.available():
+            jsoncodec.use(name)
+            self.api = app.setup(birds_storage = MemoryStorage())
+            result = self.simulate_post("/birds", body = json.dumps(bird))
+            self.assertEqual(result.status_code, 201, name)
+            bird_id = result.json["id"]
+            result = self.simulate_get("/birds/" + bird_id)
+            self.assertEqual(result.json["name"], "Bird", name)
+            self.assertEqual(self.simulate_get("/birds").json, [bird_id],
+                             name)
+            result = self.simulate_post("/birds", body = "{")
+            self.assertEqual(result.status_code, 400, name)
@@ -0,0 +1,159 @@
+"""Log storage engine tests"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from . import logstorage
+from .test_storage import StorageTest, visible_item, hidden_item
+
+
+class LogStorageTest(StorageTest):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.storage = self.open()
+
+    def tearDown(self):
+        if self.storage is not None:
+            self.storage.close()
+        shutil.rmtree(self.path)
+
+    def open(self, **kwargs):
+        kwargs.setdefault("compaction_interval", None)
+        return logstorage.LogStorage(self.path, **kwargs)
+
+    def reopen(self):
+        self.storage.close()
+        self.storage = self.open()
+
+    def segment_files(self):
+        return sorted(name for name in os.listdir(self.path)
+                      if logstorage.SEGMENT_NAME.match(name))
+
+    def test_reopen(self):
+        item = visible_item()
+        item_id = self.storage.store(item)
+        hidden_id = self.storage.store(hidden_item())
+        removed_id = self.storage.store(visible_item())
+        self.assertTrue(self.storage.remove(removed_id))
+        version = self.storage.list_version()
+        self.reopen()
+        self.assertEqual(self.storage.retrieve(item_id), item)
+        self.assertIsNotNone(self.storage.retrieve(hidden_id))
+        self.assertIsNone(self.storage.retrieve(removed_id))
+        self.assertEqual(self.list(), [item_id])
+        # Must not look like the list before the restart
+        self.assertNotEqual(self.storage.list_version(), version)
+
+    def test_torn_write(self):
+        ids = [self.storage.store(visible_item()) for _ in range(2)]
+        self.storage.close()
+        segment = os.path.join(self.path, self.segment_files()[-1])
+        size = os.path.getsize(segment)
+        with open(segment, "r+b") as log:
+            log.truncate(size - 3)
+        self.storage = self.open()
+        self.assertEqual(self.list(), ids[:1])
+        # Stores after the cut must survive the next restart
+        item_id = self.storage.store(visible_item())
+        self.reopen()
+        self.assertEqual(self.list(), [ids[0], item_id])
+
+    def test_corrupt_sealed_segment(self):
+        self.storage.close()
+        self.storage = self.open(segment_size = 1)
+        for _ in range(3):
+            self.storage.store(visible_item())
+        self.storage.close()
+        self.storage = None
+        with open(os.path.join(self.path, self.segment_files()[0]),
+                  "r+b") as log:
+            log.seek(10)
+            log.write(b"\xff")
+        with self.assertRaises(logstorage.CorruptLogError):
+            self.open()
+
+    def test_locked(self):
+        with self.assertRaises(RuntimeError):
+            self.open()
+
+    def test_compact(self):
+        ids = [self.storage.store(visible_item()) for _ in range(10)]
+        for item_id in ids[:8]:
+            self.assertTrue(self.storage.remove(item_id))
+        self.assertGreater(self.storage.garbage(), 0.5)
+        self.storage.compact()
+        self.assertLess(self.storage.garbage(), 0.1)
+        self.assertEqual(self.list(), ids[8:])
+        item_id = self.storage.store(visible_item())
+        self.assertEqual(len(self.segment_files()), 2)
+        self.reopen()
+        self.assertEqual(self.list(), ids[8:] + [item_id])
+        self.assertIsNone(self.storage.retrieve(ids[0]))
+        self.assertIsNotNone(self.storage.retrieve(ids[9]))
+
+    def crash_compaction(self, module, name):
+        """Compacts with `name' of `module' failing like a crash would."""
+        def crash(*args):
+            raise OSError("crashed")
+        original = getattr(module, name)
+        setattr(module, name, crash)
+        try:
+            with self.assertRaises(OSError):
+                self.storage.compact()
+        finally:
+            setattr(module, name, original)
+
+    def removed_in_older_segment(self):
+        """Stores birds in segments of their own and removes the first,
+        returning the ids of the rest."""
+        self.storage.close()
+        self.storage = self.open(segment_size = 1)
+        ids = [self.storage.store(visible_item()) for _ in range(3)]
+        self.assertTrue(self.storage.remove(ids[0]))
+        return ids[1:]
+
+    def test_crash_before_compaction_commit(self):
+        ids = self.removed_in_older_segment()
+        self.crash_compaction(logstorage.Segment, "sync")
+        self.reopen()
+        self.assertEqual(self.list(), ids)
+        self.assertFalse([name for name in os.listdir(self.path)
+                          if name.endswith(logstorage.COMPACTING_SUFFIX)])
+
+    def test_crash_after_compaction_commit(self):
+        ids = self.removed_in_older_segment()
+        self.crash_compaction(logstorage, "remove_file")
+        self.assertEqual(self.list(), ids)
+        self.reopen()
+        self.assertEqual(self.list(), ids)
+        self.assertEqual(len(self.segment_files()), 2)
+
+    def test_compaction_after_failed_compaction(self):
+        ids = self.removed_in_older_segment()
+        self.crash_compaction(logstorage, "remove_file")
+        self.assertTrue(self.storage.remove(ids[0]))
+        self.storage.compact()
+        self.assertEqual(logstorage.compacted_numbers(self.path), [])
+        self.reopen()
+        self.assertEqual(self.list(), ids[1:])
+
+    def test_background_compaction(self):
+        self.storage.close()
+        self.storage = self.open(compaction_interval = 0.01)
+        ids = [self.storage.store(visible_item()) for _ in range(4)]
+        for item_id in ids[:3]:
+            self.storage.remove(item_id)
+        for _ in range(500):
+            if len(self.segment_files()) > 1:
+                break
+            self.storage.stopping.wait(0.01)
+        self.storage.close()
+        self.storage = self.open()
+        self.assertLess(self.storage.garbage(), 0.5)
+        self.assertEqual(self.list(), ids[3:])
+
+
+def load_tests(loader, tests, pattern):
+    return loader.loadTestsFromTestCase(LogStorageTest)
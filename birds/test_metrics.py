@@ -0,0 +1,135 @@
+"""Metrics tests"""
+
+import falcon.testing
+import json
+import threading
+import unittest
+
+from . import app
+from . import metrics
+from .storage import MemoryStorage, TimedStorage
+from .test_storage import StorageTest, visible_item
+
+
+def parse(exposition):
+    """Returns dictionary of sample values by name and labels."""
+    samples = {}
+    for line in exposition.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+
+class RegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter(self):
+        counter = self.registry.counter("things_total", "Things.", ("kind",))
+        counter.increment("a")
+        counter.increment("a")
+        counter.increment('"b"')
+        exposition = self.registry.expose()
+        self.assertIn("# TYPE things_total counter", exposition)
+        samples = parse(exposition)
+        self.assertEqual(samples['things_total{kind="a"}'], 2)
+        self.assertEqual(samples['things_total{kind="\\"b\\""}'], 1)
+
+    def test_histogram(self):
+        histogram = self.registry.histogram("time_seconds", "Time.",
+                                            buckets = (0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        samples = parse(self.registry.expose())
+        self.assertEqual(samples['time_seconds_bucket{le="0.1"}'], 2)
+        self.assertEqual(samples['time_seconds_bucket{le="1.0"}'], 3)
+        self.assertEqual(samples['time_seconds_bucket{le="+Inf"}'], 4)
+        self.assertEqual(samples["time_seconds_count"], 4)
+        self.assertAlmostEqual(samples["time_seconds_sum"], 2.65)
+
+    def test_threads_added_up(self):
+        counter = self.registry.counter("things_total", "Things.")
+        threads = [threading.Thread(
+            target = lambda: [counter.increment() for _ in range(1000)])
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.increment()
+        self.assertEqual(parse(self.registry.expose())["things_total"], 4001)
+        self.assertEqual(len(self.registry.shards), 5)
+
+
+class FailingStorage(MemoryStorage):
+    def retrieve(self, item_id):
+        raise RuntimeError("Down")
+
+
+class TimedStorageTest(StorageTest):
+    def setUp(self):
+        self.metrics = metrics.BirdMetrics()
+        self.storage = TimedStorage(MemoryStorage(), self.metrics)
+
+    def test_timed(self):
+        item_id = self.storage.store(visible_item())
+        self.storage.retrieve(item_id)
+        self.assertEqual(self.list(), [item_id])
+        samples = parse(self.metrics.registry.expose())
+        for operation in ("store", "retrieve", "list"):
+            self.assertEqual(samples[
+                'birds_storage_duration_seconds_count{operation="%s"}' %
+                operation], 1)
+
+    def test_errors(self):
+        self.storage.engine = FailingStorage()
+        with self.assertRaises(RuntimeError):
+            self.storage.retrieve("whatever")
+        samples = parse(self.metrics.registry.expose())
+        self.assertEqual(
+            samples['birds_storage_errors_total{operation="retrieve"}'], 1)
+
+
+class RequestTimerTest(falcon.testing.TestCase):
+    def setUp(self):
+        super(RequestTimerTest, self).setUp()
+        self.api = app.setup(birds_storage = MemoryStorage())
+
+    def test_requests_counted(self):
+        bird = {"name" : "Bird", "family" : "Birdies",
+                "continents" : ["Europe"], "visible" : True}
+        result = self.simulate_post("/birds", body = json.dumps(bird))
+        self.assertEqual(result.status_code, 201)
+        self.simulate_get("/birds/" + result.json["id"])
+        self.simulate_get("/birds/" + "0" * 24)
+        self.simulate_get("/nowhere")
+
+        result = self.simulate_get("/metrics")
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.headers["content-type"], metrics.CONTENT_TYPE)
+        samples = parse(result.text)
+        self.assertEqual(samples[
+            'birds_requests_total{resource="BirdCollection",method="POST",'
+            'status="201"}'], 1)
+        self.assertEqual(samples[
+            'birds_requests_total{resource="BirdResource",method="GET",'
+            'status="200"}'], 1)
+        self.assertEqual(samples[
+            'birds_requests_total{resource="BirdResource",method="GET",'
+            'status="404"}'], 1)
+        self.assertEqual(samples[
+            'birds_requests_total{resource="none",method="GET",'
+            'status="404"}'], 1)
+        self.assertEqual(samples[
+            'birds_request_duration_seconds_count{resource="BirdResource",'
+            'method="GET"}'], 2)
+        self.assertEqual(samples[
+            'birds_storage_duration_seconds_count{operation="store"}'], 1)
+
+
+def load_tests(loader, tests, pattern):
+    suite = unittest.TestSuite()
+    for test_class in (RegistryTest, TimedStorageTest, RequestTimerTest):
+        suite.addTests(loader.loadTestsFromTestCase(test_class))
+    return suite
@@ -0,0 +1,97 @@
+"""Compact bird record tests"""
+
+from bson.objectid import ObjectId
+import json
+import unittest
+
+from . import records
+from . import resources
+
+A_BIRD = {
+    "id" : ObjectId(),
+    "name" : "A Fancy Bird",
+    "family" : "Birdies",
+    "continents" : ["Asia", "Europe"],
+    "added" : "1985-11-05",
+    "visible" : True,
+    "etag" : "0123456789abcdef0123456789abcdef01234567"
+}
+
+
+class BirdRecordTest(unittest.TestCase):
+    def assertRoundTrip(self, item):
+        record = records.BirdRecord(item)
+        self.assertEqual(dict(record.items()), item)
+        self.assertEqual(record, item)
+        self.assertEqual(len(record), len(item))
+        for key in item:
+            self.assertIn(key, record)
+        return record
+
+    def test_bird(self):
+        record = self.assertRoundTrip(A_BIRD)
+        self.assertIsNone(record.extra)
+        self.assertIsInstance(record.continents, int)
+        self.assertIsInstance(record.added, int)
+        self.assertTrue(record.is_visible())
+
+    def test_unusual_values(self):
+        bird = dict(A_BIRD)
+        bird["continents"] = ["Europe", "Asia", "Atlantis"]
+        bird["added"] = "last tuesday"
+        bird["etag"] = "not a hash"
+        bird["visible"] = False
+        record = self.assertRoundTrip(bird)
+        self.assertEqual(record.continents, ("Europe", "Asia", "Atlantis"))
+        self.assertEqual(record.added, "last tuesday")
+        self.assertEqual(record.extra, {"etag" : "not a hash"})
+        self.assertFalse(record.is_visible())
+
+    def test_other_items(self):
+        self.assertRoundTrip({})
+        self.assertRoundTrip({"key" : "value", "visible" : True})
+        self.assertRoundTrip({"name" : 42, "continents" : [1, 2],
+                              "added" : "2016-02-30", "nested" : {"a" : []}})
+        self.assertTrue(records.BirdRecord({"visible" : 1}).is_visible())
+
+    def test_missing(self):
+        record = records.BirdRecord({"visible" : False})
+        self.assertNotIn("name", record)
+        with self.assertRaises(KeyError):
+            record["name"]
+
+    def test_read_only(self):
+        item = {"list" : ["value"]}
+        record = records.BirdRecord(item)
+        item["list"].append("changed")
+        record["list"].append("changed")
+        self.assertEqual(record["list"], ["value"])
+        with self.assertRaises(TypeError):
+            record["list"] = []
+
+    def test_dump(self):
+        for continents in (["Asia", "Europe"], ["Europe", "Asia"], []):
+            bird = dict(A_BIRD, continents = continents)
+            record = records.BirdRecord(bird)
+            dumped = record.dump_json()
+            self.assertIsNotNone(dumped)
+            expected = resources.filter_dictionary(
+                bird, resources.EXPOSED_BIRD_ATTRIBUTES)
+            expected["id"] = str(expected["id"])
+            self.assertEqual(json.loads(dumped), expected)
+            self.assertEqual(json.loads(resources.dump_bird(record)),
+                             expected)
+
+    def test_encoded_once(self):
+        record = records.BirdRecord(A_BIRD)
+        encoded = resources.dump_bird(record)
+        self.assertEqual(encoded, record.dump_json().encode("ascii"))
+        self.assertIs(resources.dump_bird(record), encoded)
+
+    def test_dump_unusual(self):
+        record = records.BirdRecord(dict(A_BIRD, name = "été \""))
+        self.assertEqual(json.loads(record.dump_json())["name"],
+                         "été \"")
+        record = records.BirdRecord(dict(A_BIRD, name = 42))
+        self.assertIsNone(record.dump_json())
+        self.assertEqual(json.loads(resources.dump_bird(record))["name"], 42)
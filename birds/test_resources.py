@@ -1,15 +1,19 @@
 from bson.objectid import ObjectId
 from copy import deepcopy
 from jsonschema import validate, ValidationError
+import io
 import json
 import falcon.testing
 import time
 import unittest
 
+from . import app
 from .app import setup_routes
 from . import bird_schemas
 from . import resources
-from .storage import MemoryStorage, add_default_fields
+from .storage import (CircuitOpen, MemoryStorage, ShardedMemoryStorage,
+                      add_default_fields)
+from .test_storage import StallingStorage
 
 class FilderDictionaryTest(unittest.TestCase):
     def test_remove_extra(self):
@@ -30,6 +34,71 @@ class FilderDictionaryTest(unittest.TestCase):
         self.assertNotIn(allowed_key, d, "Didn't add allowed key?")
 
 
+class IterJsonArrayTest(unittest.TestCase):
+    def test_chunks(self):
+        for count in range(6):
+            items = [str(i) for i in range(count)]
+            body = b"".join(resources.iter_json_array(items, chunk_size = 2))
+            self.assertEqual(json.loads(body.decode("utf-8")), items)
+
+
+class CursorTest(unittest.TestCase):
+    def test_round_trip(self):
+        some_id = ObjectId()
+        cursor = resources.encode_cursor(some_id)
+        self.assertNotIn(str(some_id), cursor)
+        self.assertEqual(resources.decode_cursor(cursor), some_id)
+        self.assertEqual(resources.decode_cursor(
+            resources.encode_cursor(str(some_id))), some_id)
+
+    def test_invalid(self):
+        for cursor in ("", "!!!", "YWJj", "\u00e9t\u00e9"):
+            with self.assertRaises(ValueError):
+                resources.decode_cursor(cursor)
+
+
+class EtagMatchTest(unittest.TestCase):
+    def test_matches(self):
+        self.assertTrue(resources.etag_matches('"a"', '"a"'))
+        self.assertTrue(resources.etag_matches('"b", W/"a"', '"a"'))
+        self.assertTrue(resources.etag_matches(" * ", '"a"'))
+        self.assertFalse(resources.etag_matches('"b", "c"', '"a"'))
+        self.assertFalse(resources.etag_matches('a', '"a"'))
+
+
+class ListCacheTest(unittest.TestCase):
+    def test_versions(self):
+        cache = resources.ListCache()
+        self.assertIsNone(cache.get(1, "a"))
+        cache.put(1, "a", "first", 5)
+        self.assertEqual(cache.get(1, "a"), "first")
+        self.assertIsNone(cache.get(2, "a"))
+        cache.put(2, "b", "second", 6)
+        self.assertIsNone(cache.get(1, "a"))
+        self.assertEqual(cache.get(2, "b"), "second")
+        self.assertEqual(cache.size, 6)
+
+    def test_max_bytes(self):
+        cache = resources.ListCache(max_bytes = 10)
+        cache.put(1, "a", "a", 4)
+        cache.put(1, "b", "b", 4)
+        cache.get(1, "a")
+        cache.put(1, "c", "c", 4)
+        self.assertEqual(cache.get(1, "a"), "a")
+        self.assertIsNone(cache.get(1, "b"))
+        self.assertEqual(cache.get(1, "c"), "c")
+        cache.put(1, "d", "d", 11)
+        self.assertIsNone(cache.get(1, "d"))
+        self.assertEqual(cache.size, 8)
+
+
+class IterLinesTest(unittest.TestCase):
+    def test_split_across_chunks(self):
+        stream = io.BytesIO(b"first\nsecond line\n\nlast")
+        lines = list(resources.iter_lines(stream, chunk_size = 3))
+        self.assertEqual(lines, [b"first", b"second line", b"", b"last"])
+
+
 A_BIRD = {
     "name" : "A Fancy Bird",
     "family" : "Birdies",
@@ -74,17 +143,29 @@ class BirdResourcesTest(falcon.testing.TestCase):
     def setUpClass(cls):
         cls.bird_collection = resources.BirdCollection(MemoryStorage())
         cls.bird_resource = resources.BirdResource(MemoryStorage())
+        cls.bird_bulk = resources.BirdBulk(MemoryStorage(), batch_size = 2)
+        cls.bird_multi_get = resources.BirdMultiGet(MemoryStorage(),
+                                                    max_size = 3)
+        cls.bird_changes = resources.BirdChanges(MemoryStorage(),
+                                                 max_wait = 1.0)
 
     def setUp(self):
         super(BirdResourcesTest, self).setUp()
         # Reset "database"
         self.storage = MemoryStorage()
         BirdResourcesTest.bird_collection.storage = self.storage
+        BirdResourcesTest.bird_collection.list_cache = resources.ListCache()
         BirdResourcesTest.bird_resource.storage = self.storage
+        BirdResourcesTest.bird_bulk.storage = self.storage
+        BirdResourcesTest.bird_multi_get.storage = self.storage
+        BirdResourcesTest.bird_changes.storage = self.storage
 
         setup_routes(self.api,
                      BirdResourcesTest.bird_collection,
-                     BirdResourcesTest.bird_resource)
+                     BirdResourcesTest.bird_resource,
+                     BirdResourcesTest.bird_bulk,
+                     multi_get = BirdResourcesTest.bird_multi_get,
+                     changes = BirdResourcesTest.bird_changes)
 
     def test_empty_list(self):
         result = self.simulate_get("/birds")
@@ -108,6 +189,103 @@ class BirdResourcesTest(falcon.testing.TestCase):
         self.assertEqual(len(result.json), 1)
         self.assertEqual(result.json[0], str(bird["id"]))
 
+    def test_list_many_birds(self):
+        ids = self.storage.store_many(
+            [visible_bird() for _ in range(resources.LIST_CHUNK_SIZE + 1)])
+        result = self.simulate_get("/birds")
+        self.assertEqual(result.status_code, 200)
+        validate(result.json, bird_schemas.bird_list_schema)
+        self.assertEqual(result.json, list(map(str, ids)))
+
+    def test_list_outage(self):
+        def failing_list(*args, **kwargs):
+            raise RuntimeError("No rum")
+            yield
+        self.storage.list = failing_list
+        result = self.simulate_get("/birds")
+        self.assertEqual(result.status_code, 503)
+
+    def test_list_outage_retry_after(self):
+        def failing_version():
+            raise RuntimeError("No rum")
+        self.storage.list_version = failing_version
+        result = self.simulate_get("/birds")
+        self.assertEqual(result.headers["retry-after"],
+                         str(resources.OUTAGE_RETRY_AFTER))
+        def open_circuit():
+            raise CircuitOpen(2.5)
+        self.storage.list_version = open_circuit
+        result = self.simulate_get("/birds")
+        self.assertEqual(result.status_code, 503)
+        self.assertEqual(result.headers["retry-after"], "3")
+
+    def test_list_pages(self):
+        ids = self.storage.store_many([visible_bird() for _ in range(5)])
+        self.storage.store(default_bird())
+        pages = []
+        path = "/birds?limit=2"
+        while path is not None:
+            path, query = path.split("?")
+            result = self.simulate_get(path, query_string = query)
+            self.assertEqual(result.status_code, 200)
+            validate(result.json, bird_schemas.bird_list_schema)
+            pages.append(result.json)
+            cursor = result.headers.get(resources.NEXT_CURSOR_HEADER.lower())
+            path = None
+            if cursor is not None:
+                self.assertIn(cursor, result.headers["link"])
+                self.assertIn('rel=next', result.headers["link"])
+                path = "/birds?limit=2&after=" + cursor
+        self.assertEqual(pages, [list(map(str, ids[0:2])),
+                                 list(map(str, ids[2:4])),
+                                 [str(ids[4])]])
+
+    def test_list_after(self):
+        ids = self.storage.store_many([visible_bird() for _ in range(3)])
+        result = self.simulate_get(
+            "/birds",
+            query_string = "after=" + resources.encode_cursor(ids[0]))
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.json, list(map(str, ids[1:])))
+        self.assertNotIn("link", result.headers)
+
+    def test_list_filtered(self):
+        birds = [visible_bird() for _ in range(4)]
+        birds[1]["family"] = "Bird & Co"
+        birds[2]["continents"] = ["South America"]
+        ids = self.storage.store_many(birds)
+        result = self.simulate_get("/birds",
+                                   query_string = "family=Bird+%26+Co")
+        self.assertEqual(result.json, [str(ids[1])])
+        result = self.simulate_get(
+            "/birds", query_string = "family=Birdies&continent=Europe&limit=1")
+        self.assertEqual(result.json, [str(ids[0])])
+        link = result.headers["link"]
+        path, query = link[link.index("<") + 1:link.index(">")].split("?")
+        self.assertIn("family=Birdies", query)
+        self.assertIn("continent=Europe", query)
+        result = self.simulate_get(path, query_string = query)
+        self.assertEqual(result.json, [str(ids[3])])
+
+    def test_list_expanded(self):
+        birds = [visible_bird() for _ in range(3)]
+        ids = self.storage.store_many(birds)
+        result = self.simulate_get("/birds",
+                                   query_string = "expand=true&limit=2")
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual([bird["id"] for bird in result.json],
+                         list(map(str, ids[:2])))
+        for bird, stored in zip(result.json, birds):
+            validate(bird, bird_schemas.bird_output_schema)
+            self.compare_stored_bird(bird, stored)
+        self.assertIn("expand=true", result.headers["link"])
+
+    def test_list_bad_page_params(self):
+        for query in ("limit=0", "limit=bird", "after=not-a-cursor",
+                      "after=" + str(ObjectId())):
+            result = self.simulate_get("/birds", query_string = query)
+            self.assertEqual(result.status_code, 400, query)
+
     def test_add_simple_bird(self):
         bird = default_bird()
         result = self.simulate_post("/birds", body = json.dumps(bird))
@@ -165,6 +343,82 @@ class BirdResourcesTest(falcon.testing.TestCase):
         validate(stored_bird, bird_schemas.bird_output_schema)
         self.compare_stored_bird(stored_bird, bird)
 
+    def test_get_bird_etag(self):
+        bird = default_bird()
+        self.storage.store(add_default_fields(bird))
+        path = "/birds/" + str(bird["id"])
+        result = self.simulate_get(path)
+        self.assertEqual(result.status_code, 200)
+        etag = result.headers["etag"]
+
+        result = self.simulate_get(path, headers = {"If-None-Match" : etag})
+        self.assertEqual(result.status_code, 304)
+        self.assertEqual(result.headers["etag"], etag)
+        self.assertEqual(result.content, b"")
+
+        result = self.simulate_get(path,
+                                   headers = {"If-None-Match" : '"other"'})
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.headers["etag"], etag)
+
+    def test_missing_bird_etag(self):
+        result = self.simulate_get("/birds/" + str(ObjectId()),
+                                   headers = {"If-None-Match" : "*"})
+        self.assertEqual(result.status_code, 404)
+
+    def test_list_etag(self):
+        self.storage.store(visible_bird())
+        etag = self.simulate_get("/birds").headers["etag"]
+        result = self.simulate_get("/birds",
+                                   headers = {"If-None-Match" : etag})
+        self.assertEqual(result.status_code, 304)
+
+        # Hidden birds do not change the list
+        self.storage.store(default_bird())
+        result = self.simulate_get("/birds",
+                                   headers = {"If-None-Match" : etag})
+        self.assertEqual(result.status_code, 304)
+
+        self.storage.store(visible_bird())
+        result = self.simulate_get("/birds",
+                                   headers = {"If-None-Match" : etag})
+        self.assertEqual(result.status_code, 200)
+        self.assertNotEqual(result.headers["etag"], etag)
+        self.assertEqual(len(result.json), 2)
+
+    def test_list_cached(self):
+        ids = self.storage.store_many([visible_bird() for _ in range(3)])
+        page = {"query_string" : "limit=10"}
+        self.assertEqual(self.simulate_get("/birds", **page).json,
+                         list(map(str, ids)))
+        listed = []
+        def counting_list(*args, **kwargs):
+            listed.append(args)
+            return MemoryStorage.list(self.storage, *args, **kwargs)
+        self.storage.list = counting_list
+        self.assertEqual(self.simulate_get("/birds", **page).json,
+                         list(map(str, ids)))
+        self.assertEqual(listed, [])
+
+        # Hidden birds do not change the list
+        self.storage.store(default_bird())
+        self.simulate_get("/birds", **page)
+        self.assertEqual(listed, [])
+
+        ids.append(self.storage.store(visible_bird()))
+        self.assertEqual(self.simulate_get("/birds", **page).json,
+                         list(map(str, ids)))
+        self.assertEqual(len(listed), 1)
+        result = self.simulate_get("/birds", query_string = "limit=2")
+        self.assertEqual(result.json, list(map(str, ids[:2])))
+        self.assertEqual(len(listed), 2)
+
+        # Streamed, never kept whole
+        for _ in range(2):
+            self.assertEqual(self.simulate_get("/birds").json,
+                             list(map(str, ids)))
+        self.assertEqual(len(listed), 4)
+
     def test_delete_missing_bird(self):
         some_id = ObjectId()
         result = self.simulate_delete("/birds/" + str(some_id))
@@ -175,4 +429,190 @@ class BirdResourcesTest(falcon.testing.TestCase):
         self.storage.store(add_default_fields(bird))
         result = self.simulate_delete("/birds/" + str(bird["id"]))
         self.assertEqual(result.status_code, 200)
-        self.assertEqual(len(list(self.storage.list())), 0)
\ No newline at end of file
+        self.assertEqual(len(list(self.storage.list())), 0)
+
+    def bulk_birds(self):
+        invalid = visible_bird()
+        invalid["bogus-attribute"] = "Nope"
+        return [default_bird(), invalid, visible_bird(), old_bird(),
+                visible_bird()]
+
+    def check_bulk_result(self, result, birds):
+        self.assertEqual(result.status_code, 200)
+        validate(result.json, bird_schemas.bird_bulk_response_schema)
+        self.assertEqual(result.json["stored"], 4)
+        self.assertEqual(result.json["rejected"], 1)
+        items = result.json["items"]
+        self.assertEqual(len(items), len(birds))
+        self.assertIn("error", items[1])
+        for bird, item in zip(birds, items):
+            if "id" in item:
+                self.assertIsSubset(bird, self.storage.retrieve(item["id"]))
+        self.assertEqual(len(list(self.storage.list())), 2)
+
+    def test_bulk_array(self):
+        birds = self.bulk_birds()
+        result = self.simulate_post("/birds/_bulk", body = json.dumps(birds))
+        self.check_bulk_result(result, birds)
+
+    def test_bulk_ndjson(self):
+        birds = self.bulk_birds()
+        body = "\n".join(json.dumps(bird) for bird in birds) + "\n"
+        result = self.simulate_post(
+            "/birds/_bulk", body = body,
+            headers = {"Content-Type" : resources.NDJSON_MEDIA_TYPE})
+        self.check_bulk_result(result, birds)
+
+    def test_bulk_ndjson_malformed_line(self):
+        body = json.dumps(default_bird()) + "\n{not json\n"
+        result = self.simulate_post(
+            "/birds/_bulk", body = body,
+            headers = {"Content-Type" : resources.NDJSON_MEDIA_TYPE})
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.json["stored"], 1)
+        self.assertEqual(result.json["items"][1]["error"], "Malformed JSON")
+
+    def test_bulk_not_array(self):
+        result = self.simulate_post("/birds/_bulk",
+                                    body = json.dumps(default_bird()))
+        self.assertEqual(result.status_code, 400)
+
+    def test_multi_get(self):
+        birds = [visible_bird(), default_bird()]
+        ids = list(map(str, self.storage.store_many(birds)))
+        unknown = str(ObjectId())
+        result = self.simulate_post(
+            "/birds/_mget", body = json.dumps([ids[1], unknown, ids[0]]))
+        self.assertEqual(result.status_code, 200)
+        validate(result.json, bird_schemas.bird_mget_response_schema)
+        self.assertIsNone(result.json[1])
+        self.compare_stored_bird(result.json[0], birds[1])
+        self.compare_stored_bird(result.json[2], birds[0])
+
+    def test_multi_get_empty(self):
+        result = self.simulate_post("/birds/_mget", body = "[]")
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.json, [])
+
+    def test_multi_get_bad_ids(self):
+        for body in ('{"ids" : []}', "[1, 2]", '["a", "b", "c", "d"]', ""):
+            result = self.simulate_post("/birds/_mget", body = body)
+            self.assertEqual(result.status_code, 400, body)
+
+    def test_multi_get_outage(self):
+        def failing_retrieve_many(item_ids):
+            raise RuntimeError("No rum")
+        self.storage.retrieve_many = failing_retrieve_many
+        result = self.simulate_post("/birds/_mget",
+                                    body = json.dumps([str(ObjectId())]))
+        self.assertEqual(result.status_code, 503)
+
+    def test_changes(self):
+        token = self.simulate_get("/birds/changes").json["next"]
+        bird_id = self.simulate_post("/birds",
+                                     body = json.dumps(visible_bird())).json
+        bird_id = bird_id["id"]
+        self.simulate_delete("/birds/" + bird_id)
+        result = self.simulate_get("/birds/changes",
+                                   query_string = "since=" + token)
+        self.assertEqual(result.status_code, 200)
+        validate(result.json, bird_schemas.bird_changes_response_schema)
+        self.assertEqual(result.json["changes"], [
+            {"id" : bird_id, "change" : "insert", "visible" : True},
+            {"id" : bird_id, "change" : "delete", "visible" : True}])
+        result = self.simulate_get(
+            "/birds/changes",
+            query_string = "since=%s&wait=0.01" % result.json["next"])
+        self.assertEqual(result.json["changes"], [])
+
+    def test_changes_bad_params(self):
+        token = self.simulate_get("/birds/changes").json["next"]
+        for query_string in ("since=bogus", "since=%s&wait=2" % token,
+                             "since=%s&wait=-1" % token,
+                             "since=%s&wait=soon" % token,
+                             "since=%s&limit=0" % token):
+            result = self.simulate_get("/birds/changes",
+                                       query_string = query_string)
+            self.assertEqual(result.status_code, 400, query_string)
+
+    def test_changes_expired(self):
+        result = self.simulate_get("/birds/changes",
+                                   query_string = "since=%s-0" % ("f" * 8))
+        self.assertEqual(result.status_code, 410)
+
+    def test_changes_outage(self):
+        def failing_changes_since(token, limit, wait):
+            raise RuntimeError("No rum")
+        self.storage.changes_since = failing_changes_since
+        result = self.simulate_get("/birds/changes")
+        self.assertEqual(result.status_code, 503)
+
+    def test_bulk_empty(self):
+        result = self.simulate_post("/birds/_bulk", body = "[]")
+        self.assertEqual(result.status_code, 400)
+
+
+class OutageTest(falcon.testing.TestCase):
+    """Requests to an application with a stalled storage engine."""
+
+    TIMEOUT = 0.05
+
+    def setUp(self):
+        super(OutageTest, self).setUp()
+        self.storage = StallingStorage()
+        self.bird_id = str(self.storage.store(visible_bird()))
+        self.api = app.setup(birds_storage = self.storage,
+                             with_metrics = False,
+                             operation_timeout = self.TIMEOUT,
+                             failure_threshold = 3, reset_timeout = 60)
+
+    def tearDown(self):
+        self.storage.release()
+        self.api.close()
+        super(OutageTest, self).tearDown()
+
+    def test_fail_fast(self):
+        self.storage.stall()
+        latencies = []
+        for path in ["/birds", "/birds/" + self.bird_id] * 10:
+            started = time.monotonic()
+            result = self.simulate_get(path)
+            latencies.append(time.monotonic() - started)
+            self.assertEqual(result.status_code, 503)
+        self.assertLess(max(latencies), self.TIMEOUT + 0.5)
+        # The first three waited for the timeout, the rest for nothing
+        self.assertLess(max(latencies[3:]), self.TIMEOUT)
+        retry_after = int(result.headers["retry-after"])
+        self.assertTrue(0 < retry_after <= 60)
+
+        result = self.simulate_post("/birds",
+                                    body = json.dumps(visible_bird()))
+        self.assertEqual(result.status_code, 503)
+
+
+class SharedStorageTest(falcon.testing.TestCase):
+    """Two workers with caches of their own in front of the same engine."""
+
+    def setUp(self):
+        super(SharedStorageTest, self).setUp()
+        self.storage = ShardedMemoryStorage()
+        self.workers = [app.setup(birds_storage = self.storage,
+                                  with_metrics = False, cache_size = 100)
+                        for _ in range(2)]
+
+    def get_list(self, worker, headers = None):
+        self.api = self.workers[worker]
+        return self.simulate_get("/birds", headers = headers)
+
+    def test_list_stored_elsewhere(self):
+        first = self.get_list(0)
+        self.assertEqual(first.json, [])
+        self.api = self.workers[1]
+        bird_id = self.simulate_post("/birds", body = json.dumps(
+            visible_bird())).json["id"]
+        second = self.get_list(0)
+        self.assertEqual(second.json, [bird_id])
+        self.assertNotEqual(second.headers["etag"], first.headers["etag"])
+        result = self.get_list(0, {"If-None-Match" : first.headers["etag"]})
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.json, [bird_id])
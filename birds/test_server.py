@@ -0,0 +1,135 @@
+"""HTTP server tests"""
+
+import http.client
+import io
+import json
+import threading
+import unittest
+
+from . import app
+from . import server
+from .storage import MemoryStorage
+
+
+class RequestBodyTest(unittest.TestCase):
+    def test_bounded_read(self):
+        body = server.RequestBody(io.BytesIO(b"body\nnext request"), 5)
+        self.assertEqual(body.read(), b"body\n")
+        self.assertEqual(body.read(), b"")
+
+    def test_bounded_readline(self):
+        body = server.RequestBody(io.BytesIO(b"one\ntwo\nnext"), 8)
+        self.assertEqual(list(body), [b"one\n", b"two\n"])
+
+    def test_drain(self):
+        stream = io.BytesIO(b"unread body|next request")
+        body = server.RequestBody(stream, 12)
+        self.assertTrue(body.drain())
+        self.assertEqual(stream.read(), b"next request")
+
+    def test_too_much_to_drain(self):
+        body = server.RequestBody(io.BytesIO(), server.MAX_DRAIN + 1)
+        self.assertFalse(body.drain())
+
+
+class ChunkedRequestBodyTest(unittest.TestCase):
+    CHUNKED = b"4\r\none\n\r\n5;ext=1\r\ntwo\nt\r\n2\r\nhr\r\n0\r\n\r\nnext"
+
+    def test_read(self):
+        stream = io.BytesIO(self.CHUNKED)
+        body = server.ChunkedRequestBody(stream)
+        self.assertEqual(body.read(), b"one\ntwo\nthr")
+        self.assertEqual(body.read(), b"")
+        self.assertEqual(stream.read(), b"next")
+
+    def test_read_sized(self):
+        body = server.ChunkedRequestBody(io.BytesIO(self.CHUNKED))
+        self.assertEqual(body.read(6), b"one\ntw")
+        self.assertEqual(body.read(100), b"o\nthr")
+
+    def test_readline(self):
+        body = server.ChunkedRequestBody(io.BytesIO(self.CHUNKED))
+        self.assertEqual(list(body), [b"one\n", b"two\n", b"thr"])
+
+    def test_trailer_drained(self):
+        stream = io.BytesIO(b"3\r\nabc\r\n0\r\nX-Sum: 1\r\n\r\nnext")
+        body = server.ChunkedRequestBody(stream)
+        self.assertTrue(body.drain())
+        self.assertEqual(stream.read(), b"next")
+
+    def test_malformed(self):
+        body = server.ChunkedRequestBody(io.BytesIO(b"zz\r\nabc\r\n"))
+        self.assertEqual(body.read(), b"")
+        self.assertTrue(body.broken)
+        self.assertFalse(body.drain())
+        body = server.ChunkedRequestBody(io.BytesIO(b"9\r\nabc"))
+        self.assertEqual(body.read(), b"abc")
+        self.assertFalse(body.drain())
+
+
+class WorkerServerTest(unittest.TestCase):
+    def setUp(self):
+        listener = server.bind("127.0.0.1", 0, 8)
+        self.port = listener.getsockname()[1]
+        self.server = server.WorkerServer(
+            listener, app.setup(birds_storage = MemoryStorage()), 2, 1.0)
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.start()
+        self.connection = http.client.HTTPConnection("127.0.0.1", self.port)
+
+    def tearDown(self):
+        self.connection.close()
+        self.server.stop_accepting()
+        self.thread.join()
+        self.server.pool.shutdown(wait = True)
+        self.server.server_close()
+
+    def request(self, method, path, body = None):
+        self.connection.request(method, path, body = body)
+        response = self.connection.getresponse()
+        return response, response.read()
+
+    def test_keep_alive(self):
+        bird = {"name" : "Bird", "family" : "Birdies",
+                "continents" : ["Europe"], "visible" : True}
+        response, body = self.request("POST", "/birds", json.dumps(bird))
+        self.assertEqual(response.status, 201)
+        self.assertEqual(response.version, 11)
+        sock = self.connection.sock
+        self.assertIsNotNone(sock)
+
+        # Expanded birds are streamed, so they come in chunks
+        response, body = self.request("GET", "/birds?expand=true")
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("Transfer-Encoding"), "chunked")
+        self.assertEqual(len(json.loads(body.decode("utf-8"))), 1)
+        self.assertIs(self.connection.sock, sock)
+
+        response, body = self.request("GET", "/birds/" + "0" * 24)
+        self.assertEqual(response.status, 404)
+        self.assertIs(self.connection.sock, sock)
+
+    def test_unread_body(self):
+        # Nobody reads the body of a DELETE, it must not be parsed as
+        # the next request
+        response, _ = self.request("DELETE", "/birds/" + "0" * 24,
+                                   "GET /birds HTTP/1.1\r\n\r\n")
+        self.assertEqual(response.status, 404)
+        response, body = self.request("GET", "/birds")
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, b"[]")
+
+    def test_chunked_body(self):
+        bird = {"name" : "Bird", "family" : "Birdies",
+                "continents" : ["Europe"], "visible" : True}
+        data = json.dumps(bird).encode("utf-8")
+        self.connection.request("POST", "/birds",
+                                body = iter([data[:10], data[10:]]),
+                                encode_chunked = True)
+        response = self.connection.getresponse()
+        response.read()
+        self.assertEqual(response.status, 201)
+        sock = self.connection.sock
+        response, body = self.request("GET", "/birds")
+        self.assertEqual(len(json.loads(body.decode("utf-8"))), 1)
+        self.assertIs(self.connection.sock, sock)
@@ -0,0 +1,153 @@
+"""Snapshot tests"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from . import app
+from . import snapshot
+from . import storage
+from .test_storage import hidden_item, is_same_dictionary, visible_item
+
+
+def bird(family, continents, visible = True):
+    return {"name" : "Bird", "family" : family, "continents" : continents,
+            "visible" : visible, "extra" : {"nested" : [1, 2]}}
+
+
+class SnapshotTest(unittest.TestCase):
+    engine = storage.MemoryStorage
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "birds.snapshot")
+        self.storage = self.engine()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def restored(self):
+        self.storage.snapshot(self.path)
+        restored = self.engine()
+        restored.restore(self.path)
+        return restored
+
+    def test_round_trip(self):
+        items = [bird("Owls", ["Asia", "Europe"]), hidden_item(),
+                 bird("Ducks", ["Europe"]), bird("Owls", [], False)]
+        ids = self.storage.store_many(items)
+        restored = self.restored()
+        self.assertEqual(list(restored.list()), [ids[0], ids[2]])
+        self.assertEqual(list(restored.list(family = "Owls")), [ids[0]])
+        self.assertEqual(list(restored.list(continent = "Europe")),
+                         [ids[0], ids[2]])
+        for item_id, item in zip(ids, items):
+            self.assertTrue(is_same_dictionary(restored.retrieve(item_id),
+                                               item))
+            self.assertEqual(restored.etag(item_id),
+                             self.storage.etag(item_id))
+
+    def test_lazy(self):
+        item_id = self.storage.store(visible_item())
+        restored = self.restored()
+        self.assertIsInstance(self.stored(restored, item_id),
+                              snapshot.SnapshotRecord)
+        restored.retrieve(str(item_id))
+        self.assertNotIsInstance(self.stored(restored, item_id),
+                                 snapshot.SnapshotRecord)
+
+    def test_remove_undecoded(self):
+        ids = self.storage.store_many([bird("Owls", ["Asia"]),
+                                       bird("Owls", ["Asia"])])
+        restored = self.restored()
+        version = restored.list_version()
+        self.assertTrue(restored.remove(ids[0]))
+        self.assertNotEqual(restored.list_version(), version)
+        self.assertEqual(list(restored.list(continent = "Asia")), ids[1:])
+        self.assertIsNone(restored.retrieve(ids[0]))
+
+    def test_snapshot_of_restored(self):
+        item = bird("Owls", ["Asia"])
+        item_id = self.storage.store(item)
+        self.storage = self.restored()
+        restored = self.restored()
+        self.assertTrue(is_same_dictionary(restored.retrieve(item_id), item))
+        self.assertEqual(list(restored.list(family = "Owls")), [item_id])
+
+    def test_changes_expire(self):
+        _, token = self.storage.changes_since()
+        self.storage.store(visible_item())
+        self.storage.snapshot(self.path)
+        self.storage.restore(self.path)
+        with self.assertRaises(storage.ChangesExpired):
+            self.storage.changes_since(token)
+
+    def test_version_after_restore(self):
+        self.storage.store(visible_item())
+        version = self.storage.list_version()
+        self.storage.snapshot(self.path)
+        self.storage.restore(self.path)
+        self.assertNotEqual(self.storage.list_version(), version)
+        self.assertNotEqual(self.restored().list_version(),
+                            self.restored().list_version())
+
+    def test_damaged(self):
+        self.storage.store(visible_item())
+        self.storage.snapshot(self.path)
+        with open(self.path, "r+b") as damaged:
+            damaged.truncate(os.path.getsize(self.path) - 1)
+        with self.assertRaises(snapshot.SnapshotError):
+            self.engine().restore(self.path)
+        with open(self.path, "wb") as damaged:
+            damaged.write(b"Not a snapshot")
+        with self.assertRaises(snapshot.SnapshotError):
+            self.engine().restore(self.path)
+
+    def stored(self, engine, item_id):
+        return engine.database[item_id]
+
+
+class ShardedSnapshotTest(SnapshotTest):
+    engine = storage.ShardedMemoryStorage
+
+    def stored(self, engine, item_id):
+        return engine.shards[engine.stripe(item_id)][item_id]
+
+
+class SnapshotterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "birds.snapshot")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_only_changes_saved(self):
+        engine = storage.MemoryStorage()
+        snapshotter = snapshot.Snapshotter(engine, self.path, interval = 60)
+        snapshotter.save()
+        self.assertFalse(os.path.exists(self.path))
+        engine.store(visible_item())
+        snapshotter.save()
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_application(self):
+        engine = storage.ShardedMemoryStorage()
+        application = app.setup(birds_storage = engine,
+                                snapshot_path = self.path)
+        item_id = engine.store(visible_item())
+        application.close()
+
+        engine = storage.ShardedMemoryStorage()
+        application = app.setup(birds_storage = engine,
+                                snapshot_path = self.path)
+        self.assertEqual(list(engine.list()), [item_id])
+        application.close()
+
+
+def load_tests(loader, tests, pattern):
+    suite = unittest.TestSuite()
+    for test_class in (SnapshotTest, ShardedSnapshotTest, SnapshotterTest):
+        suite.addTests(loader.loadTestsFromTestCase(test_class))
+    return suite
@@ -1,7 +1,14 @@
 """Storage engine sanity tests"""
 
+from bson.objectid import ObjectId
 from pymongo import MongoClient
 import copy
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
 import time
 
@@ -45,6 +52,20 @@ class ComparisonTest(unittest.TestCase):
                                             {"key" : "valueB"}))
 
 
+class CopyItemTest(unittest.TestCase):
+    def test_nothing_shared(self):
+        item = {"id" : ObjectId(), "list" : [["nested"], {"a" : 1}],
+                "dict" : {"b" : [2]}, "tuple" : ([3],), "visible" : True}
+        copied = storage.copy_item(item)
+        self.assertEqual(copied, item)
+        self.assertIs(copied["id"], item["id"])
+        self.assertIsNot(copied["list"], item["list"])
+        self.assertIsNot(copied["list"][0], item["list"][0])
+        self.assertIsNot(copied["list"][1], item["list"][1])
+        self.assertIsNot(copied["dict"]["b"], item["dict"]["b"])
+        self.assertIsNot(copied["tuple"][0], item["tuple"][0])
+
+
 def visible_item():
     return copy.deepcopy(ITEM_VISIBLE)
 
@@ -110,12 +131,147 @@ class StorageTest(unittest.TestCase):
         self.assertTrue(
             is_same_dictionary(self.storage.retrieve(item_id), item))
 
+    def test_store_many(self):
+        items = [visible_item(), hidden_item(), visible_item()]
+        ids = self.storage.store_many(items)
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(len(set(ids)), 3)
+        for item_id, item in zip(ids, items):
+            self.assertTrue(is_same_dictionary(
+                self.storage.retrieve(item_id), item))
+        self.assertEqual(sorted(self.list()), sorted([ids[0], ids[2]]))
+
+    def test_retrieve_many(self):
+        items = [visible_item(), hidden_item()]
+        ids = self.storage.store_many(items)
+        found = self.storage.retrieve_many(
+            [str(ids[1]), ObjectId(), "not an id", ids[0], ids[1]])
+        self.assertEqual(len(found), 5)
+        self.assertIsNone(found[1])
+        self.assertIsNone(found[2])
+        self.assertTrue(is_same_dictionary(found[0], items[1]))
+        self.assertTrue(is_same_dictionary(found[3], items[0]))
+        self.assertTrue(is_same_dictionary(found[4], items[1]))
+        self.assertEqual(self.storage.retrieve_many([]), [])
+
+    def test_assigned_id(self):
+        item_id = ObjectId()
+        item = visible_item()
+        item[storage.ASSIGNED_ID_KEY] = item_id
+        self.assertEqual(self.storage.store(item), item_id)
+        self.assertTrue(is_same_dictionary(self.storage.retrieve(item_id),
+                                           item))
+        self.assertEqual(self.list(), [item_id])
+
+    def test_used_assigned_id(self):
+        item_id = self.storage.store(visible_item())
+        item = hidden_item()
+        item[storage.ASSIGNED_ID_KEY] = item_id
+        with self.assertRaises(ValueError):
+            self.storage.store(item)
+        new_id = ObjectId()
+        items = [hidden_item(), visible_item(), visible_item()]
+        for item, assigned in zip(items, [item_id, new_id, new_id]):
+            item[storage.ASSIGNED_ID_KEY] = assigned
+        self.assertEqual(self.storage.store_many(items), [None, new_id, None])
+        self.assertTrue(self.storage.retrieve(item_id)[storage.VISIBLE_KEY])
+        self.assertEqual(self.list(), [item_id, new_id])
+
+    def test_all_ids(self):
+        ids = self.storage.store_many([visible_item(), hidden_item()])
+        self.assertEqual(sorted(self.storage.all_ids()), sorted(ids))
+
+    def test_store_many_empty(self):
+        self.assertEqual(self.storage.store_many([]), [])
+
     def test_list(self):
         self.storage.store(hidden_item())
         visible_item_id = self.storage.store(visible_item())
         l = self.list()
         self.assertEqual(visible_item_id, l[0])
 
+    def test_list_pages(self):
+        ids = [self.storage.store(visible_item()) for _ in range(5)]
+        self.storage.store(hidden_item())
+        self.assertEqual(self.list(), ids)
+        self.assertEqual(list(self.storage.list(limit = 2)), ids[:2])
+        self.assertEqual(list(self.storage.list(after = ids[1], limit = 2)),
+                         ids[2:4])
+        self.assertEqual(list(self.storage.list(after = str(ids[3]))),
+                         ids[4:])
+        self.assertEqual(list(self.storage.list(after = ids[4])), [])
+
+    def test_list_after_removed(self):
+        ids = [self.storage.store(visible_item()) for _ in range(3)]
+        self.assertTrue(self.storage.remove(ids[1]))
+        self.assertEqual(list(self.storage.list(after = ids[1])), ids[2:])
+
+    def test_list_filtered(self):
+        def bird(family, continents, visible = True):
+            return {"family" : family, "continents" : continents,
+                    storage.VISIBLE_KEY : visible}
+        ids = self.storage.store_many([bird("Ducks", ["Europe", "Asia"]),
+                                       bird("Owls", ["Europe"]),
+                                       bird("Ducks", ["Africa"]),
+                                       bird("Ducks", ["Europe"], False),
+                                       bird("Ducks", ["Europe"])])
+        self.assertEqual(list(self.storage.list(family = "Ducks")),
+                         [ids[0], ids[2], ids[4]])
+        self.assertEqual(list(self.storage.list(continent = "Europe")),
+                         [ids[0], ids[1], ids[4]])
+        self.assertEqual(list(self.storage.list(family = "Ducks",
+                                                continent = "Europe")),
+                         [ids[0], ids[4]])
+        self.assertEqual(list(self.storage.list(after = ids[0], limit = 1,
+                                                family = "Ducks",
+                                                continent = "Europe")),
+                         [ids[4]])
+        self.assertEqual(list(self.storage.list(family = "Geese")), [])
+        self.assertTrue(self.storage.remove(ids[0]))
+        self.assertEqual(list(self.storage.list(continent = "Asia")), [])
+        self.assertEqual(list(self.storage.list(family = "Ducks",
+                                                continent = "Europe")),
+                         [ids[4]])
+
+    def test_etag(self):
+        item = visible_item()
+        item_id = self.storage.store(item)
+        etag = self.storage.etag(item_id)
+        self.assertIsNotNone(etag)
+        self.assertEqual(self.storage.etag(str(item_id)), etag)
+        self.assertEqual(storage.item_etag(self.storage.retrieve(item_id)),
+                         etag)
+        other_id = self.storage.store(hidden_item())
+        self.assertNotEqual(self.storage.etag(other_id), etag)
+        self.assertTrue(self.storage.remove(item_id))
+        self.assertIsNone(self.storage.etag(item_id))
+
+    def test_list_version(self):
+        version = self.storage.list_version()
+        self.storage.store(hidden_item())
+        self.assertEqual(self.storage.list_version(), version)
+        item_id = self.storage.store(visible_item())
+        stored_version = self.storage.list_version()
+        self.assertNotEqual(stored_version, version)
+        self.storage.store_many([visible_item()])
+        self.assertNotEqual(self.storage.list_version(), stored_version)
+        stored_version = self.storage.list_version()
+        self.assertTrue(self.storage.remove(item_id))
+        self.assertNotEqual(self.storage.list_version(), stored_version)
+
+    def test_retrieved_copy(self):
+        item = visible_item()
+        item["list"] = ["value"]
+        item_id = self.storage.store(item)
+        retrieved = self.storage.retrieve(item_id)
+        retrieved["list"].append("changed")
+        try:
+            retrieved["key"] = "changed"
+        except TypeError:
+            pass  # Read-only is just as good
+        self.assertTrue(is_same_dictionary(self.storage.retrieve(item_id),
+                                           item))
+
     def test_retrieve_missing(self):
         self.assertIsNone(self.storage.retrieve("I'm so random"))
 
@@ -128,6 +284,793 @@ class MemoryStorageTest(StorageTest):
     def setUp(self):
         self.storage = storage.MemoryStorage()
 
+    def test_versions_of_instances(self):
+        other = type(self.storage)()
+        self.assertNotEqual(other.list_version(), self.storage.list_version())
+
+
+class ShardedMemoryStorageTest(StorageTest):
+    def setUp(self):
+        self.storage = storage.ShardedMemoryStorage(stripes = 4)
+
+    def test_versions_of_instances(self):
+        other = storage.ShardedMemoryStorage(stripes = 4)
+        self.assertNotEqual(other.list_version(), self.storage.list_version())
+
+    def test_spread(self):
+        self.storage.store_many([visible_item() for _ in range(100)])
+        for shard in self.storage.shards:
+            self.assertGreater(len(shard), 0)
+        self.assertEqual(len(self.list()), 100)
+        self.assertEqual(self.list(), sorted(self.list()))
+
+    def test_concurrent_writes(self):
+        stored = [[] for _ in range(8)]
+        errors = []
+        stop = threading.Event()
+        def write(ids):
+            try:
+                for number in range(500):
+                    ids.append(self.storage.store(visible_item()))
+                    if number % 3 == 0:
+                        self.assertTrue(self.storage.remove(ids.pop(0)))
+            except Exception as ex:
+                errors.append(ex)
+        def read():
+            try:
+                while not stop.is_set():
+                    page = list(self.storage.list(limit = 50))
+                    self.assertEqual(page, sorted(set(page)))
+                    self.storage.list_version()
+            except Exception as ex:
+                errors.append(ex)
+        writers = [threading.Thread(target = write, args = (ids,))
+                   for ids in stored]
+        readers = [threading.Thread(target = read) for _ in range(2)]
+        for thread in writers + readers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        stop.set()
+        for thread in readers:
+            thread.join()
+        self.assertEqual(errors, [])
+        expected = sorted(item_id for ids in stored for item_id in ids)
+        self.assertEqual(self.list(), expected)
+        self.assertEqual(len(self.storage.visible.ids),
+                         sum(len(shard) for shard in self.storage.shards))
+
+
+class VisibleIndexTest(unittest.TestCase):
+    def test_build(self):
+        index = storage.VisibleIndex.build([(3, "Owls", {"Asia"}),
+                                            (1, "Owls", {"Asia", "Europe"}),
+                                            (2, None, {"Europe"})])
+        self.assertEqual(index.list(), [1, 2, 3])
+        self.assertEqual(index.list(family = "Owls"), [1, 3])
+        self.assertEqual(index.list(continent = "Europe", after = 1), [2])
+        self.assertEqual(index.list(family = "Owls", continent = "Asia",
+                                    limit = 1), [1])
+        self.assertEqual(index.list(family = "Owls", continent = "Europe",
+                                    after = 1), [])
+
+    def test_empty_lists_dropped(self):
+        index = storage.VisibleIndex()
+        item = {"family" : "Owls", "continents" : ["Asia", 7]}
+        index.add(1, item)
+        self.assertEqual(index.list(continent = "Asia"), [1])
+        index.remove(1, item)
+        self.assertEqual(index.families, {})
+        self.assertEqual(index.continents, {})
+
+
+class ChangeFeedTest(unittest.TestCase):
+    def setUp(self):
+        self.storage = storage.MemoryStorage(change_log_size = 4)
+
+    def test_changes(self):
+        _, token = self.storage.changes_since()
+        visible_id = self.storage.store(visible_item())
+        hidden_id, = self.storage.store_many([hidden_item()])
+        self.assertTrue(self.storage.remove(visible_id))
+        self.assertFalse(self.storage.remove(visible_id))
+        changes, token = self.storage.changes_since(token)
+        self.assertEqual(changes, [
+            {"id" : visible_id, "change" : storage.CHANGE_INSERT,
+             "visible" : True},
+            {"id" : hidden_id, "change" : storage.CHANGE_INSERT,
+             "visible" : False},
+            {"id" : visible_id, "change" : storage.CHANGE_DELETE,
+             "visible" : True}])
+        self.assertEqual(self.storage.changes_since(token), ([], token))
+
+    def test_limit(self):
+        _, token = self.storage.changes_since()
+        ids = self.storage.store_many([visible_item() for _ in range(3)])
+        changes, token = self.storage.changes_since(token, limit = 2)
+        self.assertEqual([change["id"] for change in changes], ids[:2])
+        changes, token = self.storage.changes_since(token, limit = 2)
+        self.assertEqual([change["id"] for change in changes], ids[2:])
+
+    def test_invalid_token(self):
+        epoch = self.storage.changes_since()[1].split("-")[0]
+        # Not a number, and the number of a change yet to come
+        for token in ("bogus", epoch + "-x", epoch + "-1"):
+            with self.assertRaises(ValueError):
+                self.storage.changes_since(token)
+
+    def test_wait(self):
+        _, token = self.storage.changes_since()
+        writer = threading.Timer(0.05, self.storage.store, [visible_item()])
+        writer.start()
+        started = time.monotonic()
+        changes, _ = self.storage.changes_since(token, wait = 10.0)
+        writer.join()
+        self.assertEqual(len(changes), 1)
+        self.assertLess(time.monotonic() - started, 10.0)
+
+    def test_wait_timeout(self):
+        _, token = self.storage.changes_since()
+        self.assertEqual(self.storage.changes_since(token, wait = 0.01),
+                         ([], token))
+
+    def test_expired(self):
+        _, token = self.storage.changes_since()
+        self.storage.store_many([visible_item() for _ in range(4)])
+        self.assertEqual(len(self.storage.changes_since(token)[0]), 4)
+        self.storage.store(visible_item())
+        with self.assertRaises(storage.ChangesExpired):
+            self.storage.changes_since(token)
+        with self.assertRaises(storage.ChangesExpired):
+            storage.MemoryStorage().changes_since(token)
+
+
+class ShardedChangeFeedTest(ChangeFeedTest):
+    def setUp(self):
+        self.storage = storage.ShardedMemoryStorage(change_log_size = 4)
+
+
+class SqliteStorageTest(StorageTest):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "birds.db")
+        self.storage = storage.SqliteStorage(self.path)
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.directory)
+
+    def test_reopen(self):
+        item = visible_item()
+        item_id = self.storage.store(item)
+        version = self.storage.list_version()
+        self.storage.close()
+        self.storage = storage.SqliteStorage(self.path)
+        self.assertTrue(is_same_dictionary(self.storage.retrieve(item_id),
+                                           item))
+        self.assertEqual(self.list(), [item_id])
+        self.assertEqual(self.storage.list_version(), version)
+
+    def test_list_plan(self):
+        plan = self.storage.query_plan(self.storage.LIST, (b"", 10))
+        self.assertEqual(len(plan), 1)
+        self.assertIn("COVERING INDEX visible_birds", plan[0])
+
+    def test_filtered_list_plans(self):
+        for family, continent in (("Owls", None), (None, "Asia"),
+                                  ("Owls", "Asia")):
+            plan = self.storage.query_plan(*self.storage.list_query(
+                b"", 10, family, continent))
+            self.assertNotIn("SCAN", " ".join(plan))
+            self.assertNotIn("TEMP B-TREE", " ".join(plan))
+
+    def test_filter_tables_filled(self):
+        item = visible_item()
+        item["family"] = "Owls"
+        item_id = self.storage.store(item)
+        with self.storage.transaction() as connection:
+            connection.execute("DROP TABLE visible_families")
+            connection.execute("PRAGMA user_version = 0")
+        self.storage.close()
+        self.storage = storage.SqliteStorage(self.path)
+        self.assertEqual(list(self.storage.list(family = "Owls")), [item_id])
+
+    def test_connection_per_thread(self):
+        item_id = self.storage.store(visible_item())
+        found = []
+        thread = threading.Thread(
+            target = lambda: found.append(self.storage.retrieve(item_id)))
+        thread.start()
+        thread.join()
+        self.assertIsNotNone(found[0])
+        self.assertEqual(len(self.storage.connections), 2)
+
+    def test_store_many_unencodable(self):
+        unencodable = visible_item()
+        unencodable["set"] = {"not", "encodable"}
+        ids = self.storage.store_many([visible_item(), unencodable])
+        self.assertIsNone(ids[1])
+        self.assertEqual(self.list(), ids[:1])
+
+
+class CountingStorage(storage.MemoryStorage):
+    """Memory storage counting calls that reach it."""
+
+    def __init__(self):
+        super(CountingStorage, self).__init__()
+        self.retrieves = 0
+        self.retrieved_many = []
+        self.lists = 0
+
+    def retrieve(self, item_id):
+        self.retrieves += 1
+        return super(CountingStorage, self).retrieve(item_id)
+
+    def retrieve_many(self, item_ids):
+        self.retrieved_many.append(list(item_ids))
+        return super(CountingStorage, self).retrieve_many(item_ids)
+
+    def list(self, after = None, limit = None, family = None,
+             continent = None):
+        self.lists += 1
+        return super(CountingStorage, self).list(after, limit, family,
+                                                 continent)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class CachingStorageTest(StorageTest):
+    def setUp(self):
+        self.backend = CountingStorage()
+        self.clock = FakeClock()
+        self.storage = storage.CachingStorage(self.backend, size = 2,
+                                              ttl = 10, clock = self.clock)
+
+    def test_cached_retrieve(self):
+        item_id = self.backend.store(visible_item())
+        self.storage.retrieve(item_id)
+        item = self.storage.retrieve(str(item_id))
+        self.assertEqual(item[storage.ID_KEY], item_id)
+        self.assertEqual(self.backend.retrieves, 1)
+        self.assertEqual(self.storage.hits, 1)
+        self.assertEqual(self.storage.misses, 1)
+
+    def test_cached_copies(self):
+        item_id = self.backend.store(visible_item())
+        self.storage.retrieve(item_id)["key"] = "changed"
+        self.assertEqual(self.storage.retrieve(item_id)["key"], "valueA")
+
+    def test_cached_retrieve_many(self):
+        ids = self.backend.store_many([visible_item(), visible_item()])
+        self.storage.retrieve(ids[0])
+        found = self.storage.retrieve_many([str(ids[0]), ids[1]])
+        self.assertEqual([item[storage.ID_KEY] for item in found], ids)
+        self.assertEqual(self.backend.retrieved_many, [[ids[1]]])
+        self.storage.retrieve_many(ids)
+        self.assertEqual(len(self.backend.retrieved_many), 1)
+
+    def test_negative_lookup(self):
+        some_id = ObjectId()
+        self.assertIsNone(self.storage.retrieve(some_id))
+        self.assertIsNone(self.storage.retrieve(some_id))
+        self.assertEqual(self.backend.retrieves, 1)
+
+    def test_expiry(self):
+        item_id = self.backend.store(visible_item())
+        self.storage.retrieve(item_id)
+        self.clock.now = 11
+        self.storage.retrieve(item_id)
+        self.assertEqual(self.backend.retrieves, 2)
+
+    def test_eviction(self):
+        ids = [self.backend.store(visible_item()) for _ in range(3)]
+        for item_id in ids:
+            self.storage.retrieve(item_id)
+        self.assertEqual(self.storage.evictions, 1)
+        self.storage.retrieve(ids[2])
+        self.storage.retrieve(ids[1])
+        self.assertEqual(self.backend.retrieves, 3)
+        self.storage.retrieve(ids[0])
+        self.assertEqual(self.backend.retrieves, 4)
+        self.assertEqual(self.storage.stats()["size"], 2)
+
+    def test_remove_invalidates(self):
+        item_id = self.storage.store(visible_item())
+        self.storage.retrieve(item_id)
+        self.assertEqual(len(self.list()), 1)
+        self.assertTrue(self.storage.remove(item_id))
+        self.assertIsNone(self.storage.retrieve(item_id))
+        self.assertEqual(len(self.list()), 0)
+
+    def test_cached_list(self):
+        self.storage.store(visible_item())
+        self.assertEqual(len(self.list()), 1)
+        self.assertEqual(len(self.list()), 1)
+        self.assertEqual(self.backend.lists, 1)
+        self.storage.store(visible_item())
+        self.assertEqual(len(self.list()), 2)
+        self.assertEqual(self.backend.lists, 2)
+
+    def test_list_changed_elsewhere(self):
+        self.storage.store(visible_item())
+        version = self.storage.list_version()
+        self.assertEqual(len(self.list()), 1)
+        self.backend.store(visible_item())
+        self.assertNotEqual(self.storage.list_version(), version)
+        self.assertEqual(len(self.list()), 2)
+
+
+class BatchCountingStorage(storage.MemoryStorage):
+    def __init__(self):
+        super(BatchCountingStorage, self).__init__()
+        self.batches = []
+
+    def store_many(self, items):
+        self.batches.append(len(items))
+        return super(BatchCountingStorage, self).store_many(items)
+
+
+class CoalescingStorageTest(StorageTest):
+    def setUp(self):
+        self.backend = BatchCountingStorage()
+        self.storage = storage.CoalescingStorage(self.backend,
+                                                 batch_size = 4,
+                                                 window = 0.001)
+
+    def store_concurrently(self, items):
+        """Stores every item from a thread of its own, returning list of
+        what each store returned or raised."""
+        outcomes = [None] * len(items)
+        def store(index):
+            try:
+                outcomes[index] = self.storage.store(items[index])
+            except Exception as ex:
+                outcomes[index] = ex
+        threads = [threading.Thread(target = store, args = (index,))
+                   for index in range(len(items))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_batched(self):
+        # Long enough for every thread to get in the first two batches
+        self.storage.window = 10.0
+        items = [visible_item() for _ in range(8)]
+        ids = self.store_concurrently(items)
+        self.assertEqual(self.backend.batches, [4, 4])
+        self.assertEqual(len(set(ids)), 8)
+        for item_id, item in zip(ids, items):
+            self.assertTrue(is_same_dictionary(self.storage.retrieve(item_id),
+                                               item))
+
+    def test_window(self):
+        started = time.monotonic()
+        self.storage.store(visible_item())
+        self.assertGreaterEqual(time.monotonic() - started, 0.001)
+        self.assertEqual(self.backend.batches, [1])
+
+    def test_errors(self):
+        def failing_store_many(items):
+            raise RuntimeError("Down")
+        self.backend.store_many = failing_store_many
+        self.storage.window = 10.0
+        outcomes = self.store_concurrently([visible_item()
+                                            for _ in range(4)])
+        for outcome in outcomes:
+            self.assertIsInstance(outcome, RuntimeError)
+
+    def test_unstored_item_retried(self):
+        def store_many(items):
+            return [None] * len(items)
+        self.backend.store_many = store_many
+        item_id = self.storage.store(visible_item())
+        self.assertIsNotNone(self.storage.retrieve(item_id))
+
+
+class DeferredStorageTest(StorageTest):
+    def setUp(self):
+        self.opened = []
+        self.storage = storage.DeferredStorage(self.open_engine)
+
+    def open_engine(self):
+        self.opened.append(storage.MemoryStorage())
+        return self.opened[-1]
+
+    def test_opened_on_first_use(self):
+        self.assertEqual(self.opened, [])
+        item_id = self.storage.store(visible_item())
+        self.assertIsNotNone(self.storage.retrieve(item_id))
+        self.assertEqual(len(self.opened), 1)
+
+    def test_failed_open_retried(self):
+        def failing_open():
+            raise RuntimeError("Down")
+        self.storage.open_engine = failing_open
+        with self.assertRaises(RuntimeError):
+            self.storage.list_version()
+        self.storage.open_engine = self.open_engine
+        self.assertEqual(list(self.storage.list()), [])
+        self.assertEqual(len(self.opened), 1)
+
+
+class StallingStorage(storage.MemoryStorage):
+    """Memory storage whose calls hang, once stalled, until released."""
+
+    def __init__(self):
+        super(StallingStorage, self).__init__()
+        self.running = threading.Event()
+        self.running.set()
+
+    def stall(self):
+        self.running.clear()
+
+    def release(self):
+        self.running.set()
+
+    def store(self, item):
+        self.running.wait()
+        return super(StallingStorage, self).store(item)
+
+    def retrieve(self, item_id):
+        self.running.wait()
+        return super(StallingStorage, self).retrieve(item_id)
+
+    def list_version(self):
+        self.running.wait()
+        return super(StallingStorage, self).list_version()
+
+    def list(self, after = None, limit = None, family = None,
+             continent = None):
+        self.running.wait()
+        return super(StallingStorage, self).list(after, limit, family,
+                                                 continent)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = storage.CircuitBreaker(failure_threshold = 2,
+                                              reset_timeout = 10,
+                                              clock = self.clock)
+
+    def test_failures_in_a_row(self):
+        self.breaker.failed(self.breaker.allow())
+        self.breaker.succeeded(self.breaker.allow())
+        self.breaker.failed(self.breaker.allow())
+        self.breaker.failed(self.breaker.allow())
+        self.assertEqual(self.breaker.state, storage.CIRCUIT_OPEN)
+        self.clock.now = 4
+        with self.assertRaises(storage.CircuitOpen) as raised:
+            self.breaker.allow()
+        self.assertEqual(raised.exception.retry_after, 6)
+
+    def test_half_open(self):
+        self.breaker.failed(self.breaker.allow())
+        self.breaker.failed(self.breaker.allow())
+        self.clock.now = 10
+        probe = self.breaker.allow()
+        self.assertEqual(self.breaker.state, storage.CIRCUIT_HALF_OPEN)
+        # Only one probe at a time
+        with self.assertRaises(storage.CircuitOpen):
+            self.breaker.allow()
+        self.breaker.failed(probe)
+        self.assertEqual(self.breaker.state, storage.CIRCUIT_OPEN)
+        with self.assertRaises(storage.CircuitOpen) as raised:
+            self.breaker.allow()
+        self.assertEqual(raised.exception.retry_after, 10)
+
+        self.clock.now = 20
+        self.breaker.succeeded(self.breaker.allow())
+        self.assertEqual(self.breaker.state, storage.CIRCUIT_CLOSED)
+        self.breaker.allow()
+        self.breaker.allow()
+
+    def test_late_reports(self):
+        slow = [self.breaker.allow() for _ in range(3)]
+        self.breaker.failed(self.breaker.allow())
+        self.breaker.failed(self.breaker.allow())
+        self.assertEqual(self.breaker.state, storage.CIRCUIT_OPEN)
+        # Calls let through before it opened neither close it
+        self.breaker.succeeded(slow[0])
+        self.assertEqual(self.breaker.state, storage.CIRCUIT_OPEN)
+        # nor keep it open longer
+        self.clock.now = 5
+        self.breaker.failed(slow[1])
+        self.clock.now = 10
+        probe = self.breaker.allow()
+        self.assertEqual(self.breaker.state, storage.CIRCUIT_HALF_OPEN)
+        self.breaker.failed(slow[2])
+        self.assertEqual(self.breaker.state, storage.CIRCUIT_HALF_OPEN)
+        self.breaker.succeeded(probe)
+        self.assertEqual(self.breaker.state, storage.CIRCUIT_CLOSED)
+        # and count for nothing once it closed again
+        self.breaker.failed(probe)
+        self.breaker.failed(self.breaker.allow())
+        self.assertEqual(self.breaker.state, storage.CIRCUIT_CLOSED)
+
+
+class GuardedStorageTest(StorageTest):
+    TIMEOUT = 0.05
+
+    def setUp(self):
+        self.backend = StallingStorage()
+        self.clock = FakeClock()
+        self.storage = storage.GuardedStorage(
+            self.backend, self.TIMEOUT, failure_threshold = 3,
+            reset_timeout = 10, page_size = 2, clock = self.clock)
+
+    def tearDown(self):
+        self.backend.release()
+        self.storage.close()
+
+    def test_timeout(self):
+        item_id = self.storage.store(visible_item())
+        self.backend.stall()
+        started = time.monotonic()
+        with self.assertRaises(storage.StorageTimeout):
+            self.storage.retrieve(item_id)
+        with self.assertRaises(storage.StorageTimeout):
+            list(self.storage.list())
+        self.assertLess(time.monotonic() - started, 1.0)
+
+    def test_operation_timeouts(self):
+        self.storage.timeouts["list_version"] = 1.0
+        self.backend.stall()
+        threading.Timer(self.TIMEOUT * 2, self.backend.release).start()
+        self.assertEqual(self.storage.list_version(),
+                         self.backend.list_version())
+
+    def test_outage_latency(self):
+        item_id = self.storage.store(visible_item())
+        self.backend.stall()
+        latencies = []
+        errors = []
+        def client():
+            for _ in range(20):
+                started = time.monotonic()
+                try:
+                    self.storage.retrieve(item_id)
+                except Exception as ex:
+                    errors.append(type(ex))
+                latencies.append(time.monotonic() - started)
+        clients = [threading.Thread(target = client) for _ in range(8)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+
+        self.assertEqual(len(latencies), 160)
+        # Nothing waits for the stalled engine longer than the timeout,
+        # and once the circuit opens nothing waits for it at all
+        self.assertLess(max(latencies), self.TIMEOUT + 0.5)
+        self.assertLessEqual(errors.count(storage.StorageTimeout), 8 + 3)
+        self.assertEqual(errors.count(storage.CircuitOpen) +
+                         errors.count(storage.StorageTimeout), 160)
+
+        # Probing closes the circuit once the engine is back
+        self.backend.release()
+        with self.assertRaises(storage.CircuitOpen):
+            self.storage.retrieve(item_id)
+        self.clock.now = 10
+        self.assertIsNotNone(self.storage.retrieve(item_id))
+        self.assertEqual(self.storage.breaker.state, storage.CIRCUIT_CLOSED)
+
+    def test_list_page_timeouts(self):
+        ids = self.storage.store_many([visible_item() for _ in range(6)])
+        listing = self.backend.list
+        def slow_list(*args):
+            time.sleep(self.TIMEOUT / 2)
+            return listing(*args)
+        self.backend.list = slow_list
+        # Longer than the timeout all in all, but no page is
+        self.assertEqual(self.list(), ids)
+        self.assertEqual(list(self.storage.list(limit = 3)), ids[:3])
+
+    def test_long_polls(self):
+        self.storage.close()
+        self.storage = storage.GuardedStorage(self.backend, self.TIMEOUT,
+                                              workers = 2)
+        _, token = self.storage.changes_since()
+        results = []
+        def follower():
+            results.append(self.storage.changes_since(token, wait = 5)[0])
+        followers = [threading.Thread(target = follower) for _ in range(8)]
+        for thread in followers:
+            thread.start()
+        time.sleep(0.1)
+        # Waiting for changes leaves the pool to other calls
+        for _ in range(10):
+            item_id = self.storage.store(hidden_item())
+            self.assertIsNotNone(self.storage.retrieve(item_id))
+        for thread in followers:
+            thread.join()
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(results))
+        self.assertEqual(self.storage.breaker.state, storage.CIRCUIT_CLOSED)
+
+    def test_answers_are_not_failures(self):
+        for _ in range(5):
+            with self.assertRaises(ValueError):
+                self.storage.changes_since("bogus")
+        self.assertEqual(self.storage.breaker.state, storage.CIRCUIT_CLOSED)
+
+
+class ShardedStorageTest(StorageTest):
+    def setUp(self):
+        self.storage = storage.ShardedStorage(self.make_shards(),
+                                              page_size = 2)
+
+    def make_shards(self):
+        return [storage.MemoryStorage(), storage.ShardedMemoryStorage(),
+                storage.MemoryStorage()]
+
+    def tearDown(self):
+        self.storage.close()
+
+    def assertPlaced(self):
+        """Checks every item is on the shard it belongs on, and only
+        there."""
+        shards = self.storage.shards
+        for number, shard in enumerate(shards):
+            for item_id in shard.all_ids():
+                self.assertEqual(storage.shard_of(item_id, len(shards)),
+                                 number)
+
+    def test_routing(self):
+        ids = self.storage.store_many([visible_item() for _ in range(30)])
+        ids.append(self.storage.store(hidden_item()))
+        self.assertPlaced()
+        for shard in self.storage.shards:
+            self.assertTrue(shard.all_ids())
+        self.assertEqual(sorted(self.storage.all_ids()), sorted(ids))
+
+    def test_merged_listing(self):
+        ids = self.storage.store_many([visible_item() for _ in range(20)])
+        self.storage.store_many([hidden_item() for _ in range(5)])
+        self.assertEqual(self.list(), sorted(ids))
+        pages = []
+        after = None
+        while True:
+            page = list(self.storage.list(after, 3))
+            if not page:
+                break
+            self.assertLessEqual(len(page), 3)
+            pages.extend(page)
+            after = str(page[-1])
+        self.assertEqual(pages, sorted(ids))
+        self.assertEqual(list(self.storage.list(limit = 7)), sorted(ids)[:7])
+
+    def test_list_version_of_all_shards(self):
+        version = self.storage.list_version()
+        self.storage.store(visible_item())
+        self.assertNotEqual(self.storage.list_version(), version)
+
+    def test_rebalance(self):
+        items = [visible_item() if number % 3 else hidden_item()
+                 for number in range(60)]
+        ids = self.storage.store_many(items)
+        listed = self.list()
+        self.storage.add_shard(storage.MemoryStorage())
+        with self.assertRaises(ValueError):
+            self.storage.add_shard(storage.MemoryStorage())
+
+        # Until rebalanced, items are found on their old shards
+        moving = [item_id for item_id in ids
+                  if storage.shard_of(item_id, 4) == 3]
+        self.assertTrue(moving)
+        self.assertEqual(self.storage.shards[3].all_ids(), [])
+        for item_id, item in zip(ids, self.storage.retrieve_many(ids)):
+            self.assertIsNotNone(item)
+            self.assertEqual(self.storage.etag(item_id), item["etag"])
+        self.assertTrue(self.storage.remove(moving[0]))
+        del items[ids.index(moving[0])]
+        ids.remove(moving[0])
+        listed = [item_id for item_id in listed if item_id != moving[0]]
+        self.assertEqual(self.list(), listed)
+        new_id = self.storage.store(visible_item())
+
+        self.assertEqual(self.storage.rebalance(batch_size = 4),
+                         len(moving) - 1)
+        self.assertPlaced()
+        self.assertEqual(self.storage.rebalance(), 0)
+        self.assertEqual(self.list(), sorted(listed + [new_id]))
+        for item_id, item in zip(ids, items):
+            self.assertTrue(is_same_dictionary(
+                self.storage.retrieve(item_id), item))
+        self.assertIsNone(self.storage.retrieve(moving[0]))
+        self.storage.add_shard(storage.MemoryStorage())
+
+    def test_interrupted_rebalance(self):
+        ids = self.storage.store_many([visible_item() for _ in range(40)])
+        self.storage.add_shard(storage.MemoryStorage())
+        failing = []
+        for shard in self.storage.shards[:3]:
+            def failing_remove(item_id, remove = shard.remove):
+                if not failing:
+                    failing.append(item_id)
+                    raise RuntimeError("No rum")
+                return remove(item_id)
+            shard.remove = failing_remove
+        with self.assertRaises(RuntimeError):
+            self.storage.rebalance(batch_size = 4)
+        # Copied, but still where it was too
+        self.assertIsNotNone(self.storage.shards[3].etag(failing[0]))
+        self.storage.rebalance(batch_size = 4)
+        self.assertPlaced()
+        self.assertEqual(self.list(), sorted(ids))
+        moved = self.storage.shards[3].all_ids()
+        self.assertEqual(sorted(self.storage.shards[3].list()), sorted(moved))
+
+    def test_adding(self):
+        shards = self.make_shards()
+        before = storage.ShardedStorage(shards[:2])
+        ids = before.store_many([visible_item() for _ in range(20)])
+        before.close()
+        self.storage.close()
+        self.storage = storage.ShardedStorage(shards, adding = True)
+        self.assertEqual(self.list(), sorted(ids))
+        self.assertNotIn(None, self.storage.retrieve_many(ids))
+        self.storage.rebalance()
+        self.assertPlaced()
+        self.assertTrue(shards[2].all_ids())
+        with self.assertRaises(ValueError):
+            storage.ShardedStorage(shards[:1], adding = True)
+
+    def test_moved_while_listing(self):
+        ids = self.storage.store_many([visible_item() for _ in range(20)])
+        self.storage.add_shard(storage.MemoryStorage())
+        moving = [item_id for item_id in ids
+                  if storage.shard_of(item_id, 4) == 3]
+        # Copied over, not yet removed from where it was
+        for item_id in moving:
+            item = self.storage.owners(item_id)[1].retrieve(item_id)
+            copy = {"key" : item["key"], storage.VISIBLE_KEY : True,
+                    storage.ASSIGNED_ID_KEY : item_id}
+            self.storage.shards[3].store(copy)
+        self.assertEqual(self.list(), sorted(ids))
+        self.assertEqual(list(self.storage.list(limit = 5)), sorted(ids)[:5])
+
+    def test_partial_failure(self):
+        def failing_store_many(items):
+            raise RuntimeError("No rum")
+        self.storage.shards[1].store_many = failing_store_many
+        items = [visible_item() for _ in range(30)]
+        ids = self.storage.store_many(items)
+        for item_id, item in zip(ids, items):
+            owner = storage.shard_of(item[storage.ID_KEY]
+                                     if item_id is not None
+                                     else item[storage.ASSIGNED_ID_KEY], 3)
+            self.assertEqual(item_id is None, owner == 1)
+        for shard in self.storage.shards:
+            shard.store_many = failing_store_many
+        with self.assertRaises(RuntimeError):
+            self.storage.store_many([visible_item()])
+
+    def test_changes_not_kept(self):
+        with self.assertRaises(NotImplementedError):
+            self.storage.changes_since()
+
+
+class LazyImportTest(unittest.TestCase):
+    def test_no_backends_imported(self):
+        # A fresh interpreter, since this one imported everything already
+        script = ("import sys, birds.app; "
+                  "print(sorted(name for name in "
+                  "('pymongo', 'jsonschema', 'sqlite3') "
+                  "if name in sys.modules))")
+        output = subprocess.check_output([sys.executable, "-c", script],
+                                         cwd = os.path.dirname(
+                                             os.path.dirname(__file__)))
+        self.assertEqual(output.strip(), b"[]")
+
 
 MONGO_TEST_COLLECTION = "storage_test"
 
@@ -150,14 +1093,165 @@ class MongoStorageTest(StorageTest):
 
     def tearDown(self):
         MongoStorageTest.db.drop_collection(MONGO_TEST_COLLECTION)
+        MongoStorageTest.db.drop_collection(MONGO_TEST_COLLECTION + ".meta")
+        MongoStorageTest.db.drop_collection(
+            MONGO_TEST_COLLECTION + ".changes")
+
+    def test_ensure_indexes(self):
+        self.storage.ensure_indexes()
+        self.storage.ensure_indexes()
+        indexes = self.storage.collection.index_information()
+        self.assertIn("visible_id", indexes)
+
+    def test_query_plans(self):
+        self.storage.ensure_indexes()
+        self.storage.store_many([visible_item() for _ in range(10)])
+        self.storage.verify_query_plans(storage.PLAN_CHECK_FAIL)
+
+    def test_query_plans_without_index(self):
+        self.storage.store_many([visible_item() for _ in range(10)])
+        with self.assertRaises(storage.CollectionScanError):
+            self.storage.verify_query_plans(storage.PLAN_CHECK_FAIL)
+
+
+class MongoShardedStorageTest(ShardedStorageTest):
+    """Shards in memory and in MongoDB, mixed."""
+
+    COLLECTIONS = [MONGO_TEST_COLLECTION + "_shard0",
+                   MONGO_TEST_COLLECTION + "_shard1"]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.client = MongoClient()
+        cls.db = cls.client.test_db
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.close()
+
+    def make_shards(self):
+        engines = []
+        for name in self.COLLECTIONS:
+            self.db.drop_collection(name)
+            engine = storage.MongoStorage(self.db[name])
+            engine.ensure_indexes()
+            engines.append(engine)
+        return [engines[0], storage.MemoryStorage(), engines[1]]
+
+    def tearDown(self):
+        super(MongoShardedStorageTest, self).tearDown()
+        for name in self.COLLECTIONS:
+            for suffix in ("", ".meta", ".changes"):
+                self.db.drop_collection(name + suffix)
+
+
+class MongoChangeFeedTest(ChangeFeedTest):
+    setUpClass = MongoStorageTest.setUpClass
+    tearDownClass = MongoStorageTest.tearDownClass
+    tearDown = MongoStorageTest.tearDown
+
+    def setUp(self):
+        self.storage = storage.MongoStorage(
+            MongoStorageTest.db[MONGO_TEST_COLLECTION], change_log_size = 4)
+        self.storage.ensure_change_log()
+        self.storage.ensure_change_log()
+
+    def test_invalid_token(self):
+        for token in ("bogus", "-1"):
+            with self.assertRaises(ValueError):
+                self.storage.changes_since(token)
+
+    def test_expired(self):
+        _, token = self.storage.changes_since()
+        self.storage.store_many([visible_item() for _ in range(5)])
+        with self.assertRaises(storage.ChangesExpired):
+            self.storage.changes_since(token)
+
+    def test_gap(self):
+        _, token = self.storage.changes_since()
+        # Number taken by a writer yet to log its change
+        self.storage.meta.update_one({"_id" : "changes"},
+                                     {"$inc" : {"value" : 1}}, upsert = True)
+        self.storage.store(visible_item())
+        self.assertEqual(self.storage.changes_since(token), ([], token))
+        self.storage.clock = lambda: time.time() + storage.CHANGE_GAP_TIMEOUT
+        changes, _ = self.storage.changes_since(token)
+        self.assertEqual(len(changes), 1)
+
+
+COLLSCAN_PLAN = {"queryPlanner" : {"winningPlan" : {
+    "stage" : "PROJECTION",
+    "inputStage" : {"stage" : "SORT",
+                    "inputStage" : {"stage" : "COLLSCAN"}}}}}
+IXSCAN_PLAN = {"queryPlanner" : {
+    "winningPlan" : {"stage" : "PROJECTION",
+                     "inputStage" : {"stage" : "IXSCAN"}},
+    "rejectedPlans" : [{"stage" : "COLLSCAN"}]}}
+
+class FakeCursor(object):
+    def __init__(self, explanation):
+        self.explanation = explanation
+
+    def explain(self):
+        return self.explanation
+
+    def __iter__(self):
+        return iter([])
+
+    def __next__(self):
+        raise StopIteration
+
+
+class FakeCollection(object):
+    def __init__(self, explanation):
+        self.explanation = explanation
+
+    def find(self, *args, **kwargs):
+        return FakeCursor(self.explanation)
+
+
+class QueryPlanTest(unittest.TestCase):
+    def test_index_scan(self):
+        storage.check_query_plan(IXSCAN_PLAN, storage.PLAN_CHECK_FAIL)
+
+    def test_collection_scan(self):
+        with self.assertRaises(storage.CollectionScanError):
+            storage.check_query_plan(COLLSCAN_PLAN, storage.PLAN_CHECK_FAIL)
+
+    def test_collection_scan_warning(self):
+        with self.assertLogs("birds-api", "WARNING"):
+            storage.check_query_plan(COLLSCAN_PLAN, storage.PLAN_CHECK_WARN)
+
+    def test_checked_queries(self):
+        engine = storage.MongoStorage(FakeCollection(COLLSCAN_PLAN),
+                                      plan_check = storage.PLAN_CHECK_FAIL)
+        with self.assertRaises(storage.CollectionScanError):
+            list(engine.list())
+        with self.assertRaises(storage.CollectionScanError):
+            engine.retrieve(ObjectId())
+        with self.assertRaises(storage.CollectionScanError):
+            engine.remove(ObjectId())
+
+    def test_unchecked_queries(self):
+        engine = storage.MongoStorage(FakeCollection(COLLSCAN_PLAN))
+        self.assertEqual(list(engine.list()), [])
+        self.assertIsNone(engine.retrieve(ObjectId()))
 
 
 # Override test loading to skip test from storage test base class
 # without skipping them in the subclasses.
 def load_tests(loader, tests, pattern):
     suite = unittest.TestSuite()
-    for test_class in (AddFieldsTest, ComparisonTest,
-                       MemoryStorageTest, MongoStorageTest):
+    for test_class in (AddFieldsTest, ComparisonTest, CopyItemTest,
+                       QueryPlanTest,
+                       MemoryStorageTest, ShardedMemoryStorageTest,
+                       VisibleIndexTest, CachingStorageTest,
+                       CoalescingStorageTest, DeferredStorageTest,
+                       CircuitBreakerTest, GuardedStorageTest,
+                       ShardedStorageTest,
+                       LazyImportTest, ChangeFeedTest, ShardedChangeFeedTest,
+                       SqliteStorageTest, MongoStorageTest,
+                       MongoChangeFeedTest, MongoShardedStorageTest):
         tests = loader.loadTestsFromTestCase(test_class)
         suite.addTests(tests)
     return suite
@@ -0,0 +1,89 @@
+"""Compiled validator tests"""
+
+from jsonschema import Draft4Validator
+import random
+import unittest
+
+from . import bird_schemas
+from . import validation
+
+SCHEMAS = [bird_schemas.bird_input_schema,
+           bird_schemas.bird_output_schema,
+           bird_schemas.bird_list_schema,
+           bird_schemas.bird_added_schema]
+
+KEYS = ["id", "name", "family", "continents", "added", "visible", "bogus"]
+SCALARS = ["", "Europe", "Asia", "5f0c0a0b0c0d0e0f10111213",
+           0, 1, 2, 1.0, 2.5, True, False, None]
+
+
+def random_value(rng, depth = 0):
+    kind = rng.randrange(4 if depth < 2 else 1)
+    if kind == 0:
+        return rng.choice(SCALARS)
+    elif kind == 1:
+        return [random_value(rng, depth + 1)
+                for _ in range(rng.randrange(4))]
+    elif kind == 2:
+        # Arrays of strings, with a fair chance of duplicates
+        return [rng.choice(SCALARS[:3]) for _ in range(rng.randrange(4))]
+    return {rng.choice(KEYS) : random_value(rng, depth + 1)
+            for _ in range(rng.randrange(4))}
+
+def random_bird(rng):
+    """Mostly valid bird document with a few random mutations."""
+    bird = {"id" : "5f0c0a0b0c0d0e0f10111213",
+            "name" : "A Fancy Bird",
+            "family" : "Birdies",
+            "continents" : ["Europe", "Asia"],
+            "added" : "1985-11-05",
+            "visible" : True}
+    for _ in range(rng.randrange(3)):
+        action = rng.randrange(3)
+        key = rng.choice(KEYS)
+        if action == 0:
+            bird.pop(key, None)
+        else:
+            bird[key] = random_value(rng)
+    if rng.randrange(10) == 0:
+        return random_value(rng)
+    return bird
+
+
+class CompiledValidatorTest(unittest.TestCase):
+    def test_schemas_compile(self):
+        for schema in SCHEMAS:
+            # Compiled schemas are only checked once jsonschema is needed
+            Draft4Validator.check_schema(schema)
+            self.assertIsNotNone(
+                validation.SchemaValidator(schema).source, schema["title"])
+
+    def test_same_as_jsonschema(self):
+        rng = random.Random(1985)
+        for schema in SCHEMAS:
+            compiled = validation.SchemaValidator(schema)
+            reference = Draft4Validator(schema)
+            accepted = 0
+            for _ in range(5000):
+                document = random_bird(rng)
+                expected = reference.is_valid(document)
+                self.assertEqual(compiled.is_valid(document), expected,
+                                 "%s: %r" % (schema["title"], document))
+                accepted += expected
+            # Make sure both outcomes were actually exercised
+            self.assertGreater(accepted, 0, schema["title"])
+
+    def test_unique_items(self):
+        schema = {"type" : "array", "uniqueItems" : True}
+        compiled = validation.SchemaValidator(schema)
+        self.assertTrue(compiled.is_valid([1, True, 0, False]))
+        self.assertFalse(compiled.is_valid([{"a" : 1}, {"a" : 1}]))
+        # Only top level booleans are told apart from numbers
+        self.assertFalse(compiled.is_valid([[1], [True]]))
+
+    def test_fallback(self):
+        schema = {"type" : "string", "pattern" : "^[a-z]+$"}
+        compiled = validation.SchemaValidator(schema)
+        self.assertIsNone(compiled.source)
+        self.assertTrue(compiled.is_valid("bird"))
+        self.assertFalse(compiled.is_valid("Bird"))
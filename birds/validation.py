@@ -0,0 +1,223 @@
+"""Schema validation compiled ahead of time
+
+`jsonschema.validate' checks the schema itself and builds a new validator
+every time it is called. Here the schemas from `bird_schemas' are turned
+into plain Python functions once, at import time, so validating a request
+is just a handful of isinstance and membership tests.
+
+Only the keywords the bird schemas actually use are compiled. Any schema
+using something else gets a cached `jsonschema.Draft4Validator' instead,
+so the answers are always the same as those of jsonschema. Otherwise
+jsonschema is not even imported until an invalid instance needs
+describing, which spares importing it to every process that never sees
+one."""
+
+import numbers
+
+from . import bird_schemas
+
+# Keywords that only describe the schema and never reject anything.
+ANNOTATION_KEYWORDS = frozenset(["$schema", "id", "title", "description",
+                                 "default"])
+OBJECT_KEYWORDS = frozenset(["required", "properties",
+                             "additionalProperties"])
+ARRAY_KEYWORDS = frozenset(["items", "minItems", "maxItems", "uniqueItems"])
+STRING_KEYWORDS = frozenset(["minLength", "maxLength"])
+
+# Python expressions matching the draft 4 types the way jsonschema does.
+TYPE_CHECKS = {
+    "array" : "isinstance({0}, list)",
+    "boolean" : "isinstance({0}, bool)",
+    "integer" : "(isinstance({0}, int) and not isinstance({0}, bool))",
+    "null" : "{0} is None",
+    "number" : "(isinstance({0}, numbers.Number) "
+               "and not isinstance({0}, bool))",
+    "object" : "isinstance({0}, dict)",
+    "string" : "isinstance({0}, str)",
+}
+
+
+class UnsupportedSchema(Exception):
+    """Schema uses a construct the compiler does not handle."""
+
+
+_TRUE = object()
+_FALSE = object()
+
+def _unbool(element):
+    """Keeps True and False apart from 1 and 0, as jsonschema does."""
+    if element is True:
+        return _TRUE
+    elif element is False:
+        return _FALSE
+    return element
+
+def _unique(container):
+    """Checks if all elements of a list are unique."""
+    try:
+        return len(set(_unbool(e) for e in container)) == len(container)
+    except TypeError:
+        seen = []
+        for e in container:
+            e = _unbool(e)
+            if e in seen:
+                return False
+            seen.append(e)
+        return True
+
+
+class _Generator(object):
+    """Emits source of a function returning whether instance is valid."""
+
+    def __init__(self):
+        self.lines = []
+        self.constants = {}
+        self.counter = 0
+
+    def name(self, prefix):
+        self.counter += 1
+        return "%s%d" % (prefix, self.counter)
+
+    def constant(self, value):
+        name = self.name("_const")
+        self.constants[name] = value
+        return name
+
+    def emit(self, depth, line):
+        self.lines.append("    " * depth + line)
+
+    def reject_if(self, depth, condition):
+        self.emit(depth, "if %s:" % condition)
+        self.emit(depth + 1, "return False")
+
+    def schema(self, schema, var, depth):
+        if not isinstance(schema, dict):
+            raise UnsupportedSchema("schema is not an object")
+        keywords = set(schema)
+        unknown = (keywords - ANNOTATION_KEYWORDS - OBJECT_KEYWORDS -
+                   ARRAY_KEYWORDS - STRING_KEYWORDS - {"type"})
+        if unknown:
+            raise UnsupportedSchema(
+                "unsupported keywords: " + ", ".join(sorted(unknown)))
+
+        if "type" in schema:
+            self.type(schema["type"], var, depth)
+        if keywords & OBJECT_KEYWORDS:
+            self.emit(depth, "if isinstance(%s, dict):" % var)
+            self.emit(depth + 1, "pass")
+            self.object(schema, var, depth + 1)
+        if keywords & ARRAY_KEYWORDS:
+            self.emit(depth, "if isinstance(%s, list):" % var)
+            self.emit(depth + 1, "pass")
+            self.array(schema, var, depth + 1)
+        if keywords & STRING_KEYWORDS:
+            self.emit(depth, "if isinstance(%s, str):" % var)
+            self.emit(depth + 1, "pass")
+            self.string(schema, var, depth + 1)
+
+    def type(self, types, var, depth):
+        if isinstance(types, str):
+            types = [types]
+        checks = []
+        for t in types:
+            if t not in TYPE_CHECKS:
+                raise UnsupportedSchema("unsupported type: %r" % (t,))
+            checks.append(TYPE_CHECKS[t].format(var))
+        self.reject_if(depth, "not (%s)" % " or ".join(checks))
+
+    def object(self, schema, var, depth):
+        for key in schema.get("required", []):
+            self.reject_if(depth, "%r not in %s" % (key, var))
+        properties = schema.get("properties", {})
+        for key, subschema in properties.items():
+            value = self.name("value")
+            self.emit(depth, "if %r in %s:" % (key, var))
+            self.emit(depth + 1, "%s = %s[%r]" % (value, var, key))
+            self.schema(subschema, value, depth + 1)
+
+        additional = schema.get("additionalProperties", True)
+        known = self.constant(frozenset(properties))
+        if additional is False:
+            self.reject_if(depth, "not %s.issuperset(%s)" % (known, var))
+        elif isinstance(additional, dict):
+            key = self.name("key")
+            self.emit(depth, "for %s in %s:" % (key, var))
+            self.emit(depth + 1, "if %s not in %s:" % (key, known))
+            value = self.name("value")
+            self.emit(depth + 2, "%s = %s[%s]" % (value, var, key))
+            self.schema(additional, value, depth + 2)
+
+    def array(self, schema, var, depth):
+        if "minItems" in schema:
+            self.reject_if(depth, "len(%s) < %d" % (var, schema["minItems"]))
+        if "maxItems" in schema:
+            self.reject_if(depth, "len(%s) > %d" % (var, schema["maxItems"]))
+        if schema.get("uniqueItems"):
+            self.reject_if(depth, "not _unique(%s)" % var)
+        if "items" in schema:
+            if not isinstance(schema["items"], dict):
+                raise UnsupportedSchema("only a single items schema works")
+            element = self.name("element")
+            self.emit(depth, "for %s in %s:" % (element, var))
+            self.schema(schema["items"], element, depth + 1)
+
+    def string(self, schema, var, depth):
+        if "minLength" in schema:
+            self.reject_if(depth,
+                           "len(%s) < %d" % (var, schema["minLength"]))
+        if "maxLength" in schema:
+            self.reject_if(depth,
+                           "len(%s) > %d" % (var, schema["maxLength"]))
+
+
+def compile_schema(schema):
+    """Generates a function checking instances against draft 4 `schema'.
+
+    Returns tuple of the function and its source. Raises UnsupportedSchema
+    if the schema needs anything the generator does not know about."""
+    generator = _Generator()
+    generator.emit(0, "def is_valid(instance):")
+    generator.schema(schema, "instance", 1)
+    generator.emit(1, "return True")
+    source = "\n".join(generator.lines) + "\n"
+
+    namespace = {"numbers" : numbers, "_unique" : _unique}
+    namespace.update(generator.constants)
+    exec(compile(source, "<schema %s>" % schema.get("title", ""), "exec"),
+         namespace)
+    return namespace["is_valid"], source
+
+
+class SchemaValidator(object):
+    """Validates instances against a schema fixed at construction time.
+
+    `is_valid' is the fast path: compiled from the schema when possible,
+    the cached jsonschema validator otherwise. `validate' only consults
+    jsonschema to describe the problem once an instance was rejected."""
+
+    def __init__(self, schema):
+        self.schema = schema
+        self._reference = None
+        try:
+            self.is_valid, self.source = compile_schema(schema)
+        except UnsupportedSchema:
+            self.is_valid, self.source = self.reference.is_valid, None
+
+    @property
+    def reference(self):
+        """jsonschema validator of the schema, created when first needed.
+
+        Raises jsonschema.SchemaError if the schema itself is invalid."""
+        if self._reference is None:
+            import jsonschema
+            jsonschema.Draft4Validator.check_schema(self.schema)
+            self._reference = jsonschema.Draft4Validator(self.schema)
+        return self._reference
+
+    def validate(self, instance):
+        """Raises jsonschema.ValidationError if `instance' is not valid."""
+        if not self.is_valid(instance):
+            self.reference.validate(instance)
+
+
+bird_input = SchemaValidator(bird_schemas.bird_input_schema)